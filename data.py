@@ -1,44 +1,273 @@
 """
-Stub module for downloading the latest data.py from https://github.com/lwa-project/commissioning
+Module for creating and accessing HDF5 files in the standard LWA1 layout used
+by the tools in Commissioning/DRX/HDF5 (https://github.com/lwa-project/commissioning).
+This is a vendored version of the data.py module found there that provides the
+same interface but does not do any network or file I/O when it is imported.
+It also adds support for creating the data sets with a chunked and/or
+compressed layout.
 """
 
 import os
-import time
-from urllib import request as urlrequest
-
-
-# URL to download
-MODULE_URL = 'https://raw.githubusercontent.com/lwa-project/commissioning/master/DRX/HDF5/data.py'
-
-# Where it lives
-MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
-MODULE_NAME = os.path.join(MODULE_PATH, '_data.py')
-MODULE_ETAG = os.path.join(MODULE_PATH, '_data.etag')
-
-# Maximum file age to accept without checking for a newer version
-MAX_AGE_SEC = 86400
-
-
-# Get the current file age and entity tag (if it exists)
-age = 1e6
-etag = ''
-if os.path.exists(MODULE_NAME):
-    age = time.time() - os.path.getmtime(MODULE_NAME)
-    if os.path.exists(MODULE_ETAG):
-        with open(MODULE_ETAG, 'r') as fh:
-            etag = fh.read()
-            
-# If the file is more than MAX_AGE_SEC old, check for an update
-if age > MAX_AGE_SEC:
-    request = urlrequest.Request(MODULE_URL)
-    opener = urlrequest.build_opener()
-    data = opener.open(request)
-    if data.headers['etag'] != etag:
-        with open(MODULE_NAME, 'wb') as fh:
-            fh.write(data.read())
-        with open(MODULE_ETAG, 'w') as fh:
-            fh.write(data.headers['etag'])
-            
-# Load in everything from the module
-from _data import *
-from _data import __all__
+import h5py
+import numpy
+from datetime import datetime
+
+
+__version__ = '0.7'
+__all__ = ['TIME_DTYPE', 'create_new_file', 'fill_minimum', 'fill_from_metabundle',
+           'fill_from_sdf', 'get_observation_set', 'create_observation_set',
+           'get_time', 'get_data_set']
+
+
+#: Data type for the time data set - integer and fractional UNIX time
+TIME_DTYPE = numpy.dtype([('int', '<i8'), ('frac', '<f8')])
+
+
+def _get_station_name(station):
+    """
+    Given a station name or a lsl.common.stations.LWAStation instance, return
+    the station name as it is stored in the file, e.g., 'lwa1' or 'lwasv'.
+    """
+    
+    name = getattr(station, 'name', station)
+    return str(name).lower().replace('-', '')
+
+
+def create_new_file(filename):
+    """
+    Create a new HDF5 file and return the open h5py.File instance for it.  This
+    sets up all of the top level attributes and fills them with dummy values.
+    """
+    
+    # Create the file
+    f = h5py.File(filename, 'w')
+    
+    # Observer and project information
+    f.attrs['ObserverID'] = 0
+    f.attrs['ObserverName'] = ''
+    f.attrs['ProjectID'] = ''
+    f.attrs['SessionID'] = 0
+    
+    # Station information
+    f.attrs['StationName'] = ''
+    
+    # File creation information
+    f.attrs['FileCreation'] = datetime.utcnow().strftime("UTC %Y/%m/%d %H:%M:%S")
+    f.attrs['FileGenerator'] = ''
+    
+    # Input file information
+    f.attrs['InputData'] = ''
+    f.attrs['InputMetadata'] = ''
+    
+    return f
+
+
+def _fill_observation(obs, beam=-1, srate=-1.0, srateUnits='samples/s'):
+    """
+    Fill in the target and observation attributes of an observation group with
+    dummy values.
+    """
+    
+    # Target information
+    obs.attrs['ObservationName'] = ''
+    obs.attrs['TargetName'] = ''
+    obs.attrs['RA'] = -99.0
+    obs.attrs['RA_Units'] = 'hours'
+    obs.attrs['Dec'] = -99.0
+    obs.attrs['Dec_Units'] = 'degrees'
+    obs.attrs['Epoch'] = 2000.0
+    obs.attrs['TrackingMode'] = 'Unknown'
+    
+    # Observation information
+    obs.attrs['Beam'] = beam
+    obs.attrs['DRX_Gain'] = -1.0
+    obs.attrs['sampleRate'] = srate
+    obs.attrs['sampleRate_Units'] = srateUnits
+    obs.attrs['tInt'] = -1.0
+    obs.attrs['tInt_Units'] = 's'
+    obs.attrs['LFFT'] = -1
+    obs.attrs['nChan'] = -1
+    obs.attrs['RBW'] = -1.0
+    obs.attrs['RBW_Units'] = 'Hz'
+
+
+def fill_minimum(f, obsID, beam, srate, srateUnits='samples/s', station=None):
+    """
+    Minimum metadata filling for a particular observation.  Returns True.
+    """
+    
+    # Station information
+    if station is not None:
+        f.attrs['StationName'] = _get_station_name(station)
+        
+    # Get the group or create it if it doesn't exist
+    obs = get_observation_set(f, obsID, create=True)
+    _fill_observation(obs, beam=beam, srate=srate, srateUnits=srateUnits)
+    
+    return True
+
+
+def _fill_from_project(f, project, station=None):
+    """
+    Fill in the observer, project, and observation metadata from a
+    lsl.common.sdf.Project instance.
+    """
+    
+    session = project.sessions[0]
+    
+    # Observer and project information
+    f.attrs['ObserverID'] = project.observer.id
+    f.attrs['ObserverName'] = project.observer.name
+    f.attrs['ProjectID'] = project.id
+    f.attrs['SessionID'] = session.id
+    
+    # Station information
+    if station is None:
+        station = getattr(session, 'station', None)
+    if station is not None:
+        f.attrs['StationName'] = _get_station_name(station)
+        
+    # Observation information
+    for i,obsS in enumerate(session.observations):
+        srate = getattr(obsS, 'filter_codes', {}).get(obsS.filter, -1.0)
+        obs = get_observation_set(f, i+1, create=True)
+        _fill_observation(obs, beam=session.drx_beam, srate=srate)
+        
+        ## Target information
+        obs.attrs['ObservationName'] = obsS.name
+        obs.attrs['TargetName'] = obsS.target
+        if obsS.mode not in ('STEPPED',):
+            obs.attrs['RA'] = obsS.ra
+            obs.attrs['Dec'] = obsS.dec
+        obs.attrs['TrackingMode'] = obsS.mode
+        
+        ## Observation information
+        obs.attrs['DRX_Gain'] = obsS.gain
+        
+    return True
+
+
+def fill_from_metabundle(f, tarball):
+    """
+    Fill in the metadata of a HDF5 file using the contents of the provided
+    MCS metadata tarball.  Returns True.
+    """
+    
+    from lsl.common import metabundle
+    
+    # Pull out what we need from the tarball
+    project = metabundle.get_sdf(tarball)
+    _fill_from_project(f, project)
+    
+    # Input file information
+    f.attrs['InputMetadata'] = os.path.basename(tarball)
+    
+    return True
+
+
+def fill_from_sdf(f, sdfFilename, station=None):
+    """
+    Fill in the metadata of a HDF5 file using the contents of the provided
+    session definition file.  Returns True.
+    """
+    
+    from lsl.common import sdf
+    
+    # Parse the SDF
+    project = sdf.parse_sdf(sdfFilename)
+    _fill_from_project(f, project, station=station)
+    
+    # Input file information
+    f.attrs['InputMetadata'] = os.path.basename(sdfFilename)
+    
+    return True
+
+
+def get_observation_set(f, observation, create=False):
+    """
+    Return the h5py.Group instance for the specified observation.  If create
+    is True the group is created if it does not already exist.
+    """
+    
+    obsPath = f"/Observation{observation}"
+    obs = f.get(obsPath, None)
+    if obs is None:
+        if not create:
+            raise RuntimeError(f"No such observation: {observation}")
+        obs = f.create_group(obsPath)
+        
+    return obs
+
+
+def create_observation_set(f, observation, tuning, frequency, nSamples, data_products, chunks=None, compression=None):
+    """
+    Create the data sets for the specified observation, tuning, and list of
+    data products.  The data sets are allocated at their full size of
+    (nSamples, frequency.size) up front.  The optional chunks keyword sets the
+    chunk shape to use for the data products, and compression selects the
+    filter, e.g., 'lzf' or 'gzip', to compress them with.  The time data set
+    is also created, with a matching chunk length, if it does not already
+    exist.  Returns True.
+    """
+    
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    
+    # Get the observation and create the time data set if needed
+    obs = get_observation_set(f, observation, create=True)
+    if 'time' not in obs:
+        tChunks = None if chunks is None else (chunks[0],)
+        t = obs.create_dataset('time', (nSamples,), TIME_DTYPE, chunks=tChunks)
+        t.attrs['format'] = 'unix'
+        t.attrs['scale'] = 'utc'
+        
+    # Get the tuning group or create it if it doesn't exist
+    grp = obs.get(f"Tuning{tuning}", None)
+    if grp is None:
+        grp = obs.create_group(f"Tuning{tuning}")
+        
+    # Frequencies
+    grp['freq'] = frequency
+    grp['freq'].attrs['Units'] = 'Hz'
+    
+    # Data products
+    for p in data_products:
+        d = grp.create_dataset(p, (nSamples, frequency.size), 'f4',
+                               chunks=chunks, compression=compression)
+        d.attrs['axis0'] = 'time'
+        d.attrs['axis1'] = 'frequency'
+        
+    # Saturation counts
+    grp.create_dataset('Saturation', (nSamples, 2), 'i8')
+    
+    return True
+
+
+def get_time(f, observation):
+    """
+    Return the h5py.Dataset instance holding the times for the specified
+    observation.
+    """
+    
+    obs = get_observation_set(f, observation)
+    return obs['time']
+
+
+def get_data_set(f, observation, tuning, dataProduct):
+    """
+    Return the h5py.Dataset instance for the specified observation, tuning,
+    and data product.
+    """
+    
+    obs = get_observation_set(f, observation)
+    
+    # Get the tuning
+    grp = obs.get(f"Tuning{tuning}", None)
+    if grp is None:
+        raise RuntimeError(f"Unknown tuning for observation {observation}: {tuning}")
+        
+    # Get the data
+    d = grp.get(dataProduct, None)
+    if d is None:
+        raise RuntimeError(f"Unknown data product for observation {observation}, tuning {tuning}: {dataProduct}")
+        
+    return d
@@ -6,160 +6,254 @@ Given a DRX file, create two interleaved DRX (DRXI) files, one for each tuning
 
 import os
 import sys
-import copy
-import struct
+import mmap
+import time
+import numpy
 import argparse
+import traceback
+import fcntl
 from datetime import datetime
+
+import threading
 from collections import deque
 
-from lsl.reader.ldp import DRXFile
-from lsl.reader import drx, errors, buffer
+from lsl.reader import errors
 from lsl import astro
 from lsl.common import progress
 from lsl.common.dp import fS
 from lsl.misc import parser as aph
 
+from drxmmap import DRXMemmapFile
+
+
+#: Number of frame sets to convert at a time.  This is a multiple of 128 so 
+#: that each block of DRXI frames is a multiple of 4096 bytes for O_DIRECT.
+BLOCK_SIZE = 1024
+
+#: Required alignment for O_DIRECT writes
+DIRECT_ALIGNMENT = 4096
+
+MAX_QUEUE_DEPTH = 3
+readerQ = deque()
+
+#: Structured data type for a single interleaved DRX (DRXI) frame
+DRXI_FRAME = numpy.dtype([('sync_word',    '>u4'),
+                          ('id',           'u1'),
+                          ('frame_count',  'u1', (3,)),
+                          ('second_count', '>u4'),
+                          ('decimation',   '>u2'),
+                          ('time_offset',  '>u2'),
+                          ('timetag',      '>u8'),
+                          ('tuning_word',  '>u4'),
+                          ('flags',        '>u4'),
+                          ('payload',      'u1', (8192,))])
+
+#: Header fields that are carried over from the DRX frames
+HEADER_FIELDS = ('sync_word', 'id', 'frame_count', 'second_count', 'decimation', 
+                 'time_offset', 'tuning_word', 'flags')
 
-class RawDRXFrame(object):
+
+def sortFrameSets(nSet, fIndex, aStand, frames):
     """
-    Class to help hold and work with a raw (packed) DRX frame.
+    Given the output of DRXMemmapFile.read_frames(), return the frames as a 
+    nSet by 4 (tuning/polarization) DRX_FRAME array.  If the frames are 
+    already in order this is a view into the file, otherwise they are sorted.
+    Returns None if any frames are missing.
     """
     
-    def __init__(self, contents):
-        self.contents = bytearray(contents)
-        if len(self.contents) != drx.FRAME_SIZE:
-            raise errors.EOFError
-        if self.contents[0] != 0xDE or self.contents[1] != 0xC0 or self.contents[2] != 0xDE or self.contents[3] != 0x5c:
-            raise errors.SyncError
-            
-    def __getitem__(self, key):
-        return self.contents[key]
-        
-    def __setitem__(self, key, value):
-        self.contents[key] = value
+    if len(frames) != 4*nSet:
+        return None
         
-    @property
-    def id(self):
-        _id = self.contents[4]
-        _id = (_id & 7), ((_id >> 3) & 7), ((_id >> 7) & 1)
-        return _id
+    if (fIndex[1:] < fIndex[:-1]).any() or (aStand.reshape(-1, 4) != numpy.arange(4)).any():
+        order = numpy.lexsort((aStand, fIndex))
+        fIndex, aStand, frames = fIndex[order], aStand[order], frames[order]
+    if (fIndex != numpy.arange(4*nSet) // 4).any() or (aStand.reshape(-1, 4) != numpy.arange(4)).any():
+        return None
         
-    @property
-    def timetag(self):
-        time_tag = 0
-        time_tag |= self.contents[16] << 56
-        time_tag |= self.contents[17] << 48
-        time_tag |= self.contents[18] << 40
-        time_tag |= self.contents[19] << 32
-        time_tag |= self.contents[20] << 24
-        time_tag |= self.contents[21] << 16
-        time_tag |= self.contents[22] <<  8
-        time_tag |= self.contents[23]
-        return time_tag
-        
-    @property
-    def tNom(self):
-        t_nom = (self.contents[14] << 8) | self.contents[15]
-        return t_nom
+    return frames.reshape(nSet, 4)
 
 
-class RawDRXFrameBuffer(buffer.FrameBufferBase):
+def findGaps(nSet, fIndex, aStand):
+    """
+    Given the output of DRXMemmapFile.read_frames(), find which frames are 
+    present in a block of frame sets.  Returns a three-element tuple of a nSet
+    by 4 (tuning/polarization) boolean array of the frames that are present,
+    and the starting set index and length of each run of completely missing 
+    frame sets.
     """
-    A sub-type of FrameBufferBase specifically for dealing with raw (packed) DRX 
-    frames.  See :class:`lsl.reader.buffer.FrameBufferBase` for a description of 
-    how the buffering is implemented.
     
-    Keywords:
-    beams
-    list of beam to expect packets for
+    present = numpy.zeros((nSet, 4), dtype=bool)
+    present[fIndex, aStand] = True
     
-    tunes
-    list of tunings to expect packets for
+    missing = numpy.concatenate([[0], (~present.any(axis=1)).astype(numpy.int8), [0]])
+    edges = numpy.diff(missing)
+    starts = numpy.nonzero(edges == 1)[0]
+    lengths = numpy.nonzero(edges == -1)[0] - starts
     
-    pols
-    list of polarizations to expect packets for
+    return present, starts, lengths
+
+
+def updateFillFrame(fill, template):
+    """
+    Update the header of a zero-payload DRXI fill frame using the provided DRX
+    frame as a template.
+    """
     
-    nsegments
-    number of ring segments to use for the buffer (default is 20)
+    for name in HEADER_FIELDS:
+        fill[name] = template[name]
+
+
+def interleaveTuning(tuning, timetag, ttSkip, nSet, fIndex, aStand, frames, sets, present, fill, out=None):
+    """
+    Build the DRXI frames for a block of frame sets for the given tuning.  The
+    header comes from the X polarization frame with the T_NOM offset removed 
+    from the time tag, and the X and Y payloads are interleaved byte-by-byte.
+    Any missing frames are filled in from the provided fill frame.  If out is
+    provided the frames are built in its first nSet entries.
+    """
     
-    reorder
-    whether or not to reorder frames returned by get() or flush() by 
-    stand/polarization (default is False)
+    if out is None:
+        out = numpy.empty(nSet, dtype=DRXI_FRAME)
+    else:
+        out = out[:nSet]
     
-    The number of segements in the ring can be converted to a buffer time in 
-    seconds:
+    if sets is not None:
+        ## All there - strided copies out of the sorted frame sets
+        frameX = sets[:,2*(tuning-1)+0]
+        for name in HEADER_FIELDS:
+            out[name] = frameX[name]
+        out['payload'][:,0::2] = frameX['payload']
+        out['payload'][:,1::2] = sets[:,2*(tuning-1)+1]['payload']
+        
+    else:
+        ## Missing frames - start the incomplete sets from the fill frame and 
+        ## then scatter what we have
+        out[~(present[:,2*(tuning-1)+0] & present[:,2*(tuning-1)+1])] = fill
+        x = numpy.nonzero(aStand == 2*(tuning-1)+0)[0]
+        y = numpy.nonzero(aStand == 2*(tuning-1)+1)[0]
+        for name in HEADER_FIELDS:
+            out[name][fIndex[x]] = frames[name][x]
+        out['payload'][fIndex[x],0::2] = frames['payload'][x]
+        out['payload'][fIndex[y],1::2] = frames['payload'][y]
+        
+    ## Update the quatities that have changed:  the ID now flags this as 
+    ## interleaved data and the T_NOM offset is moved into the time tag
+    out['id'] = (1<<6) | (out['id'] & (7<<3)) | (out['id'] & 7)
+    out['timetag'] = timetag + numpy.arange(nSet, dtype=numpy.int64)*ttSkip - out['time_offset']
+    out['time_offset'] = 0
     
-    +----------+--------------------------------------------------+
-    |          |                 DRX Filter Code                  |
-    | Segments +------+------+------+------+------+-------+-------+
-    |          |  1   |  2   |  3   |  4   |  5   |  6    |  7    |
-    +----------+------+------+------+------+------+-------+-------+
-    |    10    | 0.16 | 0.08 | 0.04 | 0.02 | 0.01 | 0.004 | 0.002 |
-    +----------+------+------+------+------+------+-------+-------+
-    |    20    | 0.33 | 0.16 | 0.08 | 0.04 | 0.02 | 0.008 | 0.004 |
-    +----------+------+------+------+------+------+-------+-------+
-    |    30    | 0.49 | 0.25 | 0.12 | 0.06 | 0.03 | 0.013 | 0.006 |
-    +----------+------+------+------+------+------+-------+-------+
-    |    40    | 0.66 | 0.33 | 0.16 | 0.08 | 0.03 | 0.017 | 0.008 |
-    +----------+------+------+------+------+------+-------+-------+
-    |    50    | 0.82 | 0.41 | 0.20 | 0.10 | 0.04 | 0.021 | 0.010 |
-    +----------+------+------+------+------+------+-------+-------+
-    |   100    | 1.64 | 0.82 | 0.41 | 0.20 | 0.08 | 0.042 | 0.021 |
-    +----------+------+------+------+------+------+-------+-------+
+    return out
+
+
+def alignedFrames(count):
+    """
+    Return an array of count DRXI frames that is backed by page-aligned memory
+    so that it can be used with O_DIRECT.
+    """
     
+    buf = mmap.mmap(-1, count*DRXI_FRAME.itemsize)
+    return numpy.frombuffer(buf, dtype=DRXI_FRAME)
+
+
+def reader(idf, nCaptures, outQueue, failures):
+    """
+    Read ahead blocks of frame sets from the file, sort them, and look for
+    missing frames so that the main thread only needs to build the DRXI frames.
+    Any exception is added to the failures list.
     """
     
-    def __init__(self, beams=[], tunes=[1,2], pols=[0, 1], nsegments=20, reorder=False):
-        super(RawDRXFrameBuffer, self).__init__(mode='DRX', beams=beams, tunes=tunes, pols=pols, nsegments=nsegments, reorder=reorder)
-        
-    def get_max_frames(self):
-        """
-        Calculate the maximum number of frames that we expect from 
-        the setup of the observations and a list of tuples that describes
-        all of the possible stand/pol combination.
-        """
-        
-        nFrames = 0
-        frameList = []
-        
-        nFrames = len(self.beams)*len(self.tunes)*len(self.pols)
-        for beam in self.beams:
-            for tune in self.tunes:
-                for pol in self.pols:
-                    frameList.append((beam,tune,pol))
-                    
-        return (nFrames, frameList)
-        
-    def get_figure_of_merit(self, frame):
-        """
-        Figure of merit for sorting frames.  For DRX it is:
-            <frame timetag in ticks>
-        """
+    # Setup
+    done = False
+    c = 0
+    
+    try:
+        while c < nCaptures:
+            while len(outQueue) >= MAX_QUEUE_DEPTH:
+                time.sleep(0.001)
+                
+            ## Read in the data
+            try:
+                timetag, nSet, fIndex, aStand, frames = idf.read_frames(min([BLOCK_SIZE, nCaptures-c]))
+            except errors.EOFError:
+                done = True
+                break
+            if nSet == 0:
+                done = True
+                break
+                
+            ## Put the frames in order and find any missing frames
+            sets = sortFrameSets(nSet, fIndex, aStand, frames)
+            gaps = None
+            if sets is None:
+                gaps = findGaps(nSet, fIndex, aStand)
+                
+            ## Add it to the queue
+            outQueue.append( (c, timetag, nSet, fIndex, aStand, frames, sets, gaps) )
+            c += nSet
+            
+    except Exception as e:
+        lines = traceback.format_exc()
+        lines = '\x1b[2KReader Error '+lines
+        print(lines,)
+        failures.append(e)
         
-        return frame.timetag
+    outQueue.append( (None,done) )
+
+
+def writer(fd, inQueue, freeBuffers, failures, direct=False):
+    """
+    Write blocks of DRXI frames to a file descriptor and return the buffers to
+    the free list once they are written.  For O_DIRECT output, O_DIRECT is
+    turned off for a final block that is not a multiple of DIRECT_ALIGNMENT.
+    Any exception is added to the failures list and the writer stops.
+    """
     
-    def create_fill(self, key, frameParameters):
-        """
-        Create a 'fill' frame of zeros using an existing good
-        packet as a template.
-        """
+    try:
+        incoming = getFromQueue(inQueue)
+        while incoming[0] is not None:
+            ## Unpack
+            buf, nSet = incoming
+            
+            ## Write
+            data = memoryview(buf[:nSet]).cast('B')
+            if direct and len(data) % DIRECT_ALIGNMENT != 0:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                direct = False
+            while len(data):
+                data = data[os.write(fd, data):]
+                
+            ## Return the buffer
+            freeBuffers.append( buf )
+            
+            ## Fetch another one
+            incoming = getFromQueue(inQueue)
+            
+    except Exception as e:
+        lines = traceback.format_exc()
+        lines = '\x1b[2KWriter Error '+lines
+        print(lines,)
+        failures.append(e)
 
-        # Get a template based on the first frame for the current buffer
-        fillFrame = copy.deepcopy(self.buffer[key][0])
-        
-        # Get out the frame parameters and fix-up the header
-        beam, tune, pol = frameParameters
-        fillFrame[4] = (beam & 7) | ((tune & 7) << 3) | ((pol & 1) << 7)
-        
-        # Zero the data for the fill packet
-        fillFrame[32:] = [0,]*4096
-        
-        return fillFrame
+
+def getFromQueue(queueName, failures=None):
+    """
+    Wait for an item to show up in a queue and return it.  If a list of
+    failures is provided, the first one is re-raised if it is not empty.
+    """
+    
+    while len(queueName) == 0:
+        if failures:
+            raise failures[0]
+        time.sleep(0.001)
+    return queueName.popleft()
 
 
 def main(args):
+    global MAX_QUEUE_DEPTH
+    MAX_QUEUE_DEPTH = min([args.queue_depth, 10])
+    
     # Open the file
-    idf = DRXFile(args.filename)
+    idf = DRXMemmapFile(args.filename)
     
     # Load in basic information about the data
     nFramesFile = idf.get_info('nframe')
@@ -177,8 +271,6 @@ def main(args):
     beginDate = idf.get_info('start_time')
     beginTime = beginDate.datetime
     mjd = beginDate.mjd
-    mjd_day = int(mjd)
-    mjd_sec = (mjd-mjd_day)*86400
     
     ## Tuning frequencies
     central_freq1 = idf.get_info('freq1')
@@ -207,180 +299,115 @@ def main(args):
     outname = os.path.splitext(outname)[0]
     print(f"Writing {nCaptures*4096/srate:.2f} s to file '{outname}_b{beam}t[12].dat'")
     
-    # Ready the internal interface for file access
-    fh = idf.fh
+    # Ready the output files - one for each tune/pol - along with their writer
+    # threads and buffers
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if args.direct:
+        if hasattr(os, 'O_DIRECT'):
+            flags |= os.O_DIRECT
+        else:
+            print("WARNING: O_DIRECT is not supported on this platform, disabling")
+            args.direct = False
+    fdOut = []
+    writerQs = []
+    freeBuffers = []
+    failures = []
+    wtrs = []
+    for tuning in (1, 2):
+        fdOut.append( os.open(f"{outname}_b{beam}t{tuning}.dat", flags, 0o644) )
+        writerQs.append( deque() )
+        freeBuffers.append( deque([alignedFrames(BLOCK_SIZE) for i in range(MAX_QUEUE_DEPTH+1)]) )
+        wtr = threading.Thread(target=writer, args=(fdOut[-1], writerQs[-1], freeBuffers[-1], failures), kwargs={'direct':args.direct})
+        wtr.setDaemon(True)
+        wtr.start()
+        wtrs.append( wtr )
         
-    # Ready the output files - one for each tune/pol
-    fhOut = []
-    fhOut.append( open(f"{outname}_b{beam}t1.dat", 'wb') )
-    fhOut.append( open(f"{outname}_b{beam}t2.dat", 'wb') )
-    
     pb = progress.ProgressBarPlus(max=nCaptures)
     
-    newFrame = bytearray([0 for i in range(32+4096*2)])
-    
-    # Setup the buffer
-    buffer = RawDRXFrameBuffer(beams=[beam,], reorder=True)
+    # Setup the zero-payload fill frames, one for each tuning
+    fills = [numpy.zeros((), dtype=DRXI_FRAME), numpy.zeros((), dtype=DRXI_FRAME)]
+    fillReady = [False, False]
     
     # Go!
-    c = 0
-    eofFound = False
-    while c < int(nCaptures):
-        if eofFound:
-            break
-            
-        ## Load in some frames
-        if not buffer.overfilled:
-            rFrames = deque()
-            for i in range(tunepol):
-                try:
-                    rFrames.append( RawDRXFrame(fh.read(drx.FRAME_SIZE)) )
-                    #print rFrames[-1].id, rFrames[-1].timetag, c, i
-                except errors.EOFError:
-                    eofFound = True
-                    buffer.append(rFrames)
-                    break
-                except errors.SyncError:
-                    continue
-                
-            buffer.append(rFrames)
+    rdr = threading.Thread(target=reader, args=(idf, int(nCaptures), readerQ, failures))
+    rdr.setDaemon(True)
+    rdr.start()
+    
+    gapRun = 0
+    nGaps = nGapSets = nPartialSets = nFillFrames = 0
+    incoming = getFromQueue(readerQ, failures)
+    while incoming[0] is not None:
+        ## Unpack
+        c, timetag, nSet, fIndex, aStand, frames, sets, gaps = incoming
+        
+        ## Account for any missing frames
+        present = None
+        if gaps is not None:
+            present, starts, lengths = gaps
             
-        timetag = buffer.peek()
-        if timetag is None:
-            # Continue adding frames if nothing comes out.
-            continue
+            ### Runs of missing frame sets, including any carried over from the 
+            ### previous block
+            runs = lengths.copy()
+            if len(starts) and starts[0] == 0 and gapRun:
+                runs[0] += gapRun
+                nGaps -= 1
+            if len(runs) and runs.max() > args.max_gap:
+                raise RuntimeError(f"timetag skip at {c}, {runs.max()} missing frame sets exceeds the maximum of {args.max_gap}")
+            gapRun = 0
+            if len(starts) and starts[-1] + lengths[-1] == nSet:
+                gapRun = runs[-1]
+            nGaps += len(starts)
+            nGapSets += lengths.sum()
+            nPartialSets += (present.any(axis=1) & ~present.all(axis=1)).sum()
+            nFillFrames += (~present).sum()
         else:
-            # Otherwise, make sure we are on track
-            try:
-                timetag = timetag - tNomX # T_NOM has been subtracted from ttLast
-                if timetag != ttLast + ttSkip:
-                    missing = (timetag - ttLast - ttSkip) / float(ttSkip)
-                    if int(missing) == missing and missing < 50:
-                        ## This is kind of black magic down here
-                        for m in range(int(missing)):
-                            m = ttLast + ttSkip*(m+1) + tNomX   # T_NOM has been subtracted from ttLast
-                            baseframe = copy.deepcopy(rFrames[0])
-                            baseframe[14:24] = struct.pack('>HQ', struct.unpack('>HQ', baseframe[14:24])[0], m)
-                            baseframe[32:] = [0,]*4096
-                            buffer.append(baseframe)
-            except NameError:
-                pass
-        rFrames = buffer.get()
-        
-        ## Continue adding frames if nothing comes out.
-        if rFrames is None:
-            continue
+            gapRun = 0
             
-        ## If something comes out, process it
+        ## Build the interleaved frames for each tuning and hand them off to
+        ## the writers
         for tuning in (1, 2):
-            ### Load
-            pair0 = rFrames[2*(tuning-1)+0]
-            pair1 = rFrames[2*(tuning-1)+1]
-            
-            ### ID manipulation
-            idX = pair0[4]
-            #idY = pair1[4]
-            id = (0<<7) | (1<<6) | (idX&(7<<3)) | (idX&7)
-            
-            ### Time tag manipulation to remove the T_NOM offset
-            tNomX, timetagX = pair0.tNom, pair0.timetag
-            #tNomY, timetagX = pair1.tNom, pair1.timetag
-            tNom = tNomX - tNomX
-            timetag = timetagX - tNomX
-            
-            ## Check for timetag problems
-            if tuning == 1:
-                try:
-                    ttDiff = timetag - ttLast
-                    if ttDiff != ttSkip:
-                        raise RuntimeError(f"timetag skip at {c}, {ttDiff} != {ttSkip} ({1.0*ttDiff/ttSkip:.1f} frames)")
-                except NameError:
-                    pass
-                ttLast = timetag
-                
-            ### Build the new frame
-            newFrame[0:32] = pair0[0:32]
-            newFrame[32:8224:2] = pair0[32:]
-            newFrame[33:8224:2] = pair1[32:]
-            
-            ### Update the quatities that have changed
-            try:
-                newFrame[4] = struct.pack('>B', id)
-            except TypeError:
-                newFrame[4] = int.from_bytes(struct.pack('>B', id), byteorder='little')
-            newFrame[14:24] = struct.pack('>HQ', tNom, timetag)
-            
-            ### Save
-            fhOut[tuning-1].write(newFrame)
-            
-        c += 1
-        pb.inc(amount=1)
-        if c != 0 and c % 5000 == 0:
-            sys.stdout.write(pb.show()+'\r')
-            sys.stdout.flush()
-            
-    # If we've hit the end of the file and haven't read in enough frames, 
-    # flush the buffer
-    if eofFound or c < int(nCaptures):
-        for rFrames in buffer.flush():
-            if c == int(nCaptures):
-                break
-                
-            for tuning in (1, 2):
-                ### Load
-                pair0 = rFrames[2*(tuning-1)+0]
-                pair1 = rFrames[2*(tuning-1)+1]
-                
-                ### ID manipulation
-                idX = pair0[4]
-                #idY = pair1[4]
-                id = (0<<7) | (1<<6) | (idX&(7<<3)) | (idX&7)
-                
-                ### Time tag manipulation to remove the T_NOM offset
-                tNomX, timetagX = pair0.tNom, pair0.timetag
-                #tNomY, timetagX = pair1.tNom, pair1.timetag
-                tNom = tNomX - tNomX
-                timetag = timetagX - tNomX
-                
-                ## Check for timetag problems
-                if tuning == 1:
-                    try:
-                        ttDiff = timetag - ttLast
-                        if ttDiff != ttSkip:
-                            raise RuntimeError(f"timetag skip at {c}, {ttDiff} != {ttSkip} ({1.0*ttDiff/ttSkip:.1f} frames)")
-                    except NameError:
-                        pass
-                    ttLast = timetag
+            ### Keep the fill frame up to date
+            if sets is None:
+                t = numpy.nonzero(aStand // 2 == tuning-1)[0]
+                if len(t):
+                    updateFillFrame(fills[tuning-1], frames[t[0]])
+                    fillReady[tuning-1] = True
+                elif not fillReady[tuning-1]:
+                    raise RuntimeError(f"No frames found for tuning {tuning} at {c}")
                     
-                ### Build the new frame
-                newFrame[0:32] = pair0[0:32]
-                newFrame[32:8224:2] = pair0[32:]
-                newFrame[33:8224:2] = pair1[32:]
-                
-                ### Update the quatities that have changed
-                try:
-                    newFrame[4] = struct.pack('>B', id)
-                except TypeError:
-                    newFrame[4] = int.from_bytes(struct.pack('>B', id), byteorder='little')
-                newFrame[14:24] = struct.pack('>HQ', tNom, timetag)
-                
-                ### Save
-                fhOut[tuning-1].write(newFrame)
-                
-            c += 1
-            pb.inc(amount=1)
-            if c != 0 and c % 5000 == 0:
-                sys.stdout.write(pb.show()+'\r')
-                sys.stdout.flush()
-                
+            buf = getFromQueue(freeBuffers[tuning-1], failures)
+            interleaveTuning(tuning, timetag, ttSkip, nSet, fIndex, aStand, frames, sets, present, fills[tuning-1], out=buf)
+            writerQs[tuning-1].append( (buf, nSet) )
+            
+        pb.inc(amount=nSet)
+        sys.stdout.write(pb.show()+'\r')
+        sys.stdout.flush()
+        
+        ## Fetch another one
+        incoming = getFromQueue(readerQ, failures)
+        
+    rdr.join()
+    
+    # Let the writers finish up
+    for writerQ,wtr,fd in zip(writerQs, wtrs, fdOut):
+        writerQ.append( (None,True) )
+        wtr.join()
+        os.close(fd)
+        
+    # Stop if anything went wrong in the reader or the writers
+    if failures:
+        raise RuntimeError(f"Conversion failed: {failures[0]}") from failures[0]
+        
     # Update the progress bar with the total time used
     pb.amount = pb.max
     sys.stdout.write(pb.show()+'\n')
     sys.stdout.flush()
-    for f in fhOut:
-        f.close()
-        
-    fh.close()
+    
+    idf.close()
+    
+    # Gap summary
+    print(f"Missing Frames: {nFillFrames} filled with zeros")
+    print(f"  {nGaps} gap(s) covering {nGapSets} frame set(s), {nPartialSets} partial frame set(s)")
 
 
 if __name__ == "__main__":
@@ -394,6 +421,12 @@ if __name__ == "__main__":
                         help='number of seconds to keep')
     parser.add_argument('-o', '--offset', type=aph.positive_or_zero_float, default=0.0, 
                         help='number of seconds to skip before splitting')
+    parser.add_argument('-g', '--max-gap', type=aph.positive_int, default=50, 
+                        help='maximum number of consecutive missing frame sets to fill with zeros')
+    parser.add_argument('-d', '--direct', action='store_true', 
+                        help='write the output files with O_DIRECT to bypass the page cache')
+    parser.add_argument('-q', '--queue-depth', type=aph.positive_int, default=3, 
+                        help='reader and writer queue depth')
     args = parser.parse_args()
     main(args)
     
@@ -0,0 +1,247 @@
+"""
+Memory-mapped DRX file reader that works on whole blocks of frames at once.
+
+The file is viewed as an array of DRX frames through a numpy structured data
+type so that frame validation, sorting, and gap detection are all vectorized.
+The data are returned as packed 4+4-bit samples that can be passed directly to
+PulsarEngineRaw without first unpacking them to complex64.
+"""
+
+import mmap
+import numpy
+
+from lsl.reader import errors
+from lsl.reader.base import FrameTimestamp
+from lsl.common.dp import fS
+
+
+__all__ = ['DRX_FRAME_SIZE', 'DRX_SYNC_WORD', 'DRX_FRAME', 'get_frame_ids',
+           'DRXMemmapFile']
+
+
+#: Size of a DRX frame in bytes
+DRX_FRAME_SIZE = 4128
+
+#: Mark 5C sync word as it appears when read as a big endian 32-bit integer
+DRX_SYNC_WORD = 0xDEC0DE5C
+
+#: Structured data type for a single DRX frame
+DRX_FRAME = numpy.dtype([('sync_word',    '>u4'),
+                         ('id',           'u1'),
+                         ('frame_count',  'u1', (3,)),
+                         ('second_count', '>u4'),
+                         ('decimation',   '>u2'),
+                         ('time_offset',  '>u2'),
+                         ('timetag',      '>u8'),
+                         ('tuning_word',  '>u4'),
+                         ('flags',        '>u4'),
+                         ('payload',      'u1', (4096,))])
+
+
+def get_frame_ids(ids):
+    """
+    Given an array of DRX ID bytes, return a three-element tuple of arrays for
+    the beam, tuning, and polarization of each frame.
+    """
+    
+    ids = numpy.asarray(ids)
+    return (ids & 7), ((ids >> 3) & 7), ((ids >> 7) & 1)
+
+
+class DRXMemmapFile(object):
+    """
+    Class to read DRX data from a memory-mapped file.  This mirrors the parts
+    of lsl.reader.ldp.DRXFile that are used by the writePsrfits2 family of
+    scripts, i.e., get_info(), offset(), read(), and close().  The data
+    returned by read() are a 2-D numpy.uint8 array of packed 4+4-bit samples
+    with the first dimension holding, in order:
+     * Tuning 1, polarization X
+     * Tuning 1, polarization Y
+     * Tuning 2, polarization X
+     * Tuning 2, polarization Y
+    Missing frames are filled with zeros.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'rb')
+        self._mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            
+        # Find the first frame and view the rest of the file as frames
+        start = self._mmap.find(DRX_SYNC_WORD.to_bytes(4, byteorder='big'))
+        if start < 0:
+            raise errors.SyncError()
+        nframe = (len(self._mmap) - start) // DRX_FRAME_SIZE
+        self._frames = numpy.frombuffer(self._mmap, dtype=DRX_FRAME, count=nframe, offset=start)
+        self._start = start
+        
+        self._pos = 0
+        self._timetag = None
+        self._describe_file()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    def _describe_file(self):
+        """
+        Describe the DRX file starting at the current position.
+        """
+        
+        head = self._frames[self._pos:self._pos+64]
+        if len(head) == 0:
+            raise errors.EOFError()
+        head = head[(head['sync_word'] == DRX_SYNC_WORD) & ((head['id'] >> 6) & 1 == 0)]
+        
+        beams, tunes, pols = get_frame_ids(head['id'])
+        ids = numpy.unique(head['id'])
+        
+        tuning1 = 0.0
+        tuning2 = 0.0
+        if (tunes == 1).any():
+            tuning1 = int(head['tuning_word'][tunes == 1][0])*fS / 2**32
+        if (tunes == 2).any():
+            tuning2 = int(head['tuning_word'][tunes == 2][0])*fS / 2**32
+            
+        timetag = int(head['timetag'][0])
+        time_offset = int(head['time_offset'][0])
+        
+        self.description = {'size': len(self._mmap), 'nframe': len(self._frames) - self._pos,
+                            'frame_size': DRX_FRAME_SIZE, 'nbeampol': len(ids),
+                            'beam': int(beams[0]), 'sample_rate': fS / int(head['decimation'][0]),
+                            'data_bits': 4,
+                            'start_time': FrameTimestamp.from_dp_timetag(timetag, offset=time_offset),
+                            'start_time_samples': timetag - time_offset,
+                            'freq1': tuning1, 'freq2': tuning2}
+        self._ttSkip = int(round(4096 / self.description['sample_rate'] * fS))
+        self._time_offset = time_offset
+        
+    def get_info(self, key=None):
+        """
+        Retrieve metadata about the file.  This will return a dictionary of
+        values if no key is specified.
+        """
+        
+        if key is None:
+            return self.description
+        return self.description[key]
+        
+    def offset(self, offset):
+        """
+        Offset a specified number of seconds from the current position in the
+        file.  This function returns the exact offset time.
+        """
+        
+        beampols = self.description['nbeampol']
+        tt0 = int(self._frames['timetag'][self._pos])
+        target = tt0 + int(offset * self.description['sample_rate'] / 4096)*self._ttSkip
+        
+        # Jump to where the frame should be and then refine the position using
+        # the time tags to deal with any missing frames
+        pos = self._pos + int(offset * self.description['sample_rate'] / 4096)*beampols
+        for i in range(1000):
+            pos = min([max([pos, self._pos]), len(self._frames)-1])
+            tt1 = int(self._frames['timetag'][pos])
+            cOffset = (target - tt1) // self._ttSkip * beampols
+            if cOffset == 0:
+                break
+            pos += cOffset
+            
+        # Back up to the start of the frame set
+        while pos > self._pos and self._frames['timetag'][pos-1] == self._frames['timetag'][pos]:
+            pos -= 1
+            
+        self._pos = pos
+        self._timetag = None
+        self._describe_file()
+        
+        return (tt1 - tt0) / fS
+        
+    def read_frames(self, frame_count):
+        """
+        Read in the next frame_count frame sets and return a five-element tuple
+        of the time tag of the first set, the number of sets read, the set 
+        index and the tuning/polarization index (0 through 3) of each frame,
+        and the frames themselves as a DRX_FRAME array.  Only valid frames are
+        returned so that missing frames show up as gaps in the set index.
+        """
+        
+        if self._pos >= len(self._frames):
+            raise errors.EOFError()
+            
+        beampols = self.description['nbeampol']
+        
+        # Select the frames that belong to this read using their time tags
+        if self._timetag is None:
+            self._timetag = int(self._frames['timetag'][self._pos])
+        block = self._frames[self._pos:self._pos+frame_count*beampols]
+        tDiff = block['timetag'].astype(numpy.int64) - self._timetag
+        fIndex = tDiff // self._ttSkip
+        synced = block['sync_word'] == DRX_SYNC_WORD
+        nUsed = numpy.nonzero(synced & (fIndex >= frame_count))[0]
+        nUsed = nUsed[0] if len(nUsed) else len(block)
+        block, tDiff, fIndex, synced = block[:nUsed], tDiff[:nUsed], fIndex[:nUsed], synced[:nUsed]
+        
+        # Validate the frames and find where they go in the output
+        beams, tunes, pols = get_frame_ids(block['id'])
+        aStand = 2*(tunes.astype(numpy.int64)-1) + pols
+        valid = synced & (tDiff >= 0) & (tDiff % self._ttSkip == 0) \
+                & (aStand >= 0) & (aStand < 4)
+        if not valid.all():
+            block, fIndex, aStand = block[valid], fIndex[valid], aStand[valid]
+            
+        # Update the position, trimming the number of sets if we have hit the
+        # end
+        self._pos += nUsed
+        nSet = frame_count
+        if self._pos >= len(self._frames):
+            nSet = int(fIndex.max()) + 1 if len(fIndex) else 0
+        timetag = self._timetag
+        self._timetag += frame_count*self._ttSkip
+        
+        # Ask for the next block to be read in while this one is being used
+        if hasattr(mmap, 'MADV_WILLNEED') and self._pos < len(self._frames):
+            start = self._start + self._pos*DRX_FRAME_SIZE
+            start -= start % mmap.PAGESIZE
+            length = min([self._start + (self._pos+frame_count*beampols)*DRX_FRAME_SIZE, len(self._mmap)]) - start
+            self._mmap.madvise(mmap.MADV_WILLNEED, start, length)
+            
+        return timetag, nSet, fIndex, aStand, block
+        
+    def read(self, duration):
+        """
+        Read in the specified number of seconds of data and return a
+        three-element tuple of the actual duration read in, the time of the
+        first sample, and the packed data.
+        """
+        
+        frame_count = int(round(1.0 * duration * self.description['sample_rate'] / 4096))
+        frame_count = frame_count if frame_count else 1
+        
+        timetag, nSet, fIndex, aStand, block = self.read_frames(frame_count)
+        
+        # Like lsl.reader.ldp.DRXFile.read the output is always frame_count
+        # sets long and zero-padded past the end of the file
+        data = numpy.zeros((4, frame_count, 4096), dtype=numpy.uint8)
+        data[aStand, fIndex] = block['payload']
+        t = FrameTimestamp.from_dp_timetag(timetag, offset=self._time_offset)
+        
+        return nSet*4096/self.description['sample_rate'], t, data.reshape(4, -1)
+        
+    def close(self):
+        """
+        Close the file.
+        """
+        
+        del self._frames
+        try:
+            self._mmap.close()
+        except BufferError:
+            # There are still views of the frames around, the map will be 
+            # closed once they are gone
+            pass
+        self.fh.close()
@@ -39,6 +39,23 @@ void read_wisdom(char *filename, PyObject *m) {
 }
 
 
+/*
+ Load a single complex sample from a stands by samples input array.
+*/
+
+template<typename InType>
+inline Complex32 load_sample(InType const* data, long idx) {
+	return Complex32(*(data + 2*idx + 0), *(data + 2*idx + 1));
+}
+
+template<>
+inline Complex32 load_sample<uint8_t>(uint8_t const* data, long idx) {
+	// Packed 4+4-bit DRX sample with I in the high nibble and Q in the low one
+	int8_t s = (int8_t) *(data + idx);
+	return Complex32(s >> 4, ((int8_t) (s << 4)) >> 4);
+}
+
+
 template<typename InType, typename OutType>
 void pulsar_engine(long nStand,
 									 long nSamps,
@@ -46,9 +63,12 @@ void pulsar_engine(long nStand,
 									 int nChan,
 									 InType const* data,
 									 double const* window,
-									 OutType* fdomain) {
+									 OutType* fdomain,
+									 InType const* prev=NULL,
+									 long nPrev=0,
+									 long offset=0) {
 	// Setup
-  long ij, i, j, k;
+  long ij, i, j, k, m;
 	
 	Py_BEGIN_ALLOW_THREADS
 	
@@ -65,7 +85,7 @@ void pulsar_engine(long nStand,
 	long secStart;
 	
 	#ifdef _OPENMP
-		#pragma omp parallel default(shared) private(in, secStart, i, j, k)
+		#pragma omp parallel default(shared) private(in, secStart, i, j, k, m)
 	#endif
 	{
 		in = (Complex32*) fftwf_malloc(sizeof(Complex32) * nChan);
@@ -77,10 +97,17 @@ void pulsar_engine(long nStand,
 			i = ij / nFFT;
 			j = ij % nFFT;
 			
-			secStart = nSamps * i + nChan*j;
+			// Start of the window in the stream formed by prev followed by data
+			secStart = offset + nChan*j;
 			
 			for(k=0; k<nChan; k++) {
-				in[k]  = Complex32(*(data + 2*secStart + 2*k + 0), *(data + 2*secStart + 2*k + 1));
+				m = secStart + k;
+				if( m < nPrev ) {
+					in[k]  = load_sample(prev, nPrev*i + m);
+				} else {
+					m -= nPrev;
+					in[k]  = load_sample(data, nSamps*i + m);
+				}
 				if( window != NULL ) {
           in[k] *= *(window + k);
         }
@@ -107,35 +134,66 @@ void pulsar_engine(long nStand,
 }
 
 PyObject *PulsarEngineRaw(PyObject *self, PyObject *args, PyObject *kwds) {
-	PyObject *signals, *signalsF=NULL;
-	PyArrayObject *data=NULL, *dataF=NULL;
+	PyObject *signals, *signalsF=NULL, *prevSignals=NULL;
+	PyArrayObject *data=NULL, *dataF=NULL, *dataP=NULL;
 	int nChan = 64;
+	long offset = 0;
+	int inType = NPY_COMPLEX64;
 	
-	long nStand, nSamps, nFFT;
+	long nStand, nSamps, nFFT, nPrev;
 	
-	char const* kwlist[] = {"signals", "LFFT", "signalsF", NULL};
-	if(!PyArg_ParseTupleAndKeywords(args, kwds, "O|iO", const_cast<char **>(kwlist), &signals, &nChan, &signalsF)) {
+	char const* kwlist[] = {"signals", "LFFT", "signalsF", "prevSignals", "offset", NULL};
+	if(!PyArg_ParseTupleAndKeywords(args, kwds, "O|iOOl", const_cast<char **>(kwlist), &signals, &nChan, &signalsF, &prevSignals, &offset)) {
 		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
 		goto fail;
 	}
 	
-	// Bring the data into C and make it usable
-	data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, NPY_COMPLEX64, 2, 2);
+	// Bring the data into C and make it usable.  Packed 4+4-bit samples are
+	// kept as they are and unpacked as part of the FFT.
+	if( PyArray_Check(signals) && PyArray_TYPE((PyArrayObject *) signals) == NPY_UINT8 ) {
+		inType = NPY_UINT8;
+	}
+	data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, inType, 2, 2);
 	if( data == NULL ) {
-		PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 2-D complex64");
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 2-D %s", inType == NPY_UINT8 ? "uint8" : "complex64");
 		goto fail;
 	}
+	if( prevSignals != NULL && prevSignals != Py_None ) {
+		dataP = (PyArrayObject *) PyArray_ContiguousFromObject(prevSignals, inType, 2, 2);
+		if( dataP == NULL ) {
+			PyErr_Format(PyExc_RuntimeError, "Cannot cast input prevSignals array to 2-D %s", inType == NPY_UINT8 ? "uint8" : "complex64");
+			goto fail;
+		}
+		if(PyArray_DIM(dataP, 0) != PyArray_DIM(data, 0)) {
+			PyErr_Format(PyExc_RuntimeError, "prevSignals has an unexpected number of stands");
+			goto fail;
+		}
+	}
 	
 	// Get the properties of the data
 	nStand = (long) PyArray_DIM(data, 0);
 	nSamps = (long) PyArray_DIM(data, 1);
+	nPrev = 0;
+	if( dataP != NULL ) {
+		nPrev = (long) PyArray_DIM(dataP, 1);
+	}
 	
-	// Find out how large the output array needs to be and initialize it
-	nFFT = nSamps / nChan;
+	// Find out how large the output array needs to be and initialize it.  If 
+	// there is previous data the number of FFT windows is the same as for
+	// signals alone.  Otherwise, the offset shortens the data.
+	if( dataP != NULL ) {
+		nFFT = nSamps / nChan;
+	} else {
+		nFFT = (nSamps - offset) / nChan;
+	}
+	if( offset < 0 || offset + nFFT*nChan > nPrev + nSamps ) {
+		PyErr_Format(PyExc_ValueError, "Invalid sample offset: %ld", offset);
+		goto fail;
+	}
 	npy_intp dims[3];
 	dims[0] = (npy_intp) nStand;
 	dims[1] = (npy_intp) nChan;
-	dims[2] = (npy_intp) (nSamps/nChan);
+	dims[2] = (npy_intp) nFFT;
 	if( signalsF != NULL && signalsF != Py_None ) {
 		dataF = (PyArrayObject *) PyArray_ContiguousFromObject(signalsF, NPY_COMPLEX64, 3, 3);
 		if(dataF == NULL) {
@@ -166,11 +224,14 @@ PyObject *PulsarEngineRaw(PyObject *self, PyObject *args, PyObject *kwds) {
         pulsar_engine<IterType>(nStand, nSamps, nFFT, nChan, \
                                 (IterType const*) PyArray_DATA(data), \
 																NULL, \
-                                (Complex32*) PyArray_DATA(dataF))
+                                (Complex32*) PyArray_DATA(dataF), \
+                                dataP != NULL ? (IterType const*) PyArray_DATA(dataP) : NULL, \
+                                nPrev, offset)
     
     switch( PyArray_TYPE(data) ){
-        case( NPY_INT8       ): LAUNCH_PULSAR_ENGINE(int8_t); break;
-        case( NPY_COMPLEX64  ): LAUNCH_PULSAR_ENGINE(float);  break;
+        case( NPY_INT8       ): LAUNCH_PULSAR_ENGINE(int8_t);  break;
+        case( NPY_UINT8      ): LAUNCH_PULSAR_ENGINE(uint8_t); break;
+        case( NPY_COMPLEX64  ): LAUNCH_PULSAR_ENGINE(float);   break;
         default: PyErr_Format(PyExc_RuntimeError, "Unsupport input data type"); goto fail;
     }
     
@@ -180,12 +241,14 @@ PyObject *PulsarEngineRaw(PyObject *self, PyObject *args, PyObject *kwds) {
 	
 	Py_XDECREF(data);
 	Py_XDECREF(dataF);
+	Py_XDECREF(dataP);
 	
 	return signalsF;
 	
 fail:
     Py_XDECREF(data);
     Py_XDECREF(dataF);
+    Py_XDECREF(dataP);
     
     return NULL;
 }
@@ -195,10 +258,21 @@ char PulsarEngineRaw_doc[] = PyDoc_STR(\
 integration data with linear polarization\n\
 \n\
 Input arguments are:\n\
- * signals: 2-D numpy.complex64 (stands by samples) array of data to FFT\n\
+ * signals: 2-D numpy.complex64 (stands by samples) array of data to FFT or\n\
+            2-D numpy.uint8 array of packed 4+4-bit DRX samples\n\
 \n\
 Input keywords are:\n\
  * LFFT: number of FFT channels to make (default=64)\n\
+ * signalsF: 3-D numpy.complex64 array to store the output in (default=None)\n\
+ * prevSignals: 2-D array of the same type as signals (stands by samples)\n\
+                of the data that immediately precedes signals\n\
+                (default=None)\n\
+ * offset: sample offset into prevSignals followed by signals at which to\n\
+           start the first FFT window (default=0)\n\
+\n\
+This makes it possible to shift the data by a fractional number of frames\n\
+without copying it:  with prevSignals, the number of FFT windows is the same\n\
+as for signals alone.\n\
 \n\
 Outputs:\n\
  * sub-integration: 2-D numpy.complex64 (stands by channels) of FFT'd data\n\
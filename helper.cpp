@@ -1,5 +1,6 @@
 #include "Python.h"
 #include <cmath>
+#include <cstring>
 
 #ifdef _OPENMP
 	#include <omp.h>
@@ -751,6 +752,651 @@ Outputs:\n\
 ");
 
 
+static PyObject *FastIncoherentDedispersion(PyObject *self, PyObject *args, PyObject *kwds) {
+	PyObject *spectra, *flags, *shifts, *bandpass, *spectraF;
+	PyArrayObject *data=NULL, *dataM=NULL, *dataS=NULL, *dataB=NULL;
+	PyArrayObject *dataD=NULL, *dataBD=NULL, *prof=NULL, *profB=NULL;
+	
+	long i, j, k, l, ij, nSamps, nPol, nChans, nValid, nFill;
+	
+	char const* kwlist[] = {"spectra", "mask", "delays", "bandpass", NULL};
+	if(!PyArg_ParseTupleAndKeywords(args, kwds, "OOOO", const_cast<char **>(kwlist), &spectra, &flags, &shifts, &bandpass)) {
+		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
+		return NULL;
+	}
+	
+	// Bring the data into C and make it usable
+	data = (PyArrayObject *) PyArray_ContiguousFromObject(spectra, NPY_FLOAT32, 3, 3);
+	dataM = (PyArrayObject *) PyArray_ContiguousFromObject(flags, NPY_BOOL, 3, 3);
+	dataS = (PyArrayObject *) PyArray_ContiguousFromObject(shifts, NPY_INT32, 1, 1);
+	dataB = (PyArrayObject *) PyArray_ContiguousFromObject(bandpass, NPY_FLOAT32, 2, 2);
+	if( data == NULL || dataM == NULL || dataS == NULL || dataB == NULL ) {
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input arrays to 3-D float32 spectra, 3-D bool mask, 1-D int32 delays, and 2-D float32 bandpass");
+		Py_XDECREF(data);
+		Py_XDECREF(dataM);
+		Py_XDECREF(dataS);
+		Py_XDECREF(dataB);
+		return NULL;
+	}
+	
+	// Get the properties of the data
+	nSamps = (long) PyArray_DIM(data, 0);
+	nPol = (long) PyArray_DIM(data, 1);
+	nChans = (long) PyArray_DIM(data, 2);
+	if( !PyArray_SAMESHAPE(data, dataM) \
+	    || (long) PyArray_DIM(dataS, 0) != nChans \
+	    || (long) PyArray_DIM(dataB, 0) != nPol || (long) PyArray_DIM(dataB, 1) != nChans ) {
+		PyErr_Format(PyExc_ValueError, "Input mask, delays, and bandpass do not match the spectra");
+		Py_XDECREF(data);
+		Py_XDECREF(dataM);
+		Py_XDECREF(dataS);
+		Py_XDECREF(dataB);
+		return NULL;
+	}
+	
+	// Create the output arrays
+	npy_intp dims[3];
+	dims[0] = (npy_intp) nSamps;
+	dims[1] = (npy_intp) nPol;
+	dims[2] = (npy_intp) nChans;
+	dataD = (PyArrayObject*) PyArray_ZEROS(3, dims, NPY_FLOAT32, 0);
+	dataBD = (PyArrayObject*) PyArray_ZEROS(3, dims, NPY_FLOAT32, 0);
+	prof = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
+	profB = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
+	if( dataD == NULL || dataBD == NULL || prof == NULL || profB == NULL ) {
+		PyErr_Format(PyExc_MemoryError, "Cannot create output arrays");
+		Py_XDECREF(data);
+		Py_XDECREF(dataM);
+		Py_XDECREF(dataS);
+		Py_XDECREF(dataB);
+		Py_XDECREF(dataD);
+		Py_XDECREF(dataBD);
+		Py_XDECREF(prof);
+		Py_XDECREF(profB);
+		return NULL;
+	}
+	
+	// Pointers
+	float *a, *b, *c, *e, *p, *q;
+	npy_bool *m;
+	int *d;
+	double tempV, tempB;
+	a = (float *) PyArray_DATA(data);
+	m = (npy_bool *) PyArray_DATA(dataM);
+	d = (int *) PyArray_DATA(dataS);
+	b = (float *) PyArray_DATA(dataB);
+	c = (float *) PyArray_DATA(dataD);
+	e = (float *) PyArray_DATA(dataBD);
+	p = (float *) PyArray_DATA(prof);
+	q = (float *) PyArray_DATA(profB);
+	
+	Py_BEGIN_ALLOW_THREADS
+	
+	#ifdef _OPENMP
+		#pragma omp parallel default(shared) private(i, j, k, l, tempV, tempB, nValid, nFill)
+	#endif
+	{
+		#ifdef _OPENMP
+			#pragma omp for schedule(OMP_SCHEDULER)
+		#endif
+		for(ij=0; ij<nSamps*nPol; ij++) {
+			i = ij / nPol;
+			j = ij % nPol;
+			
+			tempV = 0.0;
+			tempB = 0.0;
+			nValid = 0;
+			nFill = 0;
+			for(k=0; k<nChans; k++) {
+				l = i + *(d + k);
+				if( l < 0 || l >= nSamps ) {
+					// Past the end of the data
+					*(c + nPol*nChans*i + nChans*j + k) = NAN;
+					*(e + nPol*nChans*i + nChans*j + k) = NAN;
+					nFill++;
+				} else if( *(m + nPol*nChans*l + nChans*j + k) ) {
+					// Masked
+					*(c + nPol*nChans*i + nChans*j + k) = NAN;
+					*(e + nPol*nChans*i + nChans*j + k) = NAN;
+				} else {
+					*(c + nPol*nChans*i + nChans*j + k) = *(a + nPol*nChans*l + nChans*j + k);
+					*(e + nPol*nChans*i + nChans*j + k) = *(a + nPol*nChans*l + nChans*j + k) / *(b + nChans*j + k);
+					tempV += *(c + nPol*nChans*i + nChans*j + k);
+					tempB += *(e + nPol*nChans*i + nChans*j + k);
+					nValid++;
+				}
+			}
+			
+			if( nFill > 0 || nValid == 0 ) {
+				*(p + nPol*i + j) = NAN;
+				*(q + nPol*i + j) = NAN;
+			} else {
+				*(p + nPol*i + j) = (float) tempV;
+				*(q + nPol*i + j) = (float) tempB;
+			}
+		}
+	}
+	
+	Py_END_ALLOW_THREADS
+	
+	Py_XDECREF(data);
+	Py_XDECREF(dataM);
+	Py_XDECREF(dataS);
+	Py_XDECREF(dataB);
+	
+	spectraF = Py_BuildValue("OOOO", PyArray_Return(dataD), PyArray_Return(dataBD), PyArray_Return(prof), PyArray_Return(profB));
+	Py_XDECREF(dataD);
+	Py_XDECREF(dataBD);
+	Py_XDECREF(prof);
+	Py_XDECREF(profB);
+	
+	return spectraF;
+}
+
+PyDoc_STRVAR(FastIncoherentDedispersion_doc, \
+"Given a 3-D numpy.float32 array of spectra, a matching mask, the dispersion\n\
+delays, and a bandpass, incoherently dedisperse both the raw and the bandpass-\n\
+corrected spectra and compute their dedispersed profiles.\n\
+\n\
+Input arguments are:\n\
+ * spectra: 3-D numpy.float32 (time by polarizations by channels) array of data\n\
+ * mask: 3-D numpy.bool (time by polarizations by channels) array of flags\n\
+ * delays: 1-D numpy.int32 array of the delay for each channel in samples\n\
+ * bandpass: 2-D numpy.float32 (polarizations by channels) array of bandpass\n\
+             shapes\n\
+\n\
+Input keywords are:\n\
+ None\n\
+\n\
+Outputs:\n\
+ * dedispersed: 3-D numpy.float32 (time by polarizations by channels) of\n\
+                dedispersed spectra\n\
+ * dedispersedBandpass: 3-D numpy.float32 (time by polarizations by channels)\n\
+                        of dedispersed, bandpass-corrected spectra\n\
+ * profile: 2-D numpy.float32 (time by polarizations) of the dedispersed\n\
+            spectra summed over channels\n\
+ * profileBandpass: 2-D numpy.float32 (time by polarizations) of the\n\
+                    dedispersed, bandpass-corrected spectra summed over channels\n\
+\n\
+.. note::\n\
+\tMasked samples and samples that are shifted past the end of the data are\n\
+\tset to NaN.  The profile is NaN for any time that is missing data in\n\
+\tat least one channel or that has no unmasked channels.\n\
+");
+
+
+static inline long DensityCell(double value, double start, double stop, double scale, long n) {
+	/*
+	 * DensityCell - Return the cell along one axis of a density grid that a
+	 * value falls into, or -1 if it is outside of the grid.
+	 */
+	long cell;
+	
+	if( !(value >= start && value <= stop) ) {
+		return -1;
+	}
+	cell = (long) ((value - start) * scale);
+	if( cell >= n ) {
+		cell = n - 1;
+	}
+	return cell;
+}
+
+
+static PyObject *FastDensityPyramid(PyObject *self, PyObject *args, PyObject *kwds) {
+	PyObject *pulsesT, *pulsesD, *pulsesS, *levels, *level;
+	PyArrayObject *dataT=NULL, *dataD=NULL, *dataS=NULL;
+	PyArrayObject **counts=NULL, **peaks=NULL;
+	
+	long i, j, k, l, nSamps, nTime, nDM, nLevels;
+	double tStart, tStop, dmStart, dmStop;
+	nLevels = 1;
+	
+	char const* kwlist[] = {"time", "dm", "snr", "timeRange", "dmRange", "nTime", "nDM", "nLevels", NULL};
+	if(!PyArg_ParseTupleAndKeywords(args, kwds, "OOO(dd)(dd)ll|l", const_cast<char **>(kwlist), &pulsesT, &pulsesD, &pulsesS, &tStart, &tStop, &dmStart, &dmStop, &nTime, &nDM, &nLevels)) {
+		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
+		return NULL;
+	}
+	if( nLevels < 1 || nLevels > 30 || nTime < 1 || nDM < 1 \
+	    || nTime % (1L << (nLevels-1)) != 0 || nDM % (1L << (nLevels-1)) != 0 ) {
+		PyErr_Format(PyExc_ValueError, "Grid dimensions must be positive and divisible by 2**(nLevels-1)");
+		return NULL;
+	}
+	if( !(tStop > tStart) || !(dmStop > dmStart) ) {
+		PyErr_Format(PyExc_ValueError, "Invalid time or DM range");
+		return NULL;
+	}
+	
+	// Bring the data into C and make it usable
+	dataT = (PyArrayObject *) PyArray_ContiguousFromObject(pulsesT, NPY_FLOAT32, 1, 1);
+	dataD = (PyArrayObject *) PyArray_ContiguousFromObject(pulsesD, NPY_FLOAT32, 1, 1);
+	dataS = (PyArrayObject *) PyArray_ContiguousFromObject(pulsesS, NPY_FLOAT32, 1, 1);
+	if( dataT == NULL || dataD == NULL || dataS == NULL ) {
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input time, DM, and S/N arrays to 1-D float32");
+		Py_XDECREF(dataT);
+		Py_XDECREF(dataD);
+		Py_XDECREF(dataS);
+		return NULL;
+	}
+	
+	// Get the properties of the data
+	nSamps = (long) PyArray_DIM(dataT, 0);
+	if( (long) PyArray_DIM(dataD, 0) != nSamps || (long) PyArray_DIM(dataS, 0) != nSamps ) {
+		PyErr_Format(PyExc_ValueError, "Input time, DM, and S/N arrays must be the same length");
+		Py_XDECREF(dataT);
+		Py_XDECREF(dataD);
+		Py_XDECREF(dataS);
+		return NULL;
+	}
+	
+	// Create the output arrays, one count and one peak S/N array per level
+	counts = (PyArrayObject **) calloc(nLevels, sizeof(PyArrayObject *));
+	peaks = (PyArrayObject **) calloc(nLevels, sizeof(PyArrayObject *));
+	npy_intp dims[2];
+	for(l=0; l<nLevels; l++) {
+		dims[0] = (npy_intp) (nDM >> l);
+		dims[1] = (npy_intp) (nTime >> l);
+		counts[l] = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_INT32, 0);
+		peaks[l] = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
+		if( counts[l] == NULL || peaks[l] == NULL ) {
+			PyErr_Format(PyExc_MemoryError, "Cannot create output arrays");
+			for(k=0; k<=l; k++) {
+				Py_XDECREF(counts[k]);
+				Py_XDECREF(peaks[k]);
+			}
+			free(counts);
+			free(peaks);
+			Py_XDECREF(dataT);
+			Py_XDECREF(dataD);
+			Py_XDECREF(dataS);
+			return NULL;
+		}
+	}
+	
+	// Pointers
+	float *a, *b, *s, *p, *q;
+	int *c, *e;
+	a = (float *) PyArray_DATA(dataT);
+	b = (float *) PyArray_DATA(dataD);
+	s = (float *) PyArray_DATA(dataS);
+	
+	Py_BEGIN_ALLOW_THREADS
+	
+	double tScale, dmScale;
+	tScale = nTime / (tStop - tStart);
+	dmScale = nDM / (dmStop - dmStart);
+	
+	// Empty cells have a peak S/N of NaN
+	c = (int *) PyArray_DATA(counts[0]);
+	p = (float *) PyArray_DATA(peaks[0]);
+	for(j=0; j<nDM*nTime; j++) {
+		*(p + j) = NAN;
+	}
+	
+	// Divide up the work so that each thread has its own set of time cells.
+	// This only works if the pulses are sorted in time.
+	long nThreads, *bounds;
+	#ifdef _OPENMP
+		nThreads = omp_get_max_threads();
+	#else
+		nThreads = 1;
+	#endif
+	for(i=1; i<nSamps; i++) {
+		if( *(a + i) < *(a + i - 1) ) {
+			nThreads = 1;
+			break;
+		}
+	}
+	
+	bounds = (long *) malloc((nThreads+1)*sizeof(long));
+	*(bounds + 0) = 0;
+	for(k=1; k<nThreads; k++) {
+		i = k*nSamps / nThreads;
+		if( i < *(bounds + k - 1) ) {
+			i = *(bounds + k - 1);
+		}
+		while( i > 0 && i < nSamps \
+		       && DensityCell(*(a + i), tStart, tStop, tScale, nTime) == DensityCell(*(a + i - 1), tStart, tStop, tScale, nTime) ) {
+			i++;
+		}
+		*(bounds + k) = i;
+	}
+	*(bounds + nThreads) = nSamps;
+	
+	#ifdef _OPENMP
+		#pragma omp parallel default(shared) private(i, j, k, l)
+	#endif
+	{
+		#ifdef _OPENMP
+			#pragma omp for schedule(OMP_SCHEDULER)
+		#endif
+		for(k=0; k<nThreads; k++) {
+			for(i=*(bounds + k); i<*(bounds + k + 1); i++) {
+				j = DensityCell(*(a + i), tStart, tStop, tScale, nTime);
+				l = DensityCell(*(b + i), dmStart, dmStop, dmScale, nDM);
+				if( j < 0 || l < 0 ) {
+					continue;
+				}
+				
+				*(c + nTime*l + j) += 1;
+				if( *(s + i) == *(s + i) && !(*(p + nTime*l + j) >= *(s + i)) ) {
+					*(p + nTime*l + j) = *(s + i);
+				}
+			}
+		}
+	}
+	
+	free(bounds);
+	
+	// Build the coarser levels by combining 2x2 sets of cells
+	long nT0, nT1, nD1;
+	for(k=1; k<nLevels; k++) {
+		nT0 = nTime >> (k-1);
+		nT1 = nTime >> k;
+		nD1 = nDM >> k;
+		c = (int *) PyArray_DATA(counts[k-1]);
+		e = (int *) PyArray_DATA(counts[k]);
+		p = (float *) PyArray_DATA(peaks[k-1]);
+		q = (float *) PyArray_DATA(peaks[k]);
+		
+		#ifdef _OPENMP
+			#pragma omp parallel default(shared) private(i, j)
+		#endif
+		{
+			#ifdef _OPENMP
+				#pragma omp for schedule(OMP_SCHEDULER)
+			#endif
+			for(j=0; j<nD1; j++) {
+				for(i=0; i<nT1; i++) {
+					*(e + nT1*j + i) = *(c + nT0*(2*j) + 2*i) + *(c + nT0*(2*j) + 2*i + 1) \
+					                   + *(c + nT0*(2*j+1) + 2*i) + *(c + nT0*(2*j+1) + 2*i + 1);
+					*(q + nT1*j + i) = fmaxf(fmaxf(*(p + nT0*(2*j) + 2*i), *(p + nT0*(2*j) + 2*i + 1)), \
+					                         fmaxf(*(p + nT0*(2*j+1) + 2*i), *(p + nT0*(2*j+1) + 2*i + 1)));
+				}
+			}
+		}
+	}
+	
+	Py_END_ALLOW_THREADS
+	
+	Py_XDECREF(dataT);
+	Py_XDECREF(dataD);
+	Py_XDECREF(dataS);
+	
+	levels = PyList_New(nLevels);
+	for(l=0; l<nLevels; l++) {
+		level = Py_BuildValue("OO", PyArray_Return(counts[l]), PyArray_Return(peaks[l]));
+		PyList_SetItem(levels, l, level);
+		Py_XDECREF(counts[l]);
+		Py_XDECREF(peaks[l]);
+	}
+	free(counts);
+	free(peaks);
+	
+	return levels;
+}
+
+PyDoc_STRVAR(FastDensityPyramid_doc, \
+"Given 1-D numpy.float32 arrays of pulse times, DMs, and S/Ns, build a\n\
+multi-resolution density grid of the pulses in time and DM.\n\
+\n\
+Input arguments are:\n\
+ * time: 1-D numpy.float32 array of pulse times, ideally sorted\n\
+ * dm: 1-D numpy.float32 array of pulse DMs\n\
+ * snr: 1-D numpy.float32 array of pulse S/Ns\n\
+ * timeRange: two-element tuple of the time range covered by the grid\n\
+ * dmRange: two-element tuple of the DM range covered by the grid\n\
+ * nTime: number of time cells in the finest level\n\
+ * nDM: number of DM cells in the finest level\n\
+\n\
+Input keywords are:\n\
+ * nLevels: number of levels to build, each half the size of the previous\n\
+            one along both axes (default = 1)\n\
+\n\
+Outputs:\n\
+ * levels: list of two-element tuples, one per level, of 2-D numpy.int32\n\
+           (DM by time) pulse counts and 2-D numpy.float32 (DM by time)\n\
+           peak S/Ns.  Empty cells have a peak S/N of NaN.\n\
+\n\
+.. note::\n\
+\tThe pulses are only binned in parallel if the times are sorted in\n\
+\tascending order.\n\
+");
+
+
+static inline long FDMTMaxDelay(long nDelays, double fStart, double fStop, double norm) {
+	/*
+	 * FDMTMaxDelay - Return the largest delay, in samples, across the band
+	 * from fStart to fStop for the FDMT given the number of delays across the
+	 * full band and the full band normalization.
+	 */
+	long d;
+	
+	d = (long) ceil((nDelays - 1) * (1.0/(fStart*fStart) - 1.0/(fStop*fStop)) / norm);
+	if( d > nDelays - 1 ) {
+		d = nDelays - 1;
+	}
+	return d;
+}
+
+
+static PyObject *FastFDMT(PyObject *self, PyObject *args, PyObject *kwds) {
+	PyObject *spectra, *spectraF;
+	PyArrayObject *data=NULL, *dataF=NULL;
+	
+	long i, j, k, ij, n, nChans, nSamps, nDelays, nIter;
+	double fMin, fMax;
+	
+	char const* kwlist[] = {"waterfall", "freqRange", "nDelays", NULL};
+	if(!PyArg_ParseTupleAndKeywords(args, kwds, "O(dd)l", const_cast<char **>(kwlist), &spectra, &fMin, &fMax, &nDelays)) {
+		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
+		return NULL;
+	}
+	if( !(fMin > 0) || !(fMax > fMin) ) {
+		PyErr_Format(PyExc_ValueError, "Invalid frequency range");
+		return NULL;
+	}
+	if( nDelays < 1 ) {
+		PyErr_Format(PyExc_ValueError, "The number of delays must be positive");
+		return NULL;
+	}
+	
+	// Bring the data into C and make it usable
+	data = (PyArrayObject *) PyArray_ContiguousFromObject(spectra, NPY_FLOAT32, 2, 2);
+	if( data == NULL ) {
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input waterfall array to 2-D float32");
+		return NULL;
+	}
+	
+	// Get the properties of the data
+	nChans = (long) PyArray_DIM(data, 0);
+	nSamps = (long) PyArray_DIM(data, 1);
+	if( nChans < 1 || (nChans & (nChans - 1)) != 0 ) {
+		PyErr_Format(PyExc_ValueError, "The number of channels must be a power of two");
+		Py_XDECREF(data);
+		return NULL;
+	}
+	
+	// Find out how large the output array needs to be and initialize it
+	npy_intp dims[2];
+	dims[0] = (npy_intp) nDelays;
+	dims[1] = (npy_intp) nSamps;
+	dataF = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
+	if(dataF == NULL) {
+		PyErr_Format(PyExc_MemoryError, "Cannot create output array");
+		Py_XDECREF(data);
+		return NULL;
+	}
+	
+	// Work out the number of iterations and the largest state needed
+	double dF, norm;
+	long nF, nDT, nDTIn, stateSize;
+	dF = (fMax - fMin) / nChans;
+	norm = 1.0/(fMin*fMin) - 1.0/(fMax*fMax);
+	
+	nIter = 0;
+	while( (1L << nIter) < nChans ) {
+		nIter++;
+	}
+	
+	stateSize = 1;
+	for(n=0; n<=nIter; n++) {
+		nF = nChans >> n;
+		nDT = FDMTMaxDelay(nDelays, fMin, fMin + (1L << n)*dF, norm) + 1;
+		if( nF*nDT*nSamps > stateSize ) {
+			stateSize = nF*nDT*nSamps;
+		}
+	}
+	
+	// Temporary storage for the state of the transform
+	float *state, *next, *swap;
+	state = (float *) malloc(stateSize*sizeof(float));
+	next = (float *) malloc(stateSize*sizeof(float));
+	if( state == NULL || next == NULL ) {
+		PyErr_Format(PyExc_MemoryError, "Cannot create temporary arrays");
+		free(state);
+		free(next);
+		Py_XDECREF(data);
+		Py_XDECREF(dataF);
+		return NULL;
+	}
+	
+	// Pointers
+	float *a, *b, *in0, *in1, *out;
+	a = (float *) PyArray_DATA(data);
+	b = (float *) PyArray_DATA(dataF);
+	
+	Py_BEGIN_ALLOW_THREADS
+	
+	// Initialization - partial sums over the delays within each channel
+	nDT = FDMTMaxDelay(nDelays, fMin, fMin + dF, norm) + 1;
+	memset(state, 0, nChans*nDT*nSamps*sizeof(float));
+	
+	#ifdef _OPENMP
+		#pragma omp parallel default(shared) private(i, j, k)
+	#endif
+	{
+		#ifdef _OPENMP
+			#pragma omp for schedule(OMP_SCHEDULER)
+		#endif
+		for(i=0; i<nChans; i++) {
+			for(k=0; k<nSamps; k++) {
+				*(state + nDT*nSamps*i + k) = *(a + nSamps*i + k);
+			}
+			for(j=1; j<nDT; j++) {
+				for(k=j; k<nSamps; k++) {
+					*(state + nDT*nSamps*i + nSamps*j + k) = *(state + nDT*nSamps*i + nSamps*(j-1) + k) \
+					                                         + *(a + nSamps*i + k - j);
+				}
+			}
+		}
+	}
+	
+	// Iterations - combine pairs of adjacent sub-bands
+	double fStart, fEnd, fMiddle, fMiddleLarger;
+	long dTMiddle, dTMiddleLarger, dTRest;
+	for(n=1; n<=nIter; n++) {
+		nDTIn = nDT;
+		nF = nChans >> n;
+		nDT = FDMTMaxDelay(nDelays, fMin, fMin + (1L << n)*dF, norm) + 1;
+		memset(next, 0, nF*nDT*nSamps*sizeof(float));
+		
+		#ifdef _OPENMP
+			#pragma omp parallel default(shared) private(i, j, k, fStart, fEnd, fMiddle, fMiddleLarger, dTMiddle, dTMiddleLarger, dTRest, in0, in1, out)
+		#endif
+		{
+			#ifdef _OPENMP
+				#pragma omp for schedule(OMP_SCHEDULER)
+			#endif
+			for(ij=0; ij<nF*nDT; ij++) {
+				i = ij / nDT;
+				j = ij % nDT;
+				
+				fStart = (fMax - fMin) / nF * i + fMin;
+				fEnd = (fMax - fMin) / nF * (i+1) + fMin;
+				if( j > FDMTMaxDelay(nDelays, fStart, fEnd, norm) ) {
+					continue;
+				}
+				fMiddle = (fEnd - fStart) / 2.0 + fStart - dF / 2.0;
+				fMiddleLarger = (fEnd - fStart) / 2.0 + fStart + dF / 2.0;
+				
+				// Delays within the lower sub-band and across the upper one
+				dTMiddle = (long) nearbyint(j * (1.0/(fMiddle*fMiddle) - 1.0/(fStart*fStart)) \
+				                            / (1.0/(fEnd*fEnd) - 1.0/(fStart*fStart)));
+				dTMiddleLarger = (long) nearbyint(j * (1.0/(fMiddleLarger*fMiddleLarger) - 1.0/(fStart*fStart)) \
+				                                  / (1.0/(fEnd*fEnd) - 1.0/(fStart*fStart)));
+				dTRest = j - dTMiddleLarger;
+				if( dTMiddle >= nDTIn ) {
+					dTMiddle = nDTIn - 1;
+				}
+				if( dTRest < 0 ) {
+					dTRest = 0;
+				} else if( dTRest >= nDTIn ) {
+					dTRest = nDTIn - 1;
+				}
+				
+				in0 = state + nDTIn*nSamps*(2*i) + nSamps*dTMiddle;
+				in1 = state + nDTIn*nSamps*(2*i+1) + nSamps*dTRest;
+				out = next + nDT*nSamps*i + nSamps*j;
+				for(k=0; k<dTMiddleLarger && k<nSamps; k++) {
+					*(out + k) = *(in0 + k);
+				}
+				for(k=dTMiddleLarger; k<nSamps; k++) {
+					*(out + k) = *(in0 + k) + *(in1 + k - dTMiddleLarger);
+				}
+			}
+		}
+		
+		swap = state;
+		state = next;
+		next = swap;
+	}
+	
+	// Save
+	for(j=0; j<nDT && j<nDelays; j++) {
+		memcpy(b + nSamps*j, state + nSamps*j, nSamps*sizeof(float));
+	}
+	
+	Py_END_ALLOW_THREADS
+	
+	free(state);
+	free(next);
+	
+	Py_XDECREF(data);
+	
+	spectraF = Py_BuildValue("O", PyArray_Return(dataF));
+	Py_XDECREF(dataF);
+	
+	return spectraF;
+}
+
+PyDoc_STRVAR(FastFDMT_doc, \
+"Given a 2-D numpy.float32 array of spectra, compute the DM-time plane using\n\
+the fast dispersion measure transform (FDMT) of Zackay & Ofek (2017, ApJ, 835,\n\
+11).\n\
+\n\
+Input arguments are:\n\
+ * waterfall: 2-D numpy.float32 (channels by time) array of data with the\n\
+              channels in order of increasing frequency.  The number of\n\
+              channels must be a power of two.\n\
+ * freqRange: two-element tuple of the lower edge of the first channel and\n\
+              the upper edge of the last channel\n\
+ * nDelays: number of dispersion delays across the band to compute, starting\n\
+            at zero and in steps of one sample\n\
+\n\
+Input keywords are:\n\
+ None\n\
+\n\
+Outputs:\n\
+ * plane: 2-D numpy.float32 (delay by time) of the dedispersed time series.\n\
+          Time is the arrival time at the bottom of the band.\n\
+\n\
+.. note::\n\
+\tThe cost scales as log2 of the number of channels rather than with the\n\
+\tnumber of channels for each of the delays.\n\
+");
+
+
 /*
   Module Setup - Function Definitions and Documentation
 */
@@ -763,6 +1409,9 @@ static PyMethodDef helper_methods[] = {
 	{"FastAxis0Bandpass",          (PyCFunction) FastAxis0Bandpass,          METH_VARARGS,               FastAxis0Bandpass_doc}, 
 	{"FastAxis0Median",            (PyCFunction) FastAxis0Median,            METH_VARARGS,               FastAxis0Median_doc}, 
 	{"FastAxis1Percentiles5And99", (PyCFunction) FastAxis1Percentiles5And99, METH_VARARGS|METH_KEYWORDS, FastAxis1Percentiles5And99_doc},
+	{"FastIncoherentDedispersion", (PyCFunction) FastIncoherentDedispersion, METH_VARARGS|METH_KEYWORDS, FastIncoherentDedispersion_doc},
+	{"FastDensityPyramid",         (PyCFunction) FastDensityPyramid,         METH_VARARGS|METH_KEYWORDS, FastDensityPyramid_doc},
+	{"FastFDMT",                   (PyCFunction) FastFDMT,                   METH_VARARGS|METH_KEYWORDS, FastFDMT_doc},
 	{NULL,                         NULL,                                     0,                          NULL}
 };
 
@@ -793,6 +1442,9 @@ static int helper_exec(PyObject *module) {
 		PyList_Append(all, PyUnicode_FromString("FastAxis0Bandpass"));
 		PyList_Append(all, PyUnicode_FromString("FastAxis0Median"));
 		PyList_Append(all, PyUnicode_FromString("FastAxis1Percentiles5And99"));
+		PyList_Append(all, PyUnicode_FromString("FastIncoherentDedispersion"));
+		PyList_Append(all, PyUnicode_FromString("FastDensityPyramid"));
+		PyList_Append(all, PyUnicode_FromString("FastFDMT"));
 		PyModule_AddObject(module, "__all__", all);
 		return 0;
 }
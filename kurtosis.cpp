@@ -20,11 +20,32 @@
 #include "psr.hpp"
 
 
+/*
+  Spectral kurtosis moment accumulation for a single stand/channel of the 
+  output of PulsarEngineRaw.  The sums of the power (S1) and the squared
+  power (S2) are accumulated over nFFT windows.
+*/
+
+template<typename AccType>
+inline void compute_sk_moments(const Complex32 *a, long nFFT, AccType *s1, AccType *s2) {
+	long k;
+	AccType tempV;
+	
+	*s1 = 0.0;
+	*s2 = 0.0;
+	for(k=0; k<nFFT; k++) {
+		tempV  = abs2(*(a + k));
+		*s2 += tempV*tempV;
+		*s1 += tempV;
+	}
+}
+
+
 PyObject *ComputeSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
 	PyObject *signals, *signalsF;
 	PyArrayObject *data=NULL, *dataF=NULL;
 	double lower, upper;
-	long ij, i, j, k, nStand, nSamps, nChan, nFFT;
+	long ij, i, j, nStand, nSamps, nChan, nFFT;
 	
 	if(!PyArg_ParseTuple(args, "Odd", &signals, &lower, &upper)) {
 		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
@@ -65,7 +86,7 @@ PyObject *ComputeSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
 	b = (float *) PyArray_DATA(dataF);
 	
 	#ifdef _OPENMP
-		#pragma omp parallel default(shared) private(secStart, i, j, k, tempV, tempV2, temp2V)
+		#pragma omp parallel default(shared) private(secStart, i, j, tempV, tempV2, temp2V)
 	#endif
 	{
 		#ifdef _OPENMP
@@ -77,13 +98,7 @@ PyObject *ComputeSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
 			
 			secStart = nSamps*i + nFFT*j;
 			
-			tempV2 = 0.0;
-			temp2V = 0.0;
-			for(k=0; k<nFFT; k++) {
-				tempV  = abs2(*(a + secStart + k));
-				temp2V += tempV*tempV;
-				tempV2 += tempV;
-			}
+			compute_sk_moments(a + secStart, nFFT, &tempV2, &temp2V);
 			
 			tempV  = nFFT*temp2V / (tempV2*tempV2) - 1.0;
 			tempV *= (nFFT + 1.0)/(nFFT - 1.0);
@@ -121,53 +136,64 @@ Outputs:\n\
 ");
 
 
-PyObject *ComputePseudoSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
-	PyObject *signals, *signalsF;
+PyObject *ComputeSKMoments(PyObject *self, PyObject *args, PyObject *kwds) {
+	PyObject *signals, *signalsF=NULL;
 	PyArrayObject *data=NULL, *dataF=NULL;
-	double lower, upper;
-	long ij, i, j, k, nStand, nSamps, nChan, nFFT, skN;
+	long ij, i, j, nStand, nSamps, nChan, nFFT;
 	
-	if(!PyArg_ParseTuple(args, "Olldd", &signals, &nChan, &skN, &lower, &upper)) {
+	char const* kwlist[] = {"signals", "moments", NULL};
+	if(!PyArg_ParseTupleAndKeywords(args, kwds, "O|O", const_cast<char **>(kwlist), &signals, &signalsF)) {
 		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
-		return NULL;
+		goto fail;
 	}
 	
 	// Bring the data into C and make it usable
-	data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, NPY_DOUBLE, 2, 2);
+	data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, NPY_COMPLEX64, 3, 3);
 	if( data == NULL ) {
-		PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 2-D float64");
-		return NULL;
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 3-D complex64");
+		goto fail;
 	}
 	
 	// Get the properties of the data
 	nStand = (long) PyArray_DIM(data, 0);
-	nSamps  = (long) PyArray_DIM(data, 1);
-	nFFT = nSamps / nChan;
+	nChan  = (long) PyArray_DIM(data, 1);
+	nFFT   = (long) PyArray_DIM(data, 2);
 	
 	// Find out how large the output array needs to be and initialize it
-	npy_intp dims[2];
-	dims[0] = (npy_intp) nStand;
-	dims[1] = (npy_intp) nChan;
-	dataF = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
-	if(dataF == NULL) {
-		PyErr_Format(PyExc_MemoryError, "Cannot create output array");
-		Py_XDECREF(data);
-		return NULL;
+	nSamps = nChan*nFFT;
+	npy_intp dims[3];
+	dims[0] = (npy_intp) 2;
+	dims[1] = (npy_intp) nStand;
+	dims[2] = (npy_intp) nChan;
+	if( signalsF != NULL && signalsF != Py_None ) {
+		dataF = (PyArrayObject *) PyArray_ContiguousFromObject(signalsF, NPY_FLOAT32, 3, 3);
+		if(dataF == NULL) {
+			PyErr_Format(PyExc_RuntimeError, "Cannot cast output moments array to 3-D float32");
+			goto fail;
+		}
+		if(PyArray_DIM(dataF, 0) != dims[0] || PyArray_DIM(dataF, 1) != dims[1] || PyArray_DIM(dataF, 2) != dims[2]) {
+			PyErr_Format(PyExc_RuntimeError, "moments has an unexpected shape");
+			goto fail;
+		}
+	} else {
+		dataF = (PyArrayObject*) PyArray_EMPTY(3, dims, NPY_FLOAT32, 0);
+		if(dataF == NULL) {
+			PyErr_Format(PyExc_MemoryError, "Cannot create output array");
+			goto fail;
+		}
 	}
 	
 	Py_BEGIN_ALLOW_THREADS
 	
 	// Go!
-	long secStart;
-	double tempV, temp2V, tempV2;
-	double *a;
+	double tempV2, temp2V;
+	Complex32 *a;
 	float *b;
-	a = (double *) PyArray_DATA(data);
+	a = (Complex32 *) PyArray_DATA(data);
 	b = (float *) PyArray_DATA(dataF);
 	
 	#ifdef _OPENMP
-		omp_set_dynamic(0);
-		#pragma omp parallel default(shared) private(secStart, i, j, k, tempV, temp2V, tempV2)
+		#pragma omp parallel default(shared) private(i, j, tempV2, temp2V)
 	#endif
 	{
 		#ifdef _OPENMP
@@ -177,27 +203,184 @@ PyObject *ComputePseudoSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
 			i = ij / nChan;
 			j = ij % nChan;
 			
-			secStart = nSamps*i;
+			compute_sk_moments(a + nSamps*i + nFFT*j, nFFT, &tempV2, &temp2V);
 			
-			temp2V = 0.0;
-			tempV2 = 0.0;
-			for(k=0; k<nFFT; k++) {
-				tempV  = *(a + secStart + nChan*k + j);
+			*(b + nChan*i + j) = (float) tempV2;
+			*(b + nStand*nChan + nChan*i + j) = (float) temp2V;
+		}
+	}
+	
+	Py_END_ALLOW_THREADS
+	
+	signalsF = Py_BuildValue("O", PyArray_Return(dataF));
+	
+	Py_XDECREF(data);
+	Py_XDECREF(dataF);
+	
+	return signalsF;
+
+fail:
+	Py_XDECREF(data);
+	Py_XDECREF(dataF);
+	
+	return NULL;
+}
+
+char ComputeSKMoments_doc[] = PyDoc_STR(\
+"Given the output of PulsarEngineRaw, calculate the first two moments used\n\
+for spectral kurtosis, i.e., the sum of the power and the sum of the squared\n\
+power over all integrations\n\
+\n\
+Input arguments are:\n\
+ * signals: 3-D numpy.complex64 (stands by channels by integrations) array\n\
+   of data\n\
+\n\
+Input keywords are:\n\
+ * moments: a pre-existing 3-D numpy.float32 array to store the results in\n\
+   (default = None)\n\
+\n\
+Outputs:\n\
+ * moments: 3-D numpy.float32 (moment by stands by channels) of the sum of\n\
+   the power (moment 0) and the sum of the squared power (moment 1)\n\
+");
+
 
-				temp2V += tempV*tempV;
-				tempV2 += tempV;
+/*
+  Psuedo-spectral kurtosis moment accumulation for power data where the
+  sample for stand i, time k, and channel j is found at
+  a[sStand*i + sTime*k + j].  The sums are built up over blocks of channels so
+  that the data are walked through in memory order.
+*/
+
+#define SK_CHAN_BLOCK 64
+
+template<typename InType>
+void compute_pseudo_sk(const InType *a, long nStand, long nChan, long nFFT, long sStand, long sTime, double skN, double lower, double upper, float *b) {
+	long ij, i, j, jStart, jStop, k, nBlock;
+	double tempV, temp2V[SK_CHAN_BLOCK], tempV2[SK_CHAN_BLOCK];
+	const InType *row;
+	
+	nBlock = (nChan + SK_CHAN_BLOCK - 1) / SK_CHAN_BLOCK;
+	
+	#ifdef _OPENMP
+		omp_set_dynamic(0);
+		#pragma omp parallel default(shared) private(i, j, jStart, jStop, k, tempV, temp2V, tempV2, row)
+	#endif
+	{
+		#ifdef _OPENMP
+			#pragma omp for schedule(OMP_SCHEDULER)
+		#endif
+		for(ij=0; ij<nStand*nBlock; ij++) {
+			i = ij / nBlock;
+			jStart = (ij % nBlock) * SK_CHAN_BLOCK;
+			jStop = jStart + SK_CHAN_BLOCK;
+			if( jStop > nChan ) {
+				jStop = nChan;
 			}
 			
-			tempV  = nFFT*temp2V / (tempV2*tempV2) - 1.0;
-			tempV *= (nFFT*skN + 1.0)/(nFFT - 1.0);
+			for(j=0; j<jStop-jStart; j++) {
+				temp2V[j] = 0.0;
+				tempV2[j] = 0.0;
+			}
 			
-			if( tempV < lower || tempV > upper ) {
-				*(b + nChan*i + j) = 0.0;
-			} else {
-				*(b + nChan*i + j) = 1.0;
+			for(k=0; k<nFFT; k++) {
+				row = a + sStand*i + sTime*k + jStart;
+				for(j=0; j<jStop-jStart; j++) {
+					tempV = (double) *(row + j);
+					
+					temp2V[j] += tempV*tempV;
+					tempV2[j] += tempV;
+				}
+			}
+			
+			for(j=0; j<jStop-jStart; j++) {
+				tempV  = nFFT*temp2V[j] / (tempV2[j]*tempV2[j]) - 1.0;
+				tempV *= (nFFT*skN + 1.0)/(nFFT - 1.0);
+				
+				if( tempV < lower || tempV > upper ) {
+					*(b + nChan*i + jStart + j) = 0.0;
+				} else {
+					*(b + nChan*i + jStart + j) = 1.0;
+				}
 			}
 		}
 	}
+}
+
+
+PyObject *ComputePseudoSKMask(PyObject *self, PyObject *args, PyObject *kwds) {
+	PyObject *signals, *signalsF;
+	PyArrayObject *data=NULL, *dataF=NULL;
+	double lower, upper, skN;
+	long nStand, nChan, nFFT, sStand, sTime;
+	int nDim;
+	
+	if(!PyArg_ParseTuple(args, "Olddd", &signals, &nChan, &skN, &lower, &upper)) {
+		PyErr_Format(PyExc_RuntimeError, "Invalid parameters");
+		return NULL;
+	}
+	
+	// Bring the data into C and make it usable.  2-D data are kept as float64
+	// while 3-D data, i.e., decoded PSRFITS blocks, are worked on as float32
+	data = (PyArrayObject *) PyArray_FROM_O(signals);
+	if( data == NULL ) {
+		PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to a numpy array");
+		return NULL;
+	}
+	nDim = PyArray_NDIM(data);
+	Py_XDECREF(data);
+	
+	if( nDim == 3 ) {
+		data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, NPY_FLOAT32, 3, 3);
+		if( data == NULL ) {
+			PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 3-D float32");
+			return NULL;
+		}
+	} else {
+		data = (PyArrayObject *) PyArray_ContiguousFromObject(signals, NPY_DOUBLE, 2, 2);
+		if( data == NULL ) {
+			PyErr_Format(PyExc_RuntimeError, "Cannot cast input signals array to 2-D float64");
+			return NULL;
+		}
+	}
+	
+	// Get the properties of the data
+	if( nDim == 3 ) {
+		if( (long) PyArray_DIM(data, 2) != nChan ) {
+			PyErr_Format(PyExc_RuntimeError, "Channel count does not match the last dimension of the input signals array");
+			Py_XDECREF(data);
+			return NULL;
+		}
+		nFFT   = (long) PyArray_DIM(data, 0);
+		nStand = (long) PyArray_DIM(data, 1);
+		sStand = nChan;
+		sTime  = nStand*nChan;
+	} else {
+		nStand = (long) PyArray_DIM(data, 0);
+		nFFT   = (long) PyArray_DIM(data, 1) / nChan;
+		sStand = (long) PyArray_DIM(data, 1);
+		sTime  = nChan;
+	}
+	
+	// Find out how large the output array needs to be and initialize it
+	npy_intp dims[2];
+	dims[0] = (npy_intp) nStand;
+	dims[1] = (npy_intp) nChan;
+	dataF = (PyArrayObject*) PyArray_ZEROS(2, dims, NPY_FLOAT32, 0);
+	if(dataF == NULL) {
+		PyErr_Format(PyExc_MemoryError, "Cannot create output array");
+		Py_XDECREF(data);
+		return NULL;
+	}
+	
+	Py_BEGIN_ALLOW_THREADS
+	
+	// Go!
+	if( nDim == 3 ) {
+		compute_pseudo_sk((float *) PyArray_DATA(data), nStand, nChan, nFFT, sStand, sTime, skN, lower, upper, (float *) PyArray_DATA(dataF));
+	} else {
+		compute_pseudo_sk((double *) PyArray_DATA(data), nStand, nChan, nFFT, sStand, sTime, skN, lower, upper, (float *) PyArray_DATA(dataF));
+	}
 	
 	Py_END_ALLOW_THREADS
 	
@@ -214,8 +397,9 @@ char ComputePseudoSKMask_doc[] = PyDoc_STR(\
 psuedo-spectral kurtosis\n\
 \n\
 Input arguments are:\n\
- * signals: 2-D numpy.complex64 (stands by channels/integrations) array\n\
-   of data to from DR spectrometer\n\
+ * signals: 2-D numpy.float64 (stands by channels/integrations) array\n\
+   of data to from DR spectrometer or 3-D numpy.float32 (integrations by\n\
+   stands by channels) array of data, i.e., a decoded PSRFITS block\n\
  * LFFT: FFT length\n\
  * N: number of FFT windows per integration\n\
  * lower: lower spectral kurtosis limit\n\
@@ -6,12 +6,10 @@ Given a collection of single pulse files from PRESTO, plot them in an interactiv
 
 import os
 import sys
-import glob
 import math
 import time
 import numpy
 import shutil
-import tarfile
 import argparse
 import tempfile
 import subprocess
@@ -33,6 +31,9 @@ from lsl.misc.dedispersion import _D, delay, incoherent
 from lsl.misc.mathutils import to_dB, from_dB
 from lsl.misc import parser as aph
 
+from psrfitsio import read_weights, read_sample_times, SubintCache
+from singlepulseio import read_singlepulse_files, is_tarball, read_singlepulse_tarball, get_cache_filename, load_cache, save_cache, PulseIndex, DensityPyramid
+
 import wx
 import wx.html
 import matplotlib
@@ -214,6 +215,76 @@ def findLimits(data, usedB=True):
     return [dMin, dMax]
 
 
+def getDMTimePlane(spec, freq, tInt, dmMax, decimation=1, maxDelays=512, maxChannels=256):
+    """
+    Given a 2-D (time, channel) masked array of spectra, the channel 
+    frequencies in Hz, and the sample time in seconds, compute the DM-time
+    plane for DMs between zero and dmMax.  The data are decimated in time by 
+    at least the specified factor so that there are no more than maxDelays
+    DMs and are summed into no more than maxChannels sub-bands.  Returns a 
+    three-element tuple of the (DM, time) plane, the DMs, and the time 
+    decimation factor used.  Time in the plane is the arrival time at the top
+    of the band.
+    """
+    
+    # Zero mean channels with the flagged samples set to zero
+    data = numpy.ma.filled(spec, 0.0).astype(numpy.float32)
+    good = ~numpy.ma.getmaskarray(spec)
+    data -= data.sum(axis=0) / numpy.maximum(good.sum(axis=0), 1)
+    data *= good
+    
+    # Put the channels in order of increasing frequency
+    freq = numpy.asarray(freq, dtype=numpy.float64)
+    if freq[0] > freq[-1]:
+        freq = freq[::-1]
+        data = data[:,::-1]
+    chanWidth = (freq[-1] - freq[0]) / max([1, freq.size-1])
+    
+    # Sum adjacent channels into a power of two number of sub-bands that span
+    # the band.  When the channel count does not divide evenly the sub-bands
+    # differ by one channel, which keeps the sub-band edges to within a channel
+    # of where FDMT expects them without padding the band out.
+    nSub = 1
+    while nSub*2 <= min([maxChannels, freq.size]):
+        nSub *= 2
+    starts = (numpy.arange(nSub)*freq.size) // nSub
+    data = numpy.add.reduceat(data, starts, axis=1)
+    fLow = (freq[0] - chanWidth/2.0) / 1e6
+    fHigh = (freq[-1] + chanWidth/2.0) / 1e6
+    norm = 1.0/fLow**2 - 1.0/fHigh**2
+    
+    # Decimate in time
+    nDelay = _D*dmMax*norm / tInt
+    decimation = max([decimation, int(numpy.ceil(nDelay / (maxDelays-1)))])
+    nKeep = (data.shape[0]//decimation)*decimation
+    data = data[:nKeep,:].reshape(nKeep//decimation, decimation, -1).mean(axis=1)
+    tInt = tInt*decimation
+    nDelays = int(numpy.ceil(_D*dmMax*norm / tInt)) + 1
+    
+    # Compute the plane
+    waterfall = numpy.ascontiguousarray(data.T, dtype=numpy.float32)
+    try:
+        from _helper import FastFDMT
+        plane = FastFDMT(waterfall, (fLow, fHigh), nDelays)
+    except ImportError:
+        nSamps = waterfall.shape[1]
+        fCenter = fLow + (numpy.arange(waterfall.shape[0]) + 0.5)*(fHigh - fLow)/waterfall.shape[0]
+        plane = numpy.zeros((nDelays, nSamps), dtype=numpy.float32)
+        for i in range(nDelays):
+            shifts = numpy.round(i*(1.0/fLow**2 - 1.0/fCenter**2)/norm).astype(int)
+            for j,shift in enumerate(shifts):
+                if shift < nSamps:
+                    plane[i,shift:] += waterfall[j,:nSamps-shift]
+                    
+    # Move from the arrival time at the bottom of the band to the top
+    for i in range(1, nDelays):
+        plane[i,:-i] = plane[i,i:]
+        plane[i,-i:] = numpy.nan
+        
+    dms = numpy.arange(nDelays)*tInt / (_D*norm)
+    return plane, dms, decimation
+
+
 class LogNorm(Normalize):
     """
     Normalize a given value to the 0-1 range on a log scale
@@ -405,6 +476,7 @@ class SinglePulse_GUI(object):
         self.maxPoints = 5000
         
         self.filenames = []
+        self.infname = None
         self.fitsname = None
         
         self.ax1a = None
@@ -417,11 +489,15 @@ class SinglePulse_GUI(object):
         self.plotSymbol = 'o'
         
         self.dataThreshold = [None, None, None]
+        self.index = None
         self.sizeProperty = 1
         self.colorProperty = 4
         self.dataWindow = [None, None, None, None]
         
         self._histogramCache = {}
+        self._pyramid = None
+        self._colorbar = None
+        self.blockCache = SubintCache()
         
         self.oldMarkT = None
         self.oldMarkD = None
@@ -430,69 +506,73 @@ class SinglePulse_GUI(object):
         self._mouseClickCache = {'1a':[], '1b':[], '1c':[], '2':[]}
         self._keyPressCache = {'1a':[], '1b':[], '1c':[], '2':[]}
         
-    def loadData(self, filenames, threshold=5.0, timeRange=[0,numpy.inf], dmRange=[0,numpy.inf], widthRange=[0, numpy.inf], fitsname=None):
+    def loadData(self, filenames, threshold=5.0, timeRange=[0,numpy.inf], dmRange=[0,numpy.inf], widthRange=[0, numpy.inf], fitsname=None, useCache=True, nproc=None, pigz=False):
         print("Loading %i files with a pulse S/N threshold of %.1f" % (len(filenames), threshold))
         tStart = time.time()
-
-        # If it a tarfile?
-        if os.path.splitext(filenames[0])[1] in ('.tar.gz', '.tgz'):
-            print("%6.3f s - Extracting tar file" % (time.time()-tStart,))
+        
+        # Is there a cache for these files?
+        cachename, cached = None, None
+        if useCache:
+            cachename = get_cache_filename(filenames)
+            cached = load_cache(cachename)
             
-            if len(filenames) > 1:
-                raise RuntimeError("Only one tarfile can be provided")
+        if cached is not None:
+            print("%6.3f s - Loading pulses from cache" % (time.time()-tStart,))
+            data, infname = cached
+            
+        else:
+            # Load the data
+            ## Columns are DM, sigma, time (relative), sample (like time), and 
+            ## downfact (width)
+            if is_tarball(filenames[0]):
+                ### Read the pulses directly from the tarball
+                print("%6.3f s - Extracting pulses from tar file" % (time.time()-tStart,))
                 
-            self.tempdir = tempfile.mkdtemp(prefix='single-pulse-')
-            tf = tarfile.open(filenames[0], mode='r:*')
-            for entry in tf:
-                if entry.isdir():
-                    continue
-                filename = os.path.basename(entry.name)
-                filename = os.path.join(self.tempdir, filename)
-                with open(filename, 'wb') as fh:
-                    fh.write(tf.extractfile(entry.name).read())
+                if len(filenames) > 1:
+                    raise RuntimeError("Only one tarfile can be provided")
+                    
+                data, infContents = read_singlepulse_tarball(filenames[0], nproc=nproc, pigz=pigz)
+                if infContents is None:
+                    raise RuntimeError("No .inf file found in the tarfile")
+                    
+                ### Metadata
+                self.tempdir = tempfile.mkdtemp(prefix='single-pulse-')
+                infname = os.path.join(self.tempdir, 'singlepulse.inf')
+                with open(infname, 'wb') as fh:
+                    fh.write(infContents)
+                    
+            else:
+                print("%6.3f s - Extracting pulses" % (time.time()-tStart,))
+                spnames = [filename for filename in filenames if os.path.splitext(filename)[1] != '.inf']
+                data = read_singlepulse_files(spnames, nproc=nproc)
+                
+                ### Metadata
+                infname = os.path.splitext(spnames[0])[0]
+                infname = "%s.inf" % infname
+                
+            ## Save the cache for next time
+            if cachename is not None:
+                if save_cache(cachename, data, infname):
+                    infname = os.path.splitext(cachename)[0]+'.inf'
                     
-            filenames = glob.glob(os.path.join(self.tempdir, '*'))
-            
         # Save the filenames
         self.filenames = filenames
+        self.infname = infname
         self.fitsname = fitsname
         
-        # Load the data
-        print("%6.3f s - Extracting pulses" % (time.time()-tStart,))
-        data = []
-        meta = []
-        for filename in filenames:
-            ## Columns are DM, sigma, time (relative), sample (like time), and 
-            ## downfact (width) but are downselected to everything but sample
-            try:
-                newData = numpy.loadtxt(filename, dtype=numpy.float32)
-                if len(newData.shape) == 2:
-                    newData = newData[:,[0,1,2,3,4]]
-                    data.append( newData )
-                elif len(newData.shape) == 1 and newData.size > 0:
-                    newData = newData.reshape(1,-1)
-                    newData = newData[:,[0,1,2,3,4]]
-                    data.append( newData )
-            except ValueError:
-                pass
-                
-            ## Metadata
-            metaname = os.path.splitext(filename)[0]
-            metaname = "%s.inf" % metaname
-            meta.append( infodata(metaname) )
-        meta = meta[0]
-        data = numpy.concatenate(data)
+        meta = infodata(infname)
         
         self.meta = meta
-        self.data = numpy.ma.array(data, mask=numpy.zeros(data.shape, dtype=bool))
-        self.data.data[:,4] *= 1000.0*self.meta.dt	# Convert width from samples to time in ms
-        print("            -> Found %i pulses" % self.data.shape[0])
+        print("            -> Found %i pulses" % data.shape[0])
         
         print("%6.3f s - Applying time, DM, and width cuts" % (time.time()-tStart,))
-        valid = numpy.where( (self.data[:,2] >= timeRange[0] ) & (self.data[:,2] <= timeRange[1] ) & \
-                        (self.data[:,0] >= dmRange[0]   ) & (self.data[:,0] <= dmRange[1]   ) & \
-                        (self.data[:,4] >= widthRange[0]) & (self.data[:,4] <= widthRange[1])    )[0]
-        self.data = self.data[valid,:]
+        width = data[:,4]*numpy.float32(1000.0*self.meta.dt)	# Convert width from samples to time in ms
+        valid = numpy.where( (data[:,2] >= timeRange[0] ) & (data[:,2] <= timeRange[1] ) & \
+                        (data[:,0] >= dmRange[0]   ) & (data[:,0] <= dmRange[1]   ) & \
+                        (width >= widthRange[0]) & (width <= widthRange[1])    )[0]
+        data = data[valid,:]
+        data[:,4] = width[valid]
+        self.data = numpy.ma.array(data, mask=numpy.zeros(data.shape, dtype=bool))
         print("            -> Downselected to %i pulses" % self.data.shape[0])
         
         if self.data.shape[0] == 0:
@@ -522,13 +602,13 @@ class SinglePulse_GUI(object):
         print("            -> Time window padding: %.1f s" % tPad)
         print("            -> DM window padding: %.3f pc cm^-3" % dPad)
         
+        print("%6.3f s - Building the pulse index" % (time.time()-tStart,))
+        self.index = PulseIndex(self.data.data, *self.dataThreshold)
+        self._pyramid = None
+        
         print("%6.3f s - Setting default colorbar ranges" % (time.time() - tStart))
-        sMin, wMin, wMax = self.dataThreshold
         tLow, tHigh, dmLow, dmHigh = self.dataWindow
-        valid = numpy.where( (self.data[:,2] >= tLow ) & (self.data[:,2] <= tHigh ) & \
-                        (self.data[:,0] >= dmLow) & (self.data[:,0] <= dmHigh) & \
-                        (self.data[:,1] >= sMin ) & (self.data[:,4] >= wMin  ) & \
-                        (self.data[:,4] <= wMax) )[0]
+        valid = self.index.select(tLow, tHigh, dmLow, dmHigh)
         self.limits = [None,]*self.data.shape[1]
         for i in range(self.data.shape[1]):
             self.limits[i] = findLimits(self.data[valid,i], usedB=False)
@@ -546,31 +626,48 @@ class SinglePulse_GUI(object):
             
         try:
             shutil.rmtree(self.tempdir)
+            del self.tempdir
         except (AttributeError, OSError):
             pass
-        del self.tempdir
         print("%6.3f s - Finished preparing data" % (time.time() - tStart))
         
+    def getIndex(self):
+        """
+        Return the spatial index of the pulses after making sure that it is 
+        up-to-date with the current S/N and width thresholds.
+        """
+        
+        if self.index.threshold != tuple(self.dataThreshold):
+            self.index.set_threshold(*self.dataThreshold)
+        return self.index
+        
+    def getDensityPyramid(self):
+        """
+        Return the multi-resolution density grid of the unmasked pulses that 
+        pass the current thresholds, building it if needed.
+        """
+        
+        if self._pyramid is None:
+            valid = self.getIndex().select(-numpy.inf, numpy.inf)
+            valid = valid[self.data.mask[valid,0] == 0]
+            self._pyramid = DensityPyramid(self.data.data[valid,2], self.data.data[valid,0], self.data.data[valid,1], 
+                                           (self.tMin, self.tMax), (self.dmMin, self.dmMax))
+        return self._pyramid
+        
     def getClosestPulse(self, t, dm):
         """
         Return the index of the pulse closest to the provided time and DM.
         """
         
-        # Filter things with the right S/N and pulse width
-        sLow, wLow, wHigh = self.dataThreshold
-        valid = numpy.where( (self.data[:,1]>=sLow) \
-                             & (self.data[:,4]>=wLow) \
-                             & (self.data[:,4]<=wHigh) )[0]
-        
         # Grab the current image scale
         aspect = get_aspect(self.ax2)
         
-        # Find the best match after taking into account the plot aspect ratio
-        d = ((self.data[valid,2]-t)/aspect)**2 + (self.data[valid,0]-dm)**2
-        best = valid[numpy.argmin(d)]
+        # Find the best match with the right S/N and pulse width after taking
+        # into account the plot aspect ratio
+        best = self.getIndex().nearest(t, dm, aspect=aspect)
         print('-> click at %.1f s, %.3f pc cm^-3 closest to pulse %i at %.1f, %.3f' % (t, dm, best, self.data[best,2], self.data[best,0]))
         
-        return valid[numpy.argmin(d)]
+        return best
         
         
     def selectTimeRange(self, t0, dm0, t1, dm1):
@@ -585,9 +682,8 @@ class SinglePulse_GUI(object):
         tCutLow = t0 + (self.dmMin-dm0)*slope
         tCutHigh = t1 + (self.dmMax-dm1)*slope
         
-        valid1 = numpy.where( (self.data[:,2] >= tCutLow ) \
-                              & (self.data[:,2] <= tCutHigh) )[0]
-                        
+        valid1 = self.getIndex().select(tCutLow, tCutHigh, thresholded=False)
+        
         deltaT1 = self.data[valid1,2] + (self.data[valid1,0]-dm0)*slope - t0
         deltaT2 = self.data[valid1,2] + (self.data[valid1,0]-dm1)*slope - t1
         valid2 = numpy.where( (deltaT1 >=0) & (deltaT2 <= 0) )[0]
@@ -599,9 +695,8 @@ class SinglePulse_GUI(object):
         Given a time at DM0 and another time at DM1, select everything in DM between.
         """
         
-        valid1 = numpy.where( (self.data[:,0] >= dm0) \
-                              & (self.data[:,0] <= dm1) )[0]
-                        
+        valid1 = self.getIndex().select_dm(dm0, dm1)
+        
         return valid1
         
     def selectTimeDMRange(self, t0, dm0, t1, dm1):
@@ -617,11 +712,8 @@ class SinglePulse_GUI(object):
         tCutLow = t0 + (self.dmMin-dm0)*slope
         tCutHigh = t1 + (self.dmMax-dm1)*slope
         
-        valid1 = numpy.where( (self.data[:,2] >= tCutLow ) & \
-                        (self.data[:,2] <= tCutHigh) &
-                        (self.data[:,0] >= dm0     ) & \
-                        (self.data[:,0] <= dm1     ) )[0]
-                        
+        valid1 = self.getIndex().select(tCutLow, tCutHigh, dm0, dm1, thresholded=False)
+        
         deltaT1 = self.data[valid1,2] + (self.data[valid1,0]-dm0)*slope - t0
         deltaT2 = self.data[valid1,2] + (self.data[valid1,0]-dm1)*slope - t1
         valid2 = numpy.where( (deltaT1 >=0) & (deltaT2 <= 0) )[0]
@@ -646,6 +738,11 @@ class SinglePulse_GUI(object):
         Draw the waterfall diagram and the total power with time.
         """
         
+        # A recompute from the caller means that the mask or the thresholds
+        # may have changed
+        if recompute:
+            self._pyramid = None
+            
         try:
             tLowNew, tHighNew = self.ax2.get_xlim()
             dmLowNew, dmHighNew = self.ax2.get_ylim()
@@ -653,24 +750,27 @@ class SinglePulse_GUI(object):
             tLowNew, tHighNew = self.dataWindow[0], self.dataWindow[1]
             dmLowNew, dmHighNew = self.dataWindow[2], self.dataWindow[3]
             
+        windowChanged = False
         if tLowNew != self.dataWindow[0] or tHighNew != self.dataWindow[1]:
             self.dataWindow[0] = tLowNew
             self.dataWindow[1] = tHighNew
-            recompute = True
+            windowChanged = True
         if dmLowNew != self.dataWindow[2] or dmHighNew != self.dataWindow[3]:
             self.dataWindow[2] = dmLowNew
             self.dataWindow[3] = dmHighNew
-            recompute = True
+            windowChanged = True
+        recompute |= windowChanged
             
-        sMin, wMin, wMax = self.dataThreshold
         tLow, tHigh, dmLow, dmHigh = self.dataWindow
-        valid = numpy.where( (self.data[:,2] >= tLow ) & (self.data[:,2] <= tHigh ) \
-                             & (self.data[:,0] >= dmLow) & (self.data[:,0] <= dmHigh) \
-                             & (self.data[:,1] >= sMin ) & (self.data[:,4] >= wMin  ) \
-                             & (self.data[:,4] <= wMax)                               )[0]
+        valid = self.getIndex().select(tLow, tHigh, dmLow, dmHigh)
+        if len(valid) > self.maxPoints and not self.fullRes:
+            decim = len(valid)//self.maxPoints
+            validPlot = valid[::decim]
+        else:
+            validPlot = valid
         self.limits = [None,]*self.data.shape[1]
         for i in range(self.data.shape[1]):
-            self.limits[i] = findLimits(self.data[valid,i], usedB=False)
+            self.limits[i] = findLimits(self.data[validPlot,i], usedB=False)
                         
         try:
             snrHist = self._histogramCache['snr']
@@ -724,30 +824,53 @@ class SinglePulse_GUI(object):
             valid2 = None
             alpha = 1.0
             
-        # Plot 2 - Waterfall
-        if len(valid) > self.maxPoints and not self.fullRes:
-            decim = len(valid)//self.maxPoints
-            validPlot = valid[::decim]
-        else:
-            validPlot = valid
-            
-        if not is_callback:
-            self.frame.figure2.clf()
-            self.ax2 = self.frame.figure2.gca()
-            
-            m = self.ax2.scatter(self.data[validPlot,2], self.data[validPlot,0], 
-                                 c=self.data[validPlot,self.colorProperty], 
-                                 s=self.data[validPlot,self.sizeProperty]*5, 
-                                 cmap=self.cmap, norm=self.norm(*self.limits[self.colorProperty]), 
-                                 alpha=alpha, 
-                                 marker=self.plotSymbol, edgecolors='face')
-            try:
-                cm = self.frame.figure.colorbar(m, use_gridspec=True)
-            except:
-                if len(self.frame.figure2.get_axes()) > 1:
-                    self.frame.figure2.delaxes( self.frame.figure2.get_axes()[-1] )
-                cm = self.frame.figure2.colorbar(m)
-            if self.colorProperty == 0:
+        # Plot 2 - Waterfall - a density image if there are too many pulses
+        useDensity = (len(validPlot) < len(valid))
+        
+        if not is_callback or windowChanged:
+            if is_callback:
+                ## Zoom/pan/home - keep the axes so that the toolbar history is
+                ## intact but replace the pulses so that the density image is
+                ## rendered for the new window, or swapped for a scatter plot
+                ## once few enough pulses are visible
+                for artist in list(self.ax2.images) + list(self.ax2.collections):
+                    artist.remove()
+            else:
+                self.frame.figure2.clf()
+                self.ax2 = self.frame.figure2.gca()
+                
+            if useDensity:
+                ## Color by peak S/N or by the number of pulses
+                image, extent = self.getDensityPyramid().view(tLow, tHigh, dmLow, dmHigh, peak=(self.colorProperty == 1))
+                if self.colorProperty == 1:
+                    norm = self.norm(*self.limits[1])
+                else:
+                    norm = self.norm(1, max([2, image.max() if image.size else 0]))
+                    image = numpy.ma.masked_equal(image, 0)
+                m = self.ax2.imshow(image, extent=extent, origin='lower', aspect='auto', 
+                                    interpolation='nearest', cmap=self.cmap, norm=norm, 
+                                    alpha=alpha)
+            else:
+                m = self.ax2.scatter(self.data[validPlot,2], self.data[validPlot,0], 
+                                     c=self.data[validPlot,self.colorProperty], 
+                                     s=self.data[validPlot,self.sizeProperty]*5, 
+                                     cmap=self.cmap, norm=self.norm(*self.limits[self.colorProperty]), 
+                                     alpha=alpha, 
+                                     marker=self.plotSymbol, edgecolors='face')
+            if is_callback:
+                cm = self._colorbar
+                cm.update_normal(m)
+            else:
+                try:
+                    cm = self.frame.figure.colorbar(m, use_gridspec=True)
+                except:
+                    if len(self.frame.figure2.get_axes()) > 1:
+                        self.frame.figure2.delaxes( self.frame.figure2.get_axes()[-1] )
+                    cm = self.frame.figure2.colorbar(m)
+                self._colorbar = cm
+            if useDensity and self.colorProperty != 1:
+                cm.ax.set_ylabel('Pulses per Cell')
+            elif self.colorProperty == 0:
                 cm.ax.set_ylabel('DM [pc cm$^{-3}$]')
             elif self.colorProperty == 1:
                 cm.ax.set_ylabel('S/N')
@@ -768,7 +891,7 @@ class SinglePulse_GUI(object):
             self.ax2.set_xlabel('Elapsed Time [s]')
             self.ax2.set_ylabel('DM [pc cm$^{-3}$]')
             
-            if self.oldMarkT is not None:
+            if self.oldMarkT is not None and not is_callback:
                 if recompute:
                     self.oldMarkT = None
                     self.oldMarkD = None
@@ -1025,6 +1148,7 @@ class SinglePulse_GUI(object):
                 print("  e - export the current pulses to a file")
                 print("  s - display a DM time slice")
                 print("  w - display the PSRFITS waterfall for a pulse")
+                print("  d - display the DM-time plane for a pulse")
                 print("  u - unmask pulses in a region of time")
                 print("  m - mask pulses in a region of time")
                 print("  y - unmask pulses in a region of time/DM")
@@ -1051,16 +1175,12 @@ class SinglePulse_GUI(object):
                 print("Saving to '%s'" % outname)
                 
                 ### Select the valid data
-                sMin, wMin, wMax = self.dataThreshold
                 tLow, tHigh, dmLow, dmHigh = self.dataWindow
-                valid = numpy.where( (self.data[:,2] >= tLow ) & (self.data[:,2] <= tHigh ) & \
-                                (self.data[:,0] >= dmLow) & (self.data[:,0] <= dmHigh) & \
-                                (self.data[:,1] >= sMin ) & (self.data[:,4] >= wMin  ) & \
-                                (self.data[:,4] <= wMax ) & (self.data.mask[:,0] == 0) )[0]
+                valid = self.getIndex().select(tLow, tHigh, dmLow, dmHigh)
+                valid = valid[self.data.mask[valid,0] == 0]
                                 
                 ### Build a .inf file to use later
-                infBase = os.path.splitext(self.filenames[0])[0]
-                infBase = "%s.inf" % infBase
+                infBase = self.infname
                 
                 with open(infBase, 'r') as ih:
                     with open('plotSinglePulse.inf', 'w') as fh:
@@ -1103,6 +1223,22 @@ class SinglePulse_GUI(object):
                 else:
                     print("No PSRFITS file specified, skipping")
                 
+            elif event.key == 'd':
+                ## DM-time plane window
+                if self.fitsname is not None:
+                    ### Recenter first
+                    self.makeMark(self.data[best,2], self.data[best,0])
+                    
+                    print("Time: %.3f s" % self.data.data[best,2])
+                    print("DM: %.3f pc cm^-3" % self.data.data[best,0])
+                    print("S/N: %.2f" % self.data.data[best,1])
+                    print("Width: %.3f ms" % self.data.data[best,4])
+                    print("Flagged? %s" % self.data.mask[best,0])
+                    
+                    DMTimeDisplay(self.frame, self.fitsname, self.data[best,2], self.data[best,0], self.data[best,4])
+                else:
+                    print("No PSRFITS file specified, skipping")
+                    
             elif event.key == 'u':
                 ## Mask a time range
                 self._keyPressCache['2'].append( ('u', clickX, clickY) )
@@ -2191,15 +2327,10 @@ class SliceDisplay(wx.Frame):
         
         slope = -_D*(1.0/fLow**2 - 1.0/fHigh**2)
         
-        sLow, wLow, wHigh = self.parent.data.dataThreshold
         tCutLow = self.t + (self.parent.data.dmMax-self.dm)*slope - 1
         tCutHigh = self.t + (self.parent.data.dmMin-self.dm)*slope + 1
         
-        valid = numpy.where( (self.parent.data.data[:,2] >= tCutLow) & \
-                        (self.parent.data.data[:,2] <= tCutHigh) & \
-                        (self.parent.data.data[:,1] >= sLow ) & \
-                        (self.parent.data.data[:,4] >= wLow ) & \
-                        (self.parent.data.data[:,4] <= wHigh ) )[0]
+        valid = self.parent.data.getIndex().select(tCutLow, tCutHigh)
         if len(valid) == 0:
             self.ax1.set_title('Nothing to display')
             return False
@@ -2823,70 +2954,46 @@ class WaterfallDisplay(wx.Frame):
         
         ## Spectra extraction
         print("Extracting event region...")
-        samp, tRel, spec, mask = [], [], [], []
-        for i in range(subIntStart, subIntStop+1):
-            ### Access the correct subintegration
-            subint = hdulist[1].data[i]
-            
-            ### Pull out various bits that we need, including:
-            ###  * the start time of the subint. - tOff
-            ###  * the weight mask, converted to binary - msk
-            ###  * the scale and offset values - bscl and bzero
-            ###  * the actual data - data
-            tOff = subint[1] - subint[0]//2
-            msk = numpy.where(subint[13] >= 0.5, False, True)
-            bzero = subint[14]
-            bscl = subint[15]
-            bzero.shape = (LFFT,nPol)
-            bscl.shape = (LFFT,nPol)
-            bzero = bzero.T
-            bscl = bscl.T
-            data = subint[16]
-            data.shape = (nSubs,LFFT,nPol)
-            data = data.T
-            
-            ### Apply the scaling/offset to the data and save the results 
-            ### to the HDF5 file
-            for j in range(nSubs):
-                s = i*nSubs + j
-                t = subint[1] - self.t + tInt*(j-nSubs//2)
-                d = data[:,:,j]*bscl + bzero
-                samp.append( s )
-                tRel.append( t )
-                spec.append( d )
-                mask.append( msk )
-        samp = numpy.array(samp)
-        self.tRel = numpy.array(tRel)
-        
-        self.spec = numpy.ma.array(numpy.array(spec), mask=numpy.array(mask))
+        spec = self.parent.data.blockCache.read_subints(hdulist, subIntStart, subIntStop+1)
+        self.tRel = read_sample_times(hdulist, subIntStart, subIntStop+1) - self.t
+        
+        ### Expand the weight mask, converted to binary, to match the spectra
+        mask = read_weights(hdulist, subIntStart, subIntStop+1) < 0.5
+        mask = numpy.repeat(mask, nSubs, axis=0)
+        mask = numpy.repeat(mask[:,None,:], nPol, axis=1)
+        
+        self.spec = numpy.ma.array(spec, mask=mask)
         hdulist.close()
         
-        ## Bandpassing
+        ## Bandpassing - reusing the solution for these rows if it is cached
         print("Computing bandpass...")
-        try:
-            from _helper import FastAxis0Median
-            meanSpec = FastAxis0Median(self.spec)
-        except ImportError:
-            meanSpec = numpy.mean(self.spec, axis=0)
-            
-        ### Come up with an appropriate smoothing window (wd) and order (od)
-        ws = int(round(self.spec.shape[2]/10.0))
-        ws = min([41, ws])
-        if ws % 2 == 0:
-            ws += 1
-        od = min([9, ws-2])
-        
-        bpm2 = []
-        for i in range(self.spec.shape[1]):
-            bpm = savitzky_golay(meanSpec[i,:], ws, od, deriv=0)
-            bpm = numpy.ma.array(bpm, mask=~numpy.isfinite(bpm))
-            
-            if bpm.mean() == 0:
-                bpm += 1
-            bpm2.append( bpm / bpm.mean() )
+        bpm2 = self.parent.data.blockCache.get(self.fitsname, ('bandpass', subIntStart, subIntStop))
+        if bpm2 is None:
+            try:
+                from _helper import FastAxis0Median
+                meanSpec = FastAxis0Median(self.spec)
+            except ImportError:
+                meanSpec = numpy.mean(self.spec, axis=0)
+                
+            ### Come up with an appropriate smoothing window (wd) and order (od)
+            ws = int(round(self.spec.shape[2]/10.0))
+            ws = min([41, ws])
+            if ws % 2 == 0:
+                ws += 1
+            od = min([9, ws-2])
+            
+            bpm2 = []
+            for i in range(self.spec.shape[1]):
+                bpm = savitzky_golay(meanSpec[i,:], ws, od, deriv=0)
+                bpm = numpy.ma.array(bpm, mask=~numpy.isfinite(bpm))
+                
+                if bpm.mean() == 0:
+                    bpm += 1
+                bpm2.append( bpm / bpm.mean() )
+            bpm2 = numpy.array(bpm2)
+            self.parent.data.blockCache.put(self.fitsname, ('bandpass', subIntStart, subIntStop), bpm2)
             
         ### Apply the bandpass correction
-        bpm2 = numpy.array(bpm2)
         self.specBandpass = numpy.ma.array(self.spec.data*1.0, mask=self.spec.mask)
         try:
             from _helper import FastAxis0Bandpass
@@ -2904,12 +3011,22 @@ class WaterfallDisplay(wx.Frame):
         
         # Run the incoherent dedispersion on the data
         print("Dedispersing data...")
-        self.specD = self.spec*0
-        self.specBandpassD = self.specBandpass*0
-        for i in range(self.specD.shape[1]):
-            self.specD[:,i,:] = incoherent(freq, self.spec[:,i,:], tInt, self.dm, boundary='fill', fill_value=numpy.nan)
-            self.specBandpassD[:,i,:] = incoherent(freq, self.specBandpass[:,i,:], tInt, self.dm, boundary='fill', fill_value=numpy.nan)
-        
+        try:
+            from _helper import FastIncoherentDedispersion
+            tDelay = numpy.round(tSweep / tInt).astype(numpy.int32)
+            specD, specBandpassD, self.profD, self.profBandpassD = FastIncoherentDedispersion(self.spec.data, numpy.ma.getmaskarray(self.spec), 
+                                                                                              tDelay, bpm2.astype(numpy.float32))
+            self.specD = numpy.ma.masked_invalid(specD)
+            self.specBandpassD = numpy.ma.masked_invalid(specBandpassD)
+        except ImportError:
+            self.specD = self.spec*0
+            self.specBandpassD = self.specBandpass*0
+            for i in range(self.specD.shape[1]):
+                self.specD[:,i,:] = incoherent(freq, self.spec[:,i,:], tInt, self.dm, boundary='fill', fill_value=numpy.nan)
+                self.specBandpassD[:,i,:] = incoherent(freq, self.specBandpass[:,i,:], tInt, self.dm, boundary='fill', fill_value=numpy.nan)
+            self.profD = self.specD.sum(axis=2).filled(numpy.nan)
+            self.profBandpassD = self.specBandpassD.sum(axis=2).filled(numpy.nan)
+            
         # Calculate the plot limits
         print("Setting default plot limits...")
         self.limits = [None,]*self.spec.shape[1]
@@ -2961,11 +3078,11 @@ class WaterfallDisplay(wx.Frame):
         dataProduct = self.data_products[self.index]
         if self.bandpass:
             spec = self.specBandpass[:,self.index,:]
-            specD = self.specBandpassD[:,self.index,:]
+            profD = self.profBandpassD[:,self.index]
             limits = self.limitsBandpass[self.index]
         else:
             spec = self.spec[:,self.index,:]
-            specD = self.specD[:,self.index,:]
+            profD = self.profD[:,self.index]
             limits = self.limits[self.index]
             
         # Decimate
@@ -3006,9 +3123,7 @@ class WaterfallDisplay(wx.Frame):
             
         ## Dedispersed profile
         if self.profile:
-            prof = specD.sum(axis=1)
-            prof = prof[:nKeep]
-            prof.shape = (nKeep//self.decFactor, self.decFactor)
+            prof = profD[:nKeep].reshape(nKeep//self.decFactor, self.decFactor)
             prof = prof.mean(axis=1)
             ax = self.addSubplotAxes(self.figure, self.ax1, [0.7, 0.7, 0.25, 0.25])
             ax.plot(tRel, prof)
@@ -3380,6 +3495,253 @@ class WaterfallDecimationAdjust(wx.Frame):
         return self.parent.width // (self.parent.decFactor * self.parent.parent.data.meta.dt)
 
 
+class DMTimeDisplay(wx.Frame):
+    """
+    Window for displaying the DM-time plane around a pulse in a zoomable fashion
+    """
+    
+    def __init__(self, parent, fitsname, t, dm, width):
+        wx.Frame.__init__(self, parent, title='DM-Time Plane', size=(400, 375))
+        
+        self.parent = parent
+        self.fitsname = fitsname
+        self.t = t
+        self.dm = dm
+        self.width = width / 1000.0	# ms -> s
+        
+        # Convert time from barycentric to topocentric, if required
+        if self.parent.data.meta.bary:
+            if self.parent.data.bary2topo is not None:
+                self.t = self.parent.data.bary2topo(self.t)
+                
+        self.cmap = cm.get_cmap('jet')
+        
+        self.load()
+        
+        self.initUI()
+        self.initEvents()
+        self.Show()
+        
+        self.initPlot()
+        
+    def initUI(self):
+        """
+        Start the user interface.
+        """
+        
+        self.statusbar = self.CreateStatusBar()
+        
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        
+        # Add plots to panel 1
+        panel1 = wx.Panel(self, -1)
+        vbox1 = wx.BoxSizer(wx.VERTICAL)
+        self.figure = Figure()
+        self.canvas = FigureCanvasWxAgg(panel1, -1, self.figure)
+        self.toolbar = NavigationToolbar2WxAgg(self.canvas)
+        self.toolbar.Realize()
+        vbox1.Add(self.canvas,  1, wx.ALIGN_LEFT | wx.EXPAND)
+        vbox1.Add(self.toolbar, 0, wx.ALIGN_LEFT)
+        panel1.SetSizer(vbox1)
+        hbox.Add(panel1, 1, wx.EXPAND)
+        
+        # Use some sizers to see layout options
+        self.SetSizer(hbox)
+        self.SetAutoLayout(1)
+        hbox.Fit(self)
+        
+    def initEvents(self):
+        """
+        Set all of the various events in the data range window.
+        """
+        
+        # Make the images resizable
+        self.Bind(wx.EVT_PAINT, self.resizePlots)
+        
+    def load(self):
+        """
+        Extract the data around the pulse and compute the DM-time plane.
+        """
+        
+        print("Loading PSRFITS metadata...")
+        hdulist = astrofits.open(self.fitsname, mode='readonly', memmap=True)
+        
+        ## File specifics
+        tInt = hdulist[1].header['TBIN']
+        nSubs = hdulist[1].header['NSBLK']
+        tSubs = nSubs*tInt
+        nPol = hdulist[1].header['NPOL']
+        nChunks = len(hdulist[1].data)
+        
+        ## Frequency information
+        freq = hdulist[1].data[0][12]*1e6
+        
+        ## Pulse location - enough data to cover the sweep at twice the pulse DM
+        self.dmMax = max([2*self.dm, 1.0])
+        tSweep = delay(freq, self.dmMax).max()
+        tPad = 0.2 + self.width
+        tStart = self.t - tPad
+        tStop  = self.t + tSweep + tPad
+        subIntStart = int(tStart / tSubs) - 1
+        subIntStop  = int(tStop / tSubs) + 1
+        subIntStart = max([0, subIntStart])
+        subIntStop  = min([subIntStop, nChunks-1])
+        
+        ## Spectra extraction
+        print("Extracting event region...")
+        spec = self.parent.data.blockCache.read_subints(hdulist, subIntStart, subIntStop+1)
+        tRel = read_sample_times(hdulist, subIntStart, subIntStop+1) - self.t
+        
+        ### Expand the weight mask, converted to binary, to match the spectra
+        mask = read_weights(hdulist, subIntStart, subIntStop+1) < 0.5
+        mask = numpy.repeat(mask, nSubs, axis=0)
+        hdulist.close()
+        
+        ### Total intensity
+        if nPol == 2:
+            spec = spec.sum(axis=1)
+        else:
+            spec = spec[:,0,:]
+            
+        spec = numpy.ma.array(spec, mask=mask)
+        
+        # Downselect to something that covers the sweeps
+        valid = numpy.where( (tRel > -tPad) & (tRel < tSweep+tPad) )[0]
+        tRel = tRel[valid]
+        
+        ## Bandpassing - the mean of the unmasked samples that are left.  The
+        ## per-channel sums and counts of each sub-integration that is fully
+        ## inside the selection are cached by row so that they can be reused
+        ## by neighboring pulses and only the partial sub-integrations at the
+        ## edges need to be summed.
+        print("Computing bandpass...")
+        vStart, vStop = valid[0], valid[-1]+1
+        rowStart, rowStop = -(-vStart // nSubs), vStop // nSubs
+        if rowStop > rowStart:
+            edges = [(vStart, rowStart*nSubs), (rowStop*nSubs, vStop)]
+        else:
+            rowStop = rowStart
+            edges = [(vStart, vStop),]
+            
+        bpSum = numpy.zeros(spec.shape[1], dtype=numpy.float64)
+        bpCount = numpy.zeros(spec.shape[1], dtype=numpy.int64)
+        for i in range(rowStart, rowStop):
+            sums = self.parent.data.blockCache.get(self.fitsname, ('dmtime-rowsum', subIntStart+i))
+            if sums is None:
+                block = spec[i*nSubs:(i+1)*nSubs,:]
+                sums = (block.sum(axis=0, dtype=numpy.float64).filled(0.0), block.count(axis=0))
+                self.parent.data.blockCache.put(self.fitsname, ('dmtime-rowsum', subIntStart+i), sums)
+            bpSum += sums[0]
+            bpCount += sums[1]
+        for i,j in edges:
+            block = spec[i:j,:]
+            bpSum += block.sum(axis=0, dtype=numpy.float64).filled(0.0)
+            bpCount += block.count(axis=0)
+            
+        bpm = numpy.ones(spec.shape[1], dtype=spec.dtype)
+        bpm[bpCount > 0] = bpSum[bpCount > 0] / bpCount[bpCount > 0]
+        bpm[bpm == 0] = 1.0
+        spec = spec[valid,:] / bpm
+        
+        ## DM-time plane
+        print("Computing DM-time plane...")
+        decFactor = max([1, int(round(self.width / 2.0 / tInt))])
+        self.plane, self.dms, decFactor = getDMTimePlane(spec, freq, tInt, self.dmMax, decimation=decFactor)
+        nKeep = (tRel.size//decFactor)*decFactor
+        self.tRel = tRel[:nKeep].reshape(nKeep//decFactor, decFactor).mean(axis=1)
+        
+        print("Ready")
+        return True
+        
+    def initPlot(self):
+        """
+        Populate the figure/canvas areas with a plot.  We only need to do this
+        once for this type of window.
+        """
+        
+        # Plot the plane
+        self.figure.clf()
+        self.ax1 = self.figure.gca()
+        
+        limits = numpy.nanpercentile(self.plane, (1, 99.9))
+        m = self.ax1.imshow(self.plane, interpolation='nearest', extent=(self.tRel[0], self.tRel[-1], self.dms[0], self.dms[-1]), origin='lower', cmap=self.cmap, norm=Normalize(*limits))
+        try:
+            cm = self.figure.colorbar(m, use_gridspec=True)
+        except:
+            if len(self.figure.get_axes()) > 1:
+                self.figure.delaxes( self.figure.get_axes()[-1] )
+            cm = self.figure.colorbar(m)
+        cm.ax.set_ylabel('Dedispersed Power [arb. lin.]')
+        
+        ## Pulse marker
+        self.ax1.plot(0, self.dm, linestyle='', marker='+', markersize=12, color='w')
+        
+        self.ax1.axis('auto')
+        self.ax1.set_xlim((self.tRel[0], self.tRel[-1]))
+        self.ax1.set_ylim((self.dms[0], self.dms[-1]))
+        self.ax1.set_xlabel('Time - %.4f s' % self.t)
+        self.ax1.set_ylabel('DM [pc cm$^{-3}$]')
+        self.ax1.set_title('DM-time plane around %.1f s, %.3f pc cm$^{-3}$' % (self.t, self.dm))
+        
+        ## Draw and save the click (Why?)
+        self.canvas.draw()
+        self.connect()
+        
+    def connect(self):
+        """
+        Connect to all the events we need to interact with the plots.
+        """
+        
+        self.cidmotion  = self.figure.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        
+    def on_motion(self, event):
+        """
+        Deal with motion events in the stand field window.  This involves 
+        setting the status bar with the current x and y coordinates as well
+        as the value of the plane at that point.
+        """
+        
+        if event.inaxes:
+            clickX = event.xdata
+            clickY = event.ydata
+            
+            dataX = numpy.argmin(numpy.abs(clickY-self.dms))
+            dataY = numpy.argmin(numpy.abs(clickX-self.tRel))
+            
+            value = self.plane[dataX, dataY]
+            self.statusbar.SetStatusText("t=%.6f s, DM=%.4f pc cm^-3, p=%.2f" % (clickX, clickY, value))
+            
+        else:
+            self.statusbar.SetStatusText("")
+            
+    def disconnect(self):
+        """
+        Disconnect all the stored connection ids.
+        """
+        
+        self.figure.canvas.mpl_disconnect(self.cidmotion)
+        
+    def onCancel(self, event):
+        self.Close()
+        
+    def resizePlots(self, event):
+        # Get the current size of the window and the navigation toolbar
+        w, h = self.GetClientSize()
+        wt, ht = self.toolbar.GetSize()
+        
+        dpi = self.figure.get_dpi()
+        newW = 1.0*w/dpi
+        newH = 1.0*(h-ht)/dpi
+        self.figure.set_size_inches((newW, newH))
+        self.figure.tight_layout()
+        self.figure.canvas.draw()
+        
+    def GetToolBar(self):
+        # You will need to override GetToolBar if you are using an 
+        # unmanaged toolbar in your frame
+        return self.toolbar
+
+
 class HtmlWindow(wx.html.HtmlWindow): 
     def __init__(self, parent): 
         wx.html.HtmlWindow.__init__(self, parent, style=wx.NO_FULL_REPAINT_ON_RESIZE|wx.SUNKEN_BORDER) 
@@ -3442,6 +3804,8 @@ The lower section shows a scatter plot of time vs. DM with user-configurable col
 <b>Note:</b>  Since there may be may candidates the upper left and lower plot windows use internal
 decimation to display the data.  This default behavior limits the number of points plotted in 
 each window and the decimation can be adjusted via the <a href="#usage">Data menu</a>.
+When the number of pulses in the lower window is over this limit they are shown as an image of
+the number of pulses per cell, or the peak S/N per cell when coloring by S/N, instead.
 <br /><a href="#top">Top</a>
 </a>
 </p>
@@ -3496,6 +3860,7 @@ are:
     <li> e - export the current pulses to a file</li>
     <li>s - display a DM time slice</li>
     <li>w - display the PSRFITS waterfall for a pulse</li>
+    <li>d - display the DM-time plane for a pulse</li>
     <li>u - unmask pulses in a region of time</li>
     <li>m - mask pulses in a region of time</li>
     <li>y - unmask pulses in a region of time/DM</li>
@@ -3539,11 +3904,13 @@ def main(args):
     app = wx.App(0)
     frame = MainWindow(None, -1)
     frame.data = SinglePulse_GUI(frame)
+    frame.data.blockCache.max_bytes = int(args.block_cache*1024**2)
     frame.render()
     if args.filename is not None:
         ## If there is a filename on the command line, load it
         frame.filenames = args.filename
-        frame.data.loadData(args.filename, threshold=args.threshold, timeRange=args.time_range, dmRange=args.dm_range, widthRange=args.width_range, fitsname=args.fitsname)
+        frame.data.loadData(args.filename, threshold=args.threshold, timeRange=args.time_range, dmRange=args.dm_range, widthRange=args.width_range, fitsname=args.fitsname, 
+                            useCache=(not args.no_cache), nproc=args.processes, pigz=args.pigz)
         frame.data.render()
         frame.data.draw()
         
@@ -3570,6 +3937,14 @@ if __name__ == "__main__":
                         help='comma separated list of the pulse width range in ms to load')
     parser.add_argument('-f', '--fitsname', type=str, 
                        help='optional PSRFITS file to use for waterfall plots')
+    parser.add_argument('-n', '--no-cache', action='store_true', 
+                        help='do not read or write the binary cache of the pulses')
+    parser.add_argument('-p', '--processes', type=aph.positive_int, 
+                        help='number of processes to use when reading the .singlepulse files; defaults to one per CPU')
+    parser.add_argument('-z', '--pigz', action='store_true', 
+                        help='use pigz, if available, to decompress .tar.gz/.tgz files')
+    parser.add_argument('-m', '--block-cache', type=aph.positive_float, default=1024, 
+                        help='size in MB of the cache of decoded PSRFITS data used by the waterfall and DM-time windows')
     args = parser.parse_args()
     main(args)
     
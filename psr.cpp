@@ -33,6 +33,7 @@ static PyMethodDef psr_methods[] = {
 	{"PulsarEngineRawWindow",  (PyCFunction) PulsarEngineRawWindow,  METH_VARARGS|METH_KEYWORDS, PulsarEngineRawWindow_doc  },
 	{"PhaseRotator",           (PyCFunction) PhaseRotator,           METH_VARARGS|METH_KEYWORDS, PhaseRotator_doc           },
 	{"ComputeSKMask",          (PyCFunction) ComputeSKMask,          METH_VARARGS,               ComputeSKMask_doc          },
+	{"ComputeSKMoments",       (PyCFunction) ComputeSKMoments,       METH_VARARGS|METH_KEYWORDS, ComputeSKMoments_doc       },
 	{"ComputePseudoSKMask",    (PyCFunction) ComputePseudoSKMask,    METH_VARARGS,               ComputePseudoSKMask_doc    },
 	{"MultiChannelCD",         (PyCFunction) MultiChannelCD,         METH_VARARGS|METH_KEYWORDS, MultiChannelCD_doc         },
 	{"CombineToIntensity",     (PyCFunction) CombineToIntensity,     METH_VARARGS|METH_KEYWORDS, CombineToIntensity_doc     }, 
@@ -57,7 +58,10 @@ The functions defined in this module are:\n\
     delay as a phase rotation.\n\
   * ComputeSKMask - Given the output of PulsarEngineRaw compute a mask for\n\
     using spectral kurtosis\n\
+  * ComputeSKMoments - Given the output of PulsarEngineRaw compute the sums\n\
+    of the power and squared power used for spectral kurtosis\n\
   * ComputePseudoSKMask - Similar to ComputeSKMask but for DR spectrometer data\n\
+    or decoded PSRFITS data\n\
   * MultiChannelCD - Given the output of PulsarEngineRaw apply coherent \n\
     dedispersion to the data\n\
   * CombineToIntensity - Given the output of PulsarEngineRaw compute the total\n\
@@ -93,6 +97,7 @@ static int psr_exec(PyObject *module) {
 		PyList_Append(all, PyUnicode_FromString("PulsarEngineRawWindow"));
 		PyList_Append(all, PyUnicode_FromString("PhaseRotator"));
 		PyList_Append(all, PyUnicode_FromString("ComputeSKMask"));
+		PyList_Append(all, PyUnicode_FromString("ComputeSKMoments"));
 		PyList_Append(all, PyUnicode_FromString("ComputePseudoSKMask"));
 		PyList_Append(all, PyUnicode_FromString("MultiChannelCD"));
 		PyList_Append(all, PyUnicode_FromString("CombineToIntensity"));
@@ -77,6 +77,8 @@ extern char PhaseRotator_doc[];
 // kurtosis.c
 extern PyObject *ComputeSKMask(PyObject*, PyObject*, PyObject*);
 extern char ComputeSKMask_doc[];
+extern PyObject *ComputeSKMoments(PyObject*, PyObject*, PyObject*);
+extern char ComputeSKMoments_doc[];
 extern PyObject *ComputePseudoSKMask(PyObject*, PyObject*, PyObject*);
 extern char ComputePseudoSKMask_doc[];
 
@@ -0,0 +1,411 @@
+"""
+Module for decoding the SUBINT table of the PSRFITS files created by the
+writePsrfits2 family of converters.  The data for a range of rows are unpacked,
+scaled, and offset in a single vectorized pass, optionally in parallel over
+the rows, and returned as a (time, polarization, channel) float32 array.  The
+channel weights can also be updated in place by writing only the DAT_WTS bytes
+of the affected rows.  Decoded rows can be kept in a memory-bounded, least
+recently used cache so that overlapping reads only decode new rows.  Finally,
+there is support for the '.skstats' sidecar files that hold the spectral
+kurtosis moments saved by the converters.
+"""
+
+import os
+import numpy
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = ['read_subints', 'read_weights', 'read_sample_times', 'read_row_numbers',
+           'get_column_layout', 'write_weights', 'SubintCache', 'SKSTATS_MAGIC',
+           'get_skstats_filename', 'SKStatsWriter', 'read_skstats']
+
+
+#: Magic bytes at the start of a spectral kurtosis moments sidecar file
+SKSTATS_MAGIC = b'SKSTATS1'
+
+
+def _get_range(hdulist, start, stop):
+    """
+    Validate a range of SUBINT rows and return it as a two-element tuple.
+    """
+    
+    nRows = len(hdulist[1].data)
+    if stop is None:
+        stop = nRows
+    start = max([0, start])
+    stop = min([stop, nRows])
+    if stop <= start:
+        raise ValueError(f"Invalid row range: {start} to {stop}")
+    return start, stop
+
+
+def _decode_rows(raw, zero, scale, weights, nbits, nsblk, nchan, npol, out, fill_value):
+    """
+    Decode a set of rows into the provided output array.
+    """
+    
+    nRows = raw.shape[0]
+    
+    # Unpack the samples - 4-bit data have the first sample in the high nibble
+    if nbits == 4:
+        samples = numpy.empty((nRows, 2*raw.shape[1]), dtype=numpy.uint8)
+        numpy.right_shift(raw, 4, out=samples[:,0::2])
+        numpy.bitwise_and(raw, 0x0F, out=samples[:,1::2])
+    elif nbits == 8:
+        samples = raw
+    else:
+        raise ValueError(f"Unsupported number of bits per sample: {nbits}")
+        
+    # Apply the scale and offset, moving from (row, sample, chan, pol) to
+    # (row, sample, pol, chan) along the way
+    samples = samples.reshape(nRows, nsblk, nchan, npol).transpose(0, 1, 3, 2)
+    zero = zero.reshape(nRows, 1, nchan, npol).transpose(0, 1, 3, 2)
+    scale = scale.reshape(nRows, 1, nchan, npol).transpose(0, 1, 3, 2)
+    out = out.reshape(nRows, nsblk, npol, nchan)
+    numpy.multiply(samples, scale, out=out)
+    numpy.add(out, zero, out=out)
+    
+    # Mask, if requested
+    if fill_value is not None:
+        flagged = (weights < 0.5).reshape(nRows, 1, 1, nchan)
+        numpy.copyto(out, numpy.float32(fill_value), where=flagged)
+
+
+def read_subints(hdulist, start=0, stop=None, out=None, fill_value=None, nthreads=1):
+    """
+    Given an open PSRFITS file, decode the data in SUBINT rows start up to,
+    but not including, stop and return them as a float32 array with
+    dimensions of (time, polarization, channel).  If an output array is
+    provided the data are decoded into it instead.  If fill_value is not None,
+    the channels with a weight of less than 0.5 are set to that value.  The
+    rows are split across nthreads threads for decoding.
+    """
+    
+    start, stop = _get_range(hdulist, start, stop)
+    nRows = stop - start
+    
+    nbits = hdulist[1].header['NBITS']
+    nsblk = hdulist[1].header['NSBLK']
+    nchan = hdulist[1].header['NCHAN']
+    npol = hdulist[1].header['NPOL']
+    
+    # Pull out the columns as arrays with one row per sub-integration
+    table = hdulist[1].data
+    raw = table.field('DATA')[start:stop].reshape(nRows, -1)
+    zero = table.field('DAT_OFFS')[start:stop].reshape(nRows, -1)
+    scale = table.field('DAT_SCL')[start:stop].reshape(nRows, -1)
+    weights = table.field('DAT_WTS')[start:stop].reshape(nRows, -1)
+    
+    # Setup the output
+    shape = (nRows*nsblk, npol, nchan)
+    if out is None:
+        out = numpy.empty(shape, dtype=numpy.float32)
+    elif out.shape != shape or out.dtype != numpy.float32:
+        raise ValueError(f"Output array must be float32 with a shape of {shape}")
+        
+    # Go!
+    nthreads = max([1, min([nthreads, nRows])])
+    if nthreads == 1:
+        _decode_rows(raw, zero, scale, weights, nbits, nsblk, nchan, npol, out, fill_value)
+    else:
+        bounds = numpy.linspace(0, nRows, nthreads+1).astype(int)
+        def decode(k):
+            r0, r1 = bounds[k], bounds[k+1]
+            _decode_rows(raw[r0:r1], zero[r0:r1], scale[r0:r1], weights[r0:r1],
+                         nbits, nsblk, nchan, npol, out[r0*nsblk:r1*nsblk], fill_value)
+        with ThreadPool(nthreads) as pool:
+            pool.map(decode, range(nthreads))
+            
+    return out
+
+
+def read_weights(hdulist, start=0, stop=None):
+    """
+    Given an open PSRFITS file, return the channel weights for SUBINT rows
+    start up to, but not including, stop as a float32 array with dimensions
+    of (row, channel).
+    """
+    
+    start, stop = _get_range(hdulist, start, stop)
+    
+    weights = hdulist[1].data.field('DAT_WTS')[start:stop]
+    return weights.reshape(stop-start, -1).astype(numpy.float32)
+
+
+def read_sample_times(hdulist, start=0, stop=None):
+    """
+    Given an open PSRFITS file, return the time in seconds since the start of
+    the file for each sample in SUBINT rows start up to, but not including,
+    stop.
+    """
+    
+    start, stop = _get_range(hdulist, start, stop)
+    
+    tInt = hdulist[1].header['TBIN']
+    nsblk = hdulist[1].header['NSBLK']
+    
+    offs = hdulist[1].data.field('OFFS_SUB')[start:stop].astype(numpy.float64)
+    t = offs.reshape(-1, 1) + tInt*(numpy.arange(nsblk) - nsblk//2)
+    return t.ravel()
+
+
+def read_row_numbers(hdulist, start=0, stop=None):
+    """
+    Given an open PSRFITS file, return the sub-integration number of SUBINT 
+    rows start up to, but not including, stop as counted from the start of the
+    observation.  This is derived from the OFFS_SUB and TSUBINT columns so that
+    it also works for files that are part of a multi-file set.
+    """
+    
+    start, stop = _get_range(hdulist, start, stop)
+    
+    offs = hdulist[1].data.field('OFFS_SUB')[start:stop].astype(numpy.float64)
+    tsub = hdulist[1].data.field('TSUBINT')[start:stop].astype(numpy.float64)
+    return numpy.round(offs/tsub - 0.5).astype(numpy.int64)
+
+
+def get_column_layout(hdulist, name):
+    """
+    Given an open PSRFITS file, return a three-element tuple of the byte offset
+    of the named SUBINT column in the first row of the file, the size of a row
+    in bytes, and the numpy data type of the column values as stored on disk.
+    """
+    
+    colType, colOffset = hdulist[1].data.dtype.fields[name][:2]
+    offset = hdulist[1].fileinfo()['datLoc'] + colOffset
+    return offset, hdulist[1].header['NAXIS1'], colType.base
+
+
+def write_weights(fd, hdulist, start, stop, weights, layout=None):
+    """
+    Given a file descriptor opened for writing on an open PSRFITS file, write
+    the channel weights for SUBINT rows start up to, but not including, stop.
+    The weights can either be a single set of channel weights that is applied
+    to all rows or a 2-D array with dimensions of (row, channel).  Only the
+    bytes of the DAT_WTS column are written.  The output of get_column_layout()
+    for DAT_WTS can be passed in as layout to avoid looking it up again.
+    """
+    
+    start, stop = _get_range(hdulist, start, stop)
+    
+    if layout is None:
+        layout = get_column_layout(hdulist, 'DAT_WTS')
+    offset, rowSize, colType = layout
+    
+    weights = numpy.asarray(weights, dtype=colType)
+    weights = numpy.broadcast_to(weights.reshape(-1, hdulist[1].header['NCHAN']),
+                                 (stop-start, hdulist[1].header['NCHAN']))
+    for i in range(start, stop):
+        buffer = memoryview(weights[i-start].tobytes())
+        pos = offset + i*rowSize
+        while len(buffer):
+            written = os.pwrite(fd, buffer, pos)
+            buffer = buffer[written:]
+            pos += written
+
+
+class SubintCache(object):
+    """
+    Memory-bounded, least recently used cache of decoded SUBINT rows and of
+    other per-file products, e.g., bandpass solutions.  Entries are keyed by
+    the file, as identified by its path, size, and modification time, so that
+    any change to a file invalidates what is cached for it.  Entries are
+    evicted, oldest first, once the cached arrays take up more than max_bytes.
+    """
+    
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        
+    @property
+    def nbytes(self):
+        """
+        Size of the cached arrays in bytes.
+        """
+        
+        return self._nbytes
+        
+    @staticmethod
+    def _get_nbytes(value):
+        if isinstance(value, tuple):
+            return sum([v.nbytes for v in value])
+        return value.nbytes
+        
+    @staticmethod
+    def _get_file_key(filename):
+        st = os.stat(filename)
+        return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+        
+    def _get(self, key):
+        with self._lock:
+            value = self._entries.get(key, None)
+            if value is not None:
+                self._entries.move_to_end(key)
+        return value
+        
+    def _put(self, key, value):
+        nbytes = self._get_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+            
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= self._get_nbytes(old)
+            self._entries[key] = value
+            self._nbytes += nbytes
+            
+            while self._nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._nbytes -= self._get_nbytes(old)
+                
+    def get(self, filename, name):
+        """
+        Return the array, or tuple of arrays, cached under the provided name
+        for a file or None if there is nothing cached.
+        """
+        
+        return self._get((self._get_file_key(filename), name))
+        
+    def put(self, filename, name, value):
+        """
+        Cache an array, or tuple of arrays, under the provided name for a file.
+        """
+        
+        self._put((self._get_file_key(filename), name), value)
+        
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            
+    def read_subints(self, hdulist, start=0, stop=None, nthreads=1):
+        """
+        Cached version of read_subints().  The rows that are already in the
+        cache are copied out of it and the rest are decoded, in contiguous
+        runs, and added to the cache.  The weights are not applied to the
+        data.
+        """
+        
+        filename = hdulist.filename()
+        if filename is None:
+            return read_subints(hdulist, start, stop, nthreads=nthreads)
+            
+        start, stop = _get_range(hdulist, start, stop)
+        fileKey = self._get_file_key(filename)
+        
+        nsblk = hdulist[1].header['NSBLK']
+        nchan = hdulist[1].header['NCHAN']
+        npol = hdulist[1].header['NPOL']
+        
+        # Pull what we can out of the cache
+        out = numpy.empty(((stop-start)*nsblk, npol, nchan), dtype=numpy.float32)
+        missing = []
+        for i in range(start, stop):
+            block = self._get((fileKey, 'row', i))
+            if block is None:
+                missing.append(i)
+            else:
+                out[(i-start)*nsblk:(i-start+1)*nsblk] = block
+                
+        # Decode the rest in contiguous runs of rows
+        while len(missing):
+            r0 = r1 = missing.pop(0)
+            while len(missing) and missing[0] == r1 + 1:
+                r1 = missing.pop(0)
+            r1 += 1
+            
+            read_subints(hdulist, r0, r1, out=out[(r0-start)*nsblk:(r1-start)*nsblk], nthreads=nthreads)
+            for i in range(r0, r1):
+                self._put((fileKey, 'row', i), out[(i-start)*nsblk:(i-start+1)*nsblk].copy())
+                
+        return out
+
+
+def get_skstats_filename(filename):
+    """
+    Return the name of the spectral kurtosis moments sidecar file that goes
+    with the provided PSRFITS filename.
+    """
+    
+    return os.path.splitext(filename)[0]+'.skstats'
+
+
+def _get_skstats_record(npol, nchan):
+    """
+    Return the numpy data type for a single row in a spectral kurtosis moments
+    sidecar file.
+    """
+    
+    return numpy.dtype([('row', '<i8'),
+                        ('s1',  '<f4', (npol, nchan)),
+                        ('s2',  '<f4', (npol, nchan))])
+
+
+class SKStatsWriter(object):
+    """
+    Class for writing the spectral kurtosis moments of each sub-integration in
+    a PSRFITS file to a sidecar file.  The file starts with SKSTATS_MAGIC and 
+    the number of polarizations, channels, and FFT windows per sub-integration
+    as little endian 32-bit integers.  This is followed by one record per 
+    sub-integration with the sub-integration number as a 64-bit integer and
+    the sums of the power and the squared power as (polarization, channel)
+    float32 arrays.
+    """
+    
+    def __init__(self, filename, npol, nchan, nfft):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+        self.fh.write(SKSTATS_MAGIC)
+        self.fh.write(numpy.array([npol, nchan, nfft], dtype='<i4').tobytes())
+        self._record = numpy.zeros(1, dtype=_get_skstats_record(npol, nchan))
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    def write(self, row, moments):
+        """
+        Write the moments for the given sub-integration number.  The moments
+        are a (moment, polarization, channel) array like the output of 
+        ComputeSKMoments.
+        """
+        
+        self._record['row'] = row
+        self._record['s1'] = moments[0]
+        self._record['s2'] = moments[1]
+        self.fh.write(self._record.tobytes())
+        
+    def close(self):
+        """
+        Close the file.
+        """
+        
+        self.fh.close()
+
+
+def read_skstats(filename):
+    """
+    Read in a spectral kurtosis moments sidecar file and return a four-element
+    tuple of the number of FFT windows per sub-integration, the sub-integration
+    numbers, and the sums of the power and the squared power as (row, 
+    polarization, channel) arrays.
+    """
+    
+    with open(filename, 'rb') as fh:
+        if fh.read(len(SKSTATS_MAGIC)) != SKSTATS_MAGIC:
+            raise ValueError(f"'{filename}' is not a spectral kurtosis moments file")
+        npol, nchan, nfft = numpy.frombuffer(fh.read(12), dtype='<i4')
+        records = numpy.fromfile(fh, dtype=_get_skstats_record(npol, nchan))
+        
+    return int(nfft), records['row'], records['s1'], records['s2']
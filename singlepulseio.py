@@ -0,0 +1,469 @@
+"""
+Module for reading the .singlepulse files created by PRESTO's single_pulse_search.py.
+The files are parsed with numpy's text parser, in parallel with a pool of 
+processes for large collections of files, and the combined set of pulses can
+be saved to a binary cache that is memory-mapped on the next load.  The cache is keyed by
+the list of files, their sizes, and their modification times so that it is
+ignored if any of the files change.  Tarballs of .singlepulse files can also be
+read directly from the tar stream, optionally decompressing them with pigz.
+Finally, there is a spatial index over the pulses in time and DM that is used
+for finding the pulse closest to a point and for selecting pulses in a region,
+and a multi-resolution density grid for displaying large numbers of pulses.
+"""
+
+import io
+import os
+import numpy
+import shutil
+import tarfile
+import hashlib
+import warnings
+import subprocess
+from multiprocessing import Pool
+
+
+__all__ = ['SINGLEPULSE_COLUMNS', 'read_singlepulse', 'read_singlepulse_files',
+           'is_tarball', 'read_singlepulse_tarball', 'get_cache_filename',
+           'load_cache', 'save_cache', 'PulseIndex', 'DensityPyramid']
+
+
+#: Number of columns kept from a .singlepulse file - DM, sigma, time, sample,
+#: and downfact
+SINGLEPULSE_COLUMNS = 5
+
+# Number of files below which the files are parsed without a pool
+_SERIAL_LIMIT = 16
+
+# Target number of pulses in each DM row of the PulseIndex grid and the
+# maximum number of rows
+_ROW_SIZE = 4096
+_MAX_ROWS = 256
+
+# Initial number of pulses on either side of a point to check in each row
+# during a nearest pulse search
+_SEARCH_SPAN = 32
+
+# Size of the finest level of a DensityPyramid in time and DM and the number of
+# levels
+_DENSITY_SHAPE = (4096, 1024)
+_DENSITY_LEVELS = 7
+
+
+def _empty():
+    """
+    Return an empty set of pulses.
+    """
+    
+    return numpy.zeros((0, SINGLEPULSE_COLUMNS), dtype=numpy.float32)
+
+
+def read_singlepulse(filename):
+    """
+    Read in a single .singlepulse file, given as either a filename or an open
+    file object, and return the pulses as a float32
+    array with dimensions of (pulse, column).  The columns are DM, sigma,
+    time, sample, and downfact.  An empty array is returned for files that
+    contain no pulses or cannot be parsed.
+    """
+    
+    try:
+        with warnings.catch_warnings():
+            ## Empty files are fine
+            warnings.simplefilter('ignore', UserWarning)
+            values = numpy.loadtxt(filename, dtype=numpy.float32, ndmin=2,
+                                   usecols=range(SINGLEPULSE_COLUMNS))
+    except (ValueError, IndexError):
+        return _empty()
+        
+    return values
+
+
+def read_singlepulse_files(filenames, nproc=None):
+    """
+    Read in a collection of .singlepulse files and return all of the pulses
+    as a single float32 array with dimensions of (pulse, column).  The files
+    are parsed in parallel using nproc processes, or one per CPU if nproc is
+    None.
+    """
+    
+    if len(filenames) < _SERIAL_LIMIT or nproc == 1:
+        parts = [read_singlepulse(filename) for filename in filenames]
+    else:
+        with Pool(processes=nproc) as pool:
+            nWorkers = nproc if nproc is not None else (os.cpu_count() or 1)
+            parts = pool.map(read_singlepulse, filenames,
+                             chunksize=max([1, len(filenames) // (4*nWorkers)]))
+                             
+    if len(parts) == 0:
+        return _empty()
+    return numpy.concatenate(parts)
+
+
+def _read_singlepulse_bytes(contents):
+    """
+    Wrapper around read_singlepulse() for the contents of a file.
+    """
+    
+    return read_singlepulse(io.BytesIO(contents))
+
+
+def is_tarball(filename):
+    """
+    Return whether or not the provided filename looks like a tarball.
+    """
+    
+    return filename.endswith(('.tar', '.tar.gz', '.tgz'))
+
+
+def _open_tarball(tarname, pigz=False):
+    """
+    Open a tarball for streaming and return a two-element tuple of the 
+    tarfile.TarFile instance and the pigz process decompressing it, if any.
+    If pigz is requested but cannot be found the tarball is read with tarfile
+    alone.
+    """
+    
+    if pigz and tarname.endswith(('.gz', '.tgz')):
+        if shutil.which('pigz') is not None:
+            proc = subprocess.Popen(['pigz', '-dc', tarname], stdout=subprocess.PIPE)
+            return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+        print("WARNING: pigz not found, decompressing '%s' with tarfile" % os.path.basename(tarname))
+    return tarfile.open(tarname, mode='r|*'), None
+
+
+def read_singlepulse_tarball(tarname, nproc=None, pigz=False):
+    """
+    Read in all of the .singlepulse files contained in a tarball without 
+    extracting them to disk and return a two-element tuple of the pulses, as
+    a float32 array with dimensions of (pulse, column), and the contents of 
+    the .inf file that matches the first .singlepulse file.  The contents are
+    None if there is no matching .inf file.  The files are parsed in parallel
+    using nproc processes, or one per CPU if nproc is None.  If pigz is True
+    and the pigz command is available, it is used to decompress the tarball.
+    """
+    
+    infs = {}
+    names = []
+    def members(tf):
+        for entry in tf:
+            if not entry.isfile():
+                continue
+            base, ext = os.path.splitext(os.path.basename(entry.name))
+            if ext == '.inf':
+                infs[base] = tf.extractfile(entry).read()
+            elif ext == '.singlepulse':
+                names.append(base)
+                yield tf.extractfile(entry).read()
+                
+    tf, proc = _open_tarball(tarname, pigz=pigz)
+    done = False
+    try:
+        if nproc == 1:
+            parts = [_read_singlepulse_bytes(contents) for contents in members(tf)]
+        else:
+            with Pool(processes=nproc) as pool:
+                parts = list(pool.imap(_read_singlepulse_bytes, members(tf), chunksize=16))
+        done = True
+    finally:
+        tf.close()
+        if proc is not None:
+            proc.stdout.close()
+            status = proc.wait()
+            ## Only report pigz's exit status if it would not hide an error
+            ## that is already on its way out
+            if done and status != 0:
+                raise RuntimeError(f"pigz failed to decompress '{tarname}'")
+                
+    data = numpy.concatenate(parts) if len(parts) else _empty()
+    inf = infs.get(names[0], None) if len(names) else None
+    return data, inf
+
+
+def get_cache_filename(filenames, cachedir=None):
+    """
+    Given a list of .singlepulse files, return the name of the binary cache
+    file that goes with them.  The name is derived from the absolute paths,
+    sizes, and modification times of the files.  By default the cache is
+    placed in the same directory as the first file.
+    """
+    
+    key = hashlib.sha1()
+    for filename in filenames:
+        st = os.stat(filename)
+        key.update(os.path.abspath(filename).encode())
+        key.update(b'%i:%i;' % (st.st_size, st.st_mtime_ns))
+        
+    if cachedir is None:
+        cachedir = os.path.dirname(os.path.abspath(filenames[0]))
+    return os.path.join(cachedir, f".singlepulse-{key.hexdigest()[:16]}.npy")
+
+
+def load_cache(cachename):
+    """
+    Load a binary cache created by save_cache() and return a two-element tuple
+    of the pulses as a read-only, memory-mapped float32 array and the name of
+    the cached PRESTO .inf file.  None is returned if the cache does not
+    exist or cannot be read.
+    """
+    
+    infname = os.path.splitext(cachename)[0]+'.inf'
+    if not os.path.exists(cachename) or not os.path.exists(infname):
+        return None
+        
+    try:
+        data = numpy.load(cachename, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if data.ndim != 2 or data.shape[1] != SINGLEPULSE_COLUMNS:
+        return None
+        
+    return data, infname
+
+
+def save_cache(cachename, data, infname):
+    """
+    Save a set of pulses and a copy of the PRESTO .inf file that describes
+    them to a binary cache.  Returns True if the cache was written, False
+    otherwise.
+    """
+    
+    tempname = cachename+'.tmp'
+    try:
+        with open(tempname, 'wb') as fh:
+            numpy.save(fh, numpy.ascontiguousarray(data, dtype=numpy.float32))
+        shutil.copyfile(infname, os.path.splitext(cachename)[0]+'.inf')
+        os.replace(tempname, cachename)
+    except OSError:
+        try:
+            os.unlink(tempname)
+        except OSError:
+            pass
+        return False
+        
+    return True
+
+
+class PulseIndex(object):
+    """
+    Spatial index over a set of pulses in time and DM.  The pulses are given
+    as a (pulse, column) array with the same columns as read_singlepulse() 
+    and must be sorted in time.  The range queries use binary searches on the
+    time-sorted pulses.  The pulses that pass the S/N and width thresholds
+    are also binned into rows in DM, each of which is sorted in time, for the
+    nearest pulse searches.  Only this grid needs to be rebuilt when the 
+    thresholds change.
+    """
+    
+    def __init__(self, data, snrMin, widthMin, widthMax):
+        self.dm = numpy.ascontiguousarray(data[:,0])
+        self.snr = numpy.ascontiguousarray(data[:,1])
+        self.time = numpy.ascontiguousarray(data[:,2])
+        self.width = numpy.ascontiguousarray(data[:,4])
+        self._dmOrder = None
+        
+        self.set_threshold(snrMin, widthMin, widthMax)
+        
+    def set_threshold(self, snrMin, widthMin, widthMax):
+        """
+        Set the S/N and width thresholds and rebuild the grid used for the
+        nearest pulse searches.
+        """
+        
+        self.threshold = (snrMin, widthMin, widthMax)
+        
+        # Pulses that pass the thresholds - these are still sorted in time
+        self._valid = numpy.flatnonzero( (self.snr >= snrMin) \
+                                         & (self.width >= widthMin) \
+                                         & (self.width <= widthMax) )
+        self._vtime = self.time[self._valid]
+        vdm = self.dm[self._valid]
+        
+        # Bin them into rows in DM
+        nRows = max([1, min([_MAX_ROWS, self._valid.size // _ROW_SIZE])])
+        if self._valid.size:
+            dmMin, dmMax = vdm.min(), vdm.max()
+        else:
+            dmMin, dmMax = 0.0, 0.0
+        step = (dmMax - dmMin) / nRows
+        if step <= 0:
+            step = 1.0
+        rows = numpy.minimum(((vdm - dmMin) / step).astype(numpy.int64), nRows-1)
+        
+        ## A stable sort keeps each row sorted in time
+        order = numpy.argsort(rows, kind='stable')
+        self._gidx = self._valid[order]
+        self._gtime = self._vtime[order]
+        self._gdm = vdm[order]
+        self._rowStart = numpy.searchsorted(rows[order], numpy.arange(nRows+1))
+        
+        ## DM range covered by each row, empty rows never match
+        self._rowLow = numpy.full(nRows, numpy.inf)
+        self._rowHigh = numpy.full(nRows, -numpy.inf)
+        filled = numpy.flatnonzero(numpy.diff(self._rowStart) > 0)
+        if filled.size:
+            starts = self._rowStart[filled]
+            self._rowLow[filled] = numpy.minimum.reduceat(self._gdm, starts)
+            self._rowHigh[filled] = numpy.maximum.reduceat(self._gdm, starts)
+            
+    def nearest(self, t, dm, aspect=1.0):
+        """
+        Return the index of the pulse that passes the thresholds and is 
+        closest to the provided time and DM.  The distance is computed after
+        dividing the time offset by aspect to account for the aspect ratio of
+        the plot.
+        """
+        
+        # Search the rows in order of their closest approach in DM
+        bound = numpy.maximum(numpy.maximum(self._rowLow - dm, dm - self._rowHigh), 0)**2
+        best, bestD = -1, numpy.inf
+        for r in numpy.argsort(bound):
+            if bound[r] >= bestD:
+                break
+                
+            ## Work out from the time of the point until the time offset alone
+            ## is larger than the best distance found so far
+            s0, s1 = self._rowStart[r], self._rowStart[r+1]
+            j = s0 + numpy.searchsorted(self._gtime[s0:s1], t)
+            span = _SEARCH_SPAN
+            while True:
+                a, b = max([s0, j-span]), min([s1, j+span])
+                d = ((self._gtime[a:b] - t) / aspect)**2 + (self._gdm[a:b] - dm)**2
+                k = numpy.argmin(d)
+                if d[k] < bestD:
+                    best, bestD = a+k, d[k]
+                    
+                left = a > s0 and ((t - self._gtime[a-1]) / aspect)**2 < bestD
+                right = b < s1 and ((self._gtime[b] - t) / aspect)**2 < bestD
+                if not (left or right):
+                    break
+                span *= 4
+                
+        if best < 0:
+            raise ValueError("No pulses pass the current thresholds")
+        return int(self._gidx[best])
+        
+    def select(self, tLow, tHigh, dmLow=None, dmHigh=None, thresholded=True):
+        """
+        Return the indices, in order, of the pulses with times between tLow 
+        and tHigh, and DMs between dmLow and dmHigh if they are provided.  If
+        thresholded is True only the pulses that pass the thresholds are 
+        returned.
+        """
+        
+        times = self._vtime if thresholded else self.time
+        start = numpy.searchsorted(times, tLow, side='left')
+        stop = numpy.searchsorted(times, tHigh, side='right')
+        if thresholded:
+            valid = self._valid[start:stop]
+        else:
+            valid = numpy.arange(start, stop)
+            
+        if dmLow is not None or dmHigh is not None:
+            dms = self.dm[valid]
+            keep = numpy.ones(valid.size, dtype=bool)
+            if dmLow is not None:
+                keep &= (dms >= dmLow)
+            if dmHigh is not None:
+                keep &= (dms <= dmHigh)
+            valid = valid[keep]
+        return valid
+        
+    def select_dm(self, dmLow, dmHigh):
+        """
+        Return the indices, in order, of all of the pulses with DMs between 
+        dmLow and dmHigh.
+        """
+        
+        if self._dmOrder is None:
+            self._dmOrder = numpy.argsort(self.dm, kind='stable')
+            self._sortedDM = self.dm[self._dmOrder]
+            
+        start = numpy.searchsorted(self._sortedDM, dmLow, side='left')
+        stop = numpy.searchsorted(self._sortedDM, dmHigh, side='right')
+        return numpy.sort(self._dmOrder[start:stop])
+
+
+def _density_pyramid(time, dm, snr, timeRange, dmRange, nTime, nDM, nLevels=1):
+    """
+    Pure numpy version of _helper.FastDensityPyramid.
+    """
+    
+    time = numpy.asarray(time, dtype=numpy.float32)
+    dm = numpy.asarray(dm, dtype=numpy.float32)
+    snr = numpy.asarray(snr, dtype=numpy.float32)
+    
+    # Base level
+    j = numpy.floor((time.astype(numpy.float64) - timeRange[0]) * (nTime / (timeRange[1] - timeRange[0])))
+    l = numpy.floor((dm.astype(numpy.float64) - dmRange[0]) * (nDM / (dmRange[1] - dmRange[0])))
+    keep = (time >= timeRange[0]) & (time <= timeRange[1]) \
+           & (dm >= dmRange[0]) & (dm <= dmRange[1])
+    cells = numpy.minimum(l[keep], nDM-1).astype(numpy.int64)*nTime \
+            + numpy.minimum(j[keep], nTime-1).astype(numpy.int64)
+    count = numpy.bincount(cells, minlength=nTime*nDM).astype(numpy.int32)
+    peak = numpy.full(nTime*nDM, numpy.nan, dtype=numpy.float32)
+    numpy.fmax.at(peak, cells, snr[keep])
+    levels = [(count.reshape(nDM, nTime), peak.reshape(nDM, nTime))]
+    
+    # Coarser levels
+    for k in range(1, nLevels):
+        count, peak = levels[-1]
+        nD1, nT1 = count.shape[0]//2, count.shape[1]//2
+        count = count.reshape(nD1, 2, nT1, 2).sum(axis=(1,3), dtype=numpy.int32)
+        peak = peak.reshape(nD1, 2, nT1, 2)
+        peak = numpy.fmax(numpy.fmax(peak[:,0,:,0], peak[:,0,:,1]),
+                          numpy.fmax(peak[:,1,:,0], peak[:,1,:,1]))
+        levels.append((count, peak))
+    return levels
+
+
+class DensityPyramid(object):
+    """
+    Multi-resolution density grid of pulses in time and DM.  Each level holds
+    the number of pulses and the peak S/N in each (DM, time) cell and is half
+    the size of the previous level along both axes.  The grid is built by 
+    _helper.FastDensityPyramid if it is available.
+    """
+    
+    def __init__(self, time, dm, snr, timeRange, dmRange, shape=_DENSITY_SHAPE, nLevels=_DENSITY_LEVELS):
+        # Make sure the grid covers something
+        self.timeRange = (float(timeRange[0]), float(timeRange[1]))
+        if not self.timeRange[1] > self.timeRange[0]:
+            self.timeRange = (self.timeRange[0], self.timeRange[0] + 1.0)
+        self.dmRange = (float(dmRange[0]), float(dmRange[1]))
+        if not self.dmRange[1] > self.dmRange[0]:
+            self.dmRange = (self.dmRange[0], self.dmRange[0] + 1.0)
+            
+        try:
+            from _helper import FastDensityPyramid
+            self.levels = FastDensityPyramid(time, dm, snr, self.timeRange, self.dmRange, 
+                                             shape[0], shape[1], nLevels=nLevels)
+        except ImportError:
+            self.levels = _density_pyramid(time, dm, snr, self.timeRange, self.dmRange,
+                                           shape[0], shape[1], nLevels=nLevels)
+                                           
+    def view(self, tLow, tHigh, dmLow, dmHigh, maxCells=(1024, 512), peak=False):
+        """
+        Return a two-element tuple of the image for the provided time and DM 
+        window and its extent as (tLow, tHigh, dmLow, dmHigh).  The image comes
+        from the finest level that has no more than maxCells cells in time and
+        DM across the window.  It holds the pulse counts, or the peak S/Ns if 
+        peak is True, with dimensions of (DM, time).
+        """
+        
+        for count,peakSNR in self.levels:
+            nDM, nTime = count.shape
+            tStep = (self.timeRange[1] - self.timeRange[0]) / nTime
+            dmStep = (self.dmRange[1] - self.dmRange[0]) / nDM
+            if (tHigh - tLow) / tStep <= maxCells[0] and (dmHigh - dmLow) / dmStep <= maxCells[1]:
+                break
+                
+        # Cells that overlap the window
+        i0 = min([max([int(numpy.floor((tLow - self.timeRange[0]) / tStep)), 0]), nTime])
+        i1 = min([max([int(numpy.ceil((tHigh - self.timeRange[0]) / tStep)), i0]), nTime])
+        j0 = min([max([int(numpy.floor((dmLow - self.dmRange[0]) / dmStep)), 0]), nDM])
+        j1 = min([max([int(numpy.ceil((dmHigh - self.dmRange[0]) / dmStep)), j0]), nDM])
+        
+        image = peakSNR if peak else count
+        extent = (self.timeRange[0] + i0*tStep, self.timeRange[0] + i1*tStep,
+                  self.dmRange[0] + j0*dmStep, self.dmRange[0] + j1*dmStep)
+        return image[j0:j1,i0:i1], extent
@@ -0,0 +1,105 @@
+"""
+Unit tests for the data module.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+import shutil
+import tempfile
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_data.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_data_tests = False
+try:
+    import data
+    if MODULE_BUILD is not None:
+        run_data_tests = True
+except ImportError:
+    pass
+
+
+@unittest.skipUnless(run_data_tests, "requires the data module and h5py")
+class data_tests(unittest.TestCase):
+    def setUp(self):
+        """Create a temporary directory to work in."""
+        
+        self.tempdir = tempfile.mkdtemp(prefix='test-data-')
+        self.filename = os.path.join(self.tempdir, 'test.hdf5')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        
+    def test_create(self):
+        """Create a file and fill in the minimum metadata."""
+        
+        f = data.create_new_file(self.filename)
+        try:
+            self.assertTrue(data.fill_minimum(f, 1, 2, 19.6e6, station='LWA-SV'))
+            self.assertEqual(f.attrs['StationName'], 'lwasv')
+            
+            obs = data.get_observation_set(f, 1)
+            self.assertEqual(obs.attrs['Beam'], 2)
+            self.assertEqual(obs.attrs['sampleRate'], 19.6e6)
+            self.assertEqual(obs.attrs['sampleRate_Units'], 'samples/s')
+            self.assertRaises(RuntimeError, data.get_observation_set, f, 2)
+        finally:
+            f.close()
+            
+    def test_observation_set(self):
+        """Create and access the data sets for an observation."""
+        
+        freq = numpy.linspace(60e6, 80e6, 32)
+        f = data.create_new_file(self.filename)
+        try:
+            data.fill_minimum(f, 1, 1, 19.6e6)
+            for tuning in (1, 2):
+                data.create_observation_set(f, 1, tuning, freq+tuning, 100, ['XX', 'YY'],
+                                            chunks=(16, 32), compression='gzip')
+                                            
+            t = data.get_time(f, 1)
+            self.assertEqual(t.shape, (100,))
+            self.assertEqual(t.dtype, data.TIME_DTYPE)
+            self.assertEqual(t.chunks, (16,))
+            
+            d = data.get_data_set(f, 1, 2, 'YY')
+            self.assertEqual(d.shape, (100, 32))
+            self.assertEqual(d.chunks, (16, 32))
+            self.assertEqual(d.compression, 'gzip')
+            d[10:20,:] = 1.0
+            
+            numpy.testing.assert_array_equal(data.get_data_set(f, 1, 2, 'freq')[...], freq+2)
+            self.assertRaises(RuntimeError, data.get_data_set, f, 1, 3, 'XX')
+            self.assertRaises(RuntimeError, data.get_data_set, f, 1, 1, 'I')
+        finally:
+            f.close()
+            
+        ## Unchunked by default
+        f = data.create_new_file(self.filename)
+        try:
+            data.create_observation_set(f, 1, 1, freq, 10, ['I'])
+            self.assertTrue(data.get_data_set(f, 1, 1, 'I').chunks is None)
+        finally:
+            f.close()
+
+
+class data_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the data module
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(data_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
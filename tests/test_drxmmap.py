@@ -0,0 +1,158 @@
+"""
+Unit tests for the drxmmap module.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+import shutil
+import tempfile
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_drxmmap.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_drxmmap_tests = False
+try:
+    import drxmmap
+    from lsl.reader import errors
+    from lsl.common.dp import fS
+    if MODULE_BUILD is not None:
+        run_drxmmap_tests = True
+except ImportError:
+    pass
+
+
+_DECIMATION = 10
+_TIMETAG = 1000000
+
+
+def _make_drx(filename, nSet=50, drop=(), seed=0):
+    """
+    Write a DRX file with nSet frame sets for beam 1, with the frames in each
+    set in a random order, and return the expected (tuning/polarization, set)
+    payload values.  The sets in drop are left out and the file starts with a
+    few bytes of junk.
+    """
+    
+    ttSkip = _DECIMATION*4096
+    rng = numpy.random.default_rng(seed)
+    
+    frames = numpy.zeros(nSet*4, dtype=drxmmap.DRX_FRAME)
+    frames['sync_word'] = drxmmap.DRX_SYNC_WORD
+    frames['decimation'] = _DECIMATION
+    expected = numpy.zeros((4, nSet), dtype=numpy.uint8)
+    for i in range(nSet):
+        for j,k in enumerate(rng.permutation(4)):
+            tuning, pol = k//2 + 1, k % 2
+            frames['id'][4*i+j] = 1 | (tuning << 3) | (pol << 7)
+            frames['timetag'][4*i+j] = _TIMETAG + i*ttSkip
+            frames['tuning_word'][4*i+j] = 1000*tuning
+            frames['payload'][4*i+j] = (4*i + k) % 256
+            if i not in drop:
+                expected[k,i] = (4*i + k) % 256
+                
+    keep = numpy.ones(frames.size, dtype=bool)
+    for i in drop:
+        keep[4*i:4*(i+1)] = False
+    with open(filename, 'wb') as fh:
+        fh.write(b'\x00'*7)
+        fh.write(frames[keep].tobytes())
+    return expected
+
+
+@unittest.skipUnless(run_drxmmap_tests, "requires the drxmmap module and LSL")
+class drxmmap_tests(unittest.TestCase):
+    def setUp(self):
+        """Create a temporary directory to work in."""
+        
+        self.tempdir = tempfile.mkdtemp(prefix='test-drxmmap-')
+        self.filename = os.path.join(self.tempdir, 'test.dat')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        
+    def test_frame_ids(self):
+        """Decode the DRX ID byte."""
+        
+        beam, tune, pol = drxmmap.get_frame_ids([1 | (2 << 3) | (1 << 7), 4 | (1 << 3)])
+        numpy.testing.assert_array_equal(beam, [1, 4])
+        numpy.testing.assert_array_equal(tune, [2, 1])
+        numpy.testing.assert_array_equal(pol, [1, 0])
+        
+    def test_info(self):
+        """Describe a DRX file."""
+        
+        _make_drx(self.filename)
+        with drxmmap.DRXMemmapFile(self.filename) as idf:
+            self.assertEqual(idf.get_info('nframe'), 200)
+            self.assertEqual(idf.get_info('nbeampol'), 4)
+            self.assertEqual(idf.get_info('beam'), 1)
+            self.assertAlmostEqual(idf.get_info('sample_rate'), fS/_DECIMATION)
+            self.assertAlmostEqual(idf.get_info('freq1'), 1000*fS/2**32)
+            self.assertAlmostEqual(idf.get_info('freq2'), 2000*fS/2**32)
+            self.assertEqual(idf.get_info('start_time_samples'), _TIMETAG)
+            self.assertTrue('data_bits' in idf.get_info())
+            
+    def test_read(self):
+        """Read a DRX file with missing frames to the end."""
+        
+        expected = _make_drx(self.filename, drop=(10, 31))
+        duration = 7*4096/(fS/_DECIMATION)
+        
+        blocks = []
+        with drxmmap.DRXMemmapFile(self.filename) as idf:
+            while True:
+                try:
+                    tRead, t, data = idf.read(duration)
+                except errors.EOFError:
+                    break
+                self.assertEqual(data.shape, (4, 7*4096))
+                blocks.append(data)
+                
+        ## Always full blocks, zero-padded past the end of the file
+        self.assertEqual(len(blocks), 8)
+        self.assertAlmostEqual(tRead, 1*4096/(fS/_DECIMATION))
+        data = numpy.concatenate(blocks, axis=1).reshape(4, -1, 4096)
+        numpy.testing.assert_array_equal(data[:,:50,:], expected[:,:,None].repeat(4096, axis=2))
+        numpy.testing.assert_array_equal(data[:,50:,:], 0)
+        
+    def test_offset(self):
+        """Seek into a DRX file."""
+        
+        expected = _make_drx(self.filename)
+        with drxmmap.DRXMemmapFile(self.filename) as idf:
+            tOffset = idf.offset(15*4096/(fS/_DECIMATION))
+            self.assertAlmostEqual(tOffset, 15*4096/(fS/_DECIMATION))
+            self.assertEqual(idf.get_info('nframe'), 200-15*4)
+            self.assertEqual(idf.get_info('start_time_samples'), _TIMETAG + 15*_DECIMATION*4096)
+            
+            tRead, t, data = idf.read(4096/(fS/_DECIMATION))
+            numpy.testing.assert_array_equal(data[:,0], expected[:,15])
+            
+    def test_sync_error(self):
+        """Open a file that is not DRX data."""
+        
+        with open(self.filename, 'wb') as fh:
+            fh.write(b'\x00'*8192)
+        self.assertRaises(errors.SyncError, drxmmap.DRXMemmapFile, self.filename)
+
+
+class drxmmap_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the drxmmap module
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(drxmmap_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+"""
+Unit tests for the kernels in the _helper extension.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_helper.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_helper_tests = False
+try:
+    import _helper
+    from singlepulseio import _density_pyramid
+    if MODULE_BUILD is not None:
+        run_helper_tests = True
+except ImportError:
+    pass
+
+
+def _fdmt(waterfall, freqRange, nDelays):
+    """
+    Straightforward port of the reference FDMT implementation from Zackay &
+    Ofek (2017, ApJ, 835, 11) for checking _helper.FastFDMT.
+    """
+    
+    nChan, nSamps = waterfall.shape
+    fLow, fHigh = freqRange
+    norm = 1.0/fLow**2 - 1.0/fHigh**2
+    chanWidth = (fHigh - fLow) / nChan
+    
+    # Initialization - partial sums along each channel
+    nDT = int(numpy.ceil((nDelays-1)*(1.0/fLow**2 - 1.0/(fLow+chanWidth)**2)/norm))
+    state = numpy.zeros((nChan, nDT+1, nSamps), dtype=numpy.float64)
+    state[:,0,:] = waterfall
+    for i in range(1, nDT+1):
+        state[:,i,i:] = state[:,i-1,i:] + waterfall[:,:-i]
+        
+    # Iterations - combine pairs of sub-bands
+    n = 1
+    while state.shape[0] > 1:
+        nSub = state.shape[0] // 2
+        subWidth = (fHigh - fLow) / nSub
+        nDT = int(numpy.ceil((nDelays-1)*(1.0/fLow**2 - 1.0/(fLow+subWidth)**2)/norm))
+        output = numpy.zeros((nSub, nDT+1, nSamps), dtype=numpy.float64)
+        for j in range(nSub):
+            fStart = fLow + j*subWidth
+            fStop = fStart + subWidth
+            fMid = (fStop - fStart)/2.0 + fStart - chanWidth/2.0
+            fMidL = (fStop - fStart)/2.0 + fStart + chanWidth/2.0
+            nDTLocal = int(numpy.ceil((nDelays-1)*(1.0/fStart**2 - 1.0/fStop**2)/norm))
+            for i in range(nDTLocal+1):
+                dtMid = int(round(i*(1.0/fMid**2 - 1.0/fStart**2)/(1.0/fStop**2 - 1.0/fStart**2)))
+                dtMidL = int(round(i*(1.0/fMidL**2 - 1.0/fStart**2)/(1.0/fStop**2 - 1.0/fStart**2)))
+                dtRest = i - dtMidL
+                output[j,i,:dtMidL] = state[2*j,dtMid,:dtMidL]
+                output[j,i,dtMidL:] = state[2*j,dtMid,dtMidL:] + state[2*j+1,dtRest,:nSamps-dtMidL]
+        state = output
+        n += 1
+        
+    return state[0,:nDelays,:]
+
+
+@unittest.skipUnless(run_helper_tests, "requires the _helper extension")
+class helper_tests(unittest.TestCase):
+    def test_density_pyramid(self):
+        """Build a density grid with FastDensityPyramid."""
+        
+        rng = numpy.random.default_rng(0)
+        nPulse = 50000
+        time = numpy.sort(rng.uniform(-5, 605, nPulse)).astype(numpy.float32)
+        dm = rng.uniform(-1, 101, nPulse).astype(numpy.float32)
+        snr = rng.uniform(5, 20, nPulse).astype(numpy.float32)
+        time[:10] = 0.0
+        time[-10:] = 600.0
+        
+        fast = _helper.FastDensityPyramid(time, dm, snr, (0.0, 600.0), (0.0, 100.0), 256, 64, nLevels=5)
+        slow = _density_pyramid(time, dm, snr, (0.0, 600.0), (0.0, 100.0), 256, 64, nLevels=5)
+        self.assertEqual(len(fast), len(slow))
+        for (fCount,fPeak),(sCount,sPeak) in zip(fast, slow):
+            self.assertEqual(fCount.dtype, numpy.int32)
+            self.assertEqual(fPeak.dtype, numpy.float32)
+            numpy.testing.assert_array_equal(fCount, sCount)
+            numpy.testing.assert_array_equal(fPeak, sPeak)
+            
+    def test_incoherent_dedispersion(self):
+        """Dedisperse spectra with FastIncoherentDedispersion."""
+        
+        rng = numpy.random.default_rng(1)
+        nSamps, nPol, nChans = 500, 2, 32
+        spec = rng.normal(10, 1, size=(nSamps, nPol, nChans)).astype(numpy.float32)
+        mask = numpy.zeros(spec.shape, dtype=bool)
+        mask[:,:,5] = True
+        mask[100:110,1,20] = True
+        delays = numpy.linspace(40, 0, nChans).round().astype(numpy.int32)
+        bandpass = rng.uniform(0.5, 1.5, size=(nPol, nChans)).astype(numpy.float32)
+        
+        specD, specBD, prof, profB = _helper.FastIncoherentDedispersion(spec, mask, delays, bandpass)
+        
+        ## Shift each channel back by its delay and fill in what wraps around
+        ## or is masked
+        expected = numpy.where(mask, numpy.nan, spec)
+        for k in range(nChans):
+            expected[:,:,k] = numpy.roll(expected[:,:,k], -delays[k], axis=0)
+            if delays[k] > 0:
+                expected[-delays[k]:,:,k] = numpy.nan
+        numpy.testing.assert_array_equal(specD, expected)
+        numpy.testing.assert_allclose(specBD, expected / bandpass, rtol=1e-6)
+        
+        ## Profiles are NaN where any channel has run off of the end of the data
+        expectedProf = numpy.nansum(expected, axis=2)
+        expectedProf[nSamps-delays.max():,:] = numpy.nan
+        numpy.testing.assert_allclose(prof, expectedProf, rtol=1e-5)
+        expectedProfB = numpy.nansum(expected / bandpass, axis=2)
+        expectedProfB[nSamps-delays.max():,:] = numpy.nan
+        numpy.testing.assert_allclose(profB, expectedProfB, rtol=1e-5)
+        
+        self.assertRaises(ValueError, _helper.FastIncoherentDedispersion, spec, mask, delays[:-1], bandpass)
+        
+    def test_fdmt(self):
+        """Compute a DM-time plane with FastFDMT."""
+        
+        rng = numpy.random.default_rng(2)
+        nChan, nSamps, nDelays = 64, 1024, 150
+        waterfall = rng.normal(size=(nChan, nSamps)).astype(numpy.float32)
+        
+        plane = _helper.FastFDMT(waterfall, (60.0, 80.0), nDelays)
+        self.assertEqual(plane.shape, (nDelays, nSamps))
+        numpy.testing.assert_allclose(plane, _fdmt(waterfall, (60.0, 80.0), nDelays), atol=1e-4)
+        
+        ## A dispersed pulse ends up close to its delay and arrival time at the
+        ## bottom of the band with most of the channels summed
+        waterfall[...] = 0
+        fCenter = 60.0 + (numpy.arange(nChan) + 0.5)*20.0/nChan
+        norm = 1.0/60.0**2 - 1.0/80.0**2
+        shifts = numpy.round(100*(1.0/60.0**2 - 1.0/fCenter**2)/norm).astype(int)
+        waterfall[numpy.arange(nChan),500-shifts] = 1.0
+        plane = _helper.FastFDMT(waterfall, (60.0, 80.0), nDelays)
+        i, j = numpy.unravel_index(numpy.argmax(plane), plane.shape)
+        self.assertTrue(abs(i - 100) <= 3 and abs(j - 500) <= 2)
+        self.assertTrue(plane[i,j] >= 0.8*nChan)
+
+
+class helper_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the _helper extension
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(helper_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
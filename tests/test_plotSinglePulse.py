@@ -0,0 +1,84 @@
+"""
+Unit tests for the non-GUI parts of plotSinglePulse.py.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_plotSinglePulse.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_plotsinglepulse_tests = False
+try:
+    import plotSinglePulse
+    if MODULE_BUILD is not None:
+        run_plotsinglepulse_tests = True
+except ImportError:
+    pass
+
+
+def _make_pulse(freq, tInt, nSamps, dm, t0, seed=0):
+    """
+    Build a (time, channel) masked array of noise with a dispersed pulse that
+    arrives at the top of the band at t0.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    spec = rng.normal(size=(nSamps, freq.size)).astype(numpy.float32)
+    
+    chanWidth = abs(freq[-1] - freq[0]) / (freq.size - 1)
+    fTop = (freq.max() + chanWidth/2.0) / 1e6
+    delays = plotSinglePulse._D*dm*(1.0/(freq/1e6)**2 - 1.0/fTop**2)
+    spec[numpy.round((t0 + delays)/tInt).astype(int),numpy.arange(freq.size)] += 20.0
+    
+    spec = numpy.ma.array(spec, mask=numpy.zeros(spec.shape, dtype=bool))
+    spec.mask[:,7] = True
+    return spec
+
+
+@unittest.skipUnless(run_plotsinglepulse_tests, "requires the plotSinglePulse.py dependencies")
+class plotsinglepulse_tests(unittest.TestCase):
+    def test_dmtime_plane(self):
+        """Recover a dispersed pulse from the DM-time plane."""
+        
+        tInt = 0.01
+        for nChan,reverse in ((1024, False), (1025, False), (1025, True), (300, False)):
+            freq = numpy.linspace(10e6, 30e6, nChan)
+            spec = _make_pulse(freq, tInt, 4000, 0.3, 5.0)
+            if reverse:
+                freq = freq[::-1]
+                spec = spec[:,::-1]
+                
+            plane, dms, decimation = plotSinglePulse.getDMTimePlane(spec, freq, tInt, 0.5)
+            self.assertEqual(plane.shape, (dms.size, 4000//decimation))
+            self.assertTrue(dms[-1] >= 0.5)
+            
+            ## The DM axis comes from the actual band, not a padded one
+            fLow, fHigh = (freq.min() - 10e6/(nChan-1))/1e6, (freq.max() + 10e6/(nChan-1))/1e6
+            numpy.testing.assert_allclose(dms[1], decimation*tInt/(plotSinglePulse._D*(1.0/fLow**2 - 1.0/fHigh**2)))
+            
+            i, j = numpy.unravel_index(numpy.nanargmax(plane), plane.shape)
+            self.assertTrue(abs(dms[i] - 0.3) <= 2*dms[1])
+            self.assertTrue(abs(j*decimation*tInt - 5.0) <= decimation*tInt)
+
+
+class plotsinglepulse_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the plotSinglePulse.py
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(plotsinglepulse_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Unit tests for the kernels in the _psr extension.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_psr.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_psr_tests = False
+try:
+    import _psr
+    if MODULE_BUILD is not None:
+        run_psr_tests = True
+except ImportError:
+    pass
+
+
+def _make_signals(nStand, nSamps, seed=0):
+    """
+    Build a (stands, samples) complex64 array of random 4+4-bit samples.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    i = rng.integers(-8, 8, size=(nStand, nSamps))
+    q = rng.integers(-8, 8, size=(nStand, nSamps))
+    return (i + 1j*q).astype(numpy.complex64)
+
+
+@unittest.skipUnless(run_psr_tests, "requires the _psr extension")
+class psr_tests(unittest.TestCase):
+    def test_pulsar_engine_prev(self):
+        """Channelize across the boundary with the previous block."""
+        
+        LFFT = 64
+        prev = _make_signals(4, 300, seed=1)
+        signals = _make_signals(4, 20*LFFT, seed=2)
+        full = numpy.concatenate([prev, signals], axis=1)
+        
+        for offset in (0, 1, 137, 300):
+            specP = _psr.PulsarEngineRaw(signals, LFFT, prevSignals=prev, offset=offset)
+            self.assertEqual(specP.shape, (4, LFFT, 20))
+            spec = _psr.PulsarEngineRaw(full[:,offset:offset+20*LFFT], LFFT)
+            numpy.testing.assert_allclose(specP, spec, rtol=1e-5, atol=1e-5)
+            
+        ## Without the previous block the offset shortens the data
+        specO = _psr.PulsarEngineRaw(signals, LFFT, offset=10)
+        self.assertEqual(specO.shape, (4, LFFT, 19))
+        numpy.testing.assert_allclose(specO, _psr.PulsarEngineRaw(signals[:,10:10+19*LFFT], LFFT), rtol=1e-5, atol=1e-5)
+        
+        self.assertRaises(ValueError, _psr.PulsarEngineRaw, signals, LFFT, prevSignals=prev, offset=301)
+        self.assertRaises(ValueError, _psr.PulsarEngineRaw, signals, LFFT, offset=-1)
+        
+    def test_pulsar_engine_packed(self):
+        """Channelize packed 4+4-bit samples."""
+        
+        LFFT = 64
+        signals = _make_signals(4, 20*LFFT, seed=3)
+        packed = ((signals.real.astype(numpy.int8) & 0xF) << 4) | (signals.imag.astype(numpy.int8) & 0xF)
+        packed = packed.view(numpy.uint8)
+        
+        spec = _psr.PulsarEngineRaw(signals, LFFT)
+        numpy.testing.assert_array_equal(_psr.PulsarEngineRaw(packed, LFFT), spec)
+        
+        ## Also across the boundary with the previous block
+        specP = _psr.PulsarEngineRaw(packed[:,5*LFFT:], LFFT, prevSignals=packed[:,:5*LFFT], offset=3*LFFT+7)
+        numpy.testing.assert_array_equal(specP, _psr.PulsarEngineRaw(signals[:,3*LFFT+7:18*LFFT+7], LFFT))
+        
+    def test_pseudo_sk_mask(self):
+        """Compute the pseudo-SK mask for 2-D and 3-D power data."""
+        
+        rng = numpy.random.default_rng(4)
+        nFFT, nStand, LFFT, skN = 256, 4, 128, 8
+        power = rng.gamma(skN, size=(nFFT, nStand, LFFT)).astype(numpy.float32)
+        power[:,1,10] = 5.0
+        power[::16,2,50] *= 20
+        
+        ## Expected mask from the moments
+        s1 = power.sum(axis=0, dtype=numpy.float64)
+        s2 = (power.astype(numpy.float64)**2).sum(axis=0)
+        sk = (nFFT*s2/s1**2 - 1.0) * (nFFT*skN + 1.0)/(nFFT - 1.0)
+        lower, upper = 0.8, 1.2
+        expected = ((sk >= lower) & (sk <= upper)).astype(numpy.float32)
+        self.assertEqual(expected[1,10], 0)
+        self.assertEqual(expected[2,50], 0)
+        
+        ## 3-D (integrations, stands, channels) float32 blocks
+        mask3 = _psr.ComputePseudoSKMask(power, LFFT, 1.0*skN, lower, upper)
+        self.assertEqual(mask3.dtype, numpy.float32)
+        close = (numpy.abs(sk - lower) < 1e-6) | (numpy.abs(sk - upper) < 1e-6)
+        numpy.testing.assert_array_equal(mask3[~close], expected[~close])
+        
+        ## Same as the 2-D (stands, integrations*channels) float64 estimator
+        power2 = power.transpose(1, 0, 2).reshape(nStand, nFFT*LFFT).astype(numpy.float64)
+        mask2 = _psr.ComputePseudoSKMask(power2, LFFT, 1.0*skN, lower, upper)
+        numpy.testing.assert_array_equal(mask3, mask2)
+        
+        self.assertRaises(RuntimeError, _psr.ComputePseudoSKMask, power, LFFT//2, 1.0*skN, lower, upper)
+        
+    def test_sk_moments(self):
+        """Compute the spectral kurtosis moments."""
+        
+        LFFT = 64
+        signals = _make_signals(4, 50*LFFT, seed=5)
+        spec = _psr.PulsarEngineRaw(signals, LFFT)
+        
+        power = numpy.abs(spec.astype(numpy.complex128))**2
+        moments = _psr.ComputeSKMoments(spec)
+        self.assertEqual(moments.shape, (2, 4, LFFT))
+        self.assertEqual(moments.dtype, numpy.float32)
+        numpy.testing.assert_allclose(moments[0], power.sum(axis=2), rtol=1e-5)
+        numpy.testing.assert_allclose(moments[1], (power**2).sum(axis=2), rtol=1e-5)
+        
+        ## Into an existing array
+        out = numpy.zeros((2, 4, LFFT), dtype=numpy.float32)
+        _psr.ComputeSKMoments(spec, moments=out)
+        numpy.testing.assert_array_equal(out, moments)
+        self.assertRaises(RuntimeError, _psr.ComputeSKMoments, spec, moments=out[:,:2,:])
+
+
+class psr_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the _psr extension
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(psr_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
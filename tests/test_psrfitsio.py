@@ -0,0 +1,187 @@
+"""
+Unit tests for the psrfitsio module.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+import shutil
+import tempfile
+from astropy.io import fits as astrofits
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_psrfitsio.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_psrfitsio_tests = False
+try:
+    import psrfitsio
+    if MODULE_BUILD is not None:
+        run_psrfitsio_tests = True
+except ImportError:
+    pass
+
+
+def _make_psrfits(filename, nRows=12, nsblk=32, nchan=16, npol=2, nbits=8, tsub=0.01, seed=0):
+    """
+    Write a small search mode PSRFITS file and return a two-element tuple of
+    the decoded data, as a (time, polarization, channel) float32 array, and the
+    channel weights.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    nlev = 2**nbits
+    
+    # Samples are stored as (row, sample, channel, polarization)
+    samples = rng.integers(0, nlev, size=(nRows, nsblk, nchan, npol), dtype=numpy.uint8)
+    offs = rng.normal(size=(nRows, nchan, npol)).astype(numpy.float32)
+    scl = rng.uniform(0.5, 2.0, size=(nRows, nchan, npol)).astype(numpy.float32)
+    wts = numpy.ones((nRows, nchan), dtype=numpy.float32)
+    wts[:,3] = 0
+    wts[5,7] = 0
+    
+    raw = samples.reshape(nRows, -1)
+    if nbits == 4:
+        raw = (raw[:,0::2] << 4) | raw[:,1::2]
+        
+    cols = [astrofits.Column(name='TSUBINT', format='D', array=numpy.full(nRows, tsub)),
+            astrofits.Column(name='OFFS_SUB', format='D', array=(numpy.arange(nRows)+0.5)*tsub),
+            astrofits.Column(name='DAT_FREQ', format=f"{nchan}D", array=numpy.tile(numpy.linspace(60, 70, nchan), (nRows, 1))),
+            astrofits.Column(name='DAT_WTS', format=f"{nchan}E", array=wts),
+            astrofits.Column(name='DAT_OFFS', format=f"{nchan*npol}E", array=offs.reshape(nRows, -1)),
+            astrofits.Column(name='DAT_SCL', format=f"{nchan*npol}E", array=scl.reshape(nRows, -1)),
+            astrofits.Column(name='DATA', format=f"{raw.shape[1]}B", array=raw)]
+    subint = astrofits.BinTableHDU.from_columns(cols, name='SUBINT')
+    for key,value in (('NBITS', nbits), ('NSBLK', nsblk), ('NCHAN', nchan), ('NPOL', npol), ('TBIN', tsub/nsblk)):
+        subint.header[key] = value
+    astrofits.HDUList([astrofits.PrimaryHDU(), subint]).writeto(filename, overwrite=True)
+    
+    data = samples*scl[:,None,:,:] + offs[:,None,:,:]
+    data = data.transpose(0, 1, 3, 2).reshape(nRows*nsblk, npol, nchan)
+    return data.astype(numpy.float32), wts
+
+
+@unittest.skipUnless(run_psrfitsio_tests, "requires the psrfitsio module")
+class psrfitsio_tests(unittest.TestCase):
+    def setUp(self):
+        """Create a temporary directory to work in."""
+        
+        self.tempdir = tempfile.mkdtemp(prefix='test-psrfitsio-')
+        self.filename = os.path.join(self.tempdir, 'test.fits')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        
+    def test_read_subints(self):
+        """Decode 8-bit and 4-bit data."""
+        
+        for nbits in (8, 4):
+            data, wts = _make_psrfits(self.filename, nbits=nbits)
+            with astrofits.open(self.filename, memmap=True) as hdulist:
+                numpy.testing.assert_allclose(psrfitsio.read_subints(hdulist), data, rtol=1e-6)
+                numpy.testing.assert_allclose(psrfitsio.read_subints(hdulist, 2, 5), data[2*32:5*32], rtol=1e-6)
+                numpy.testing.assert_allclose(psrfitsio.read_subints(hdulist, 1, 11, nthreads=3), data[32:11*32], rtol=1e-6)
+                
+                out = numpy.zeros((3*32, 2, 16), dtype=numpy.float32)
+                psrfitsio.read_subints(hdulist, 4, 7, out=out)
+                numpy.testing.assert_allclose(out, data[4*32:7*32], rtol=1e-6)
+                self.assertRaises(ValueError, psrfitsio.read_subints, hdulist, 4, 8, out=out)
+                self.assertRaises(ValueError, psrfitsio.read_subints, hdulist, 8, 4)
+                
+    def test_read_subints_fill(self):
+        """Decode data with the flagged channels filled in."""
+        
+        data, wts = _make_psrfits(self.filename)
+        with astrofits.open(self.filename, memmap=True) as hdulist:
+            filled = psrfitsio.read_subints(hdulist, fill_value=0.0)
+            
+        flagged = numpy.repeat(wts < 0.5, 32, axis=0)[:,None,:].repeat(2, axis=1)
+        numpy.testing.assert_array_equal(filled[flagged], 0.0)
+        numpy.testing.assert_allclose(filled[~flagged], data[~flagged], rtol=1e-6)
+        
+    def test_read_metadata(self):
+        """Read the weights, sample times, and row numbers."""
+        
+        data, wts = _make_psrfits(self.filename)
+        with astrofits.open(self.filename, memmap=True) as hdulist:
+            numpy.testing.assert_array_equal(psrfitsio.read_weights(hdulist, 2, 6), wts[2:6])
+            
+            t = psrfitsio.read_sample_times(hdulist, 1, 3)
+            self.assertEqual(t.size, 2*32)
+            numpy.testing.assert_allclose(numpy.diff(t), 0.01/32)
+            self.assertAlmostEqual(t[16], 0.015, 9)
+            
+            numpy.testing.assert_array_equal(psrfitsio.read_row_numbers(hdulist), numpy.arange(12))
+            
+    def test_write_weights(self):
+        """Update the weights in place."""
+        
+        data, wts = _make_psrfits(self.filename)
+        with open(self.filename, 'rb') as fh:
+            before = fh.read()
+            
+        newWts = numpy.ones((3, 16), dtype=numpy.float32)
+        newWts[:,9] = 0
+        with astrofits.open(self.filename, memmap=True) as hdulist:
+            fd = os.open(self.filename, os.O_WRONLY)
+            try:
+                psrfitsio.write_weights(fd, hdulist, 4, 7, newWts)
+                psrfitsio.write_weights(fd, hdulist, 10, 12, numpy.zeros(16), layout=psrfitsio.get_column_layout(hdulist, 'DAT_WTS'))
+            finally:
+                os.close(fd)
+                
+        wts[4:7] = newWts
+        wts[10:12] = 0
+        with astrofits.open(self.filename) as hdulist:
+            numpy.testing.assert_array_equal(psrfitsio.read_weights(hdulist), wts)
+            numpy.testing.assert_allclose(psrfitsio.read_subints(hdulist), data, rtol=1e-6)
+            offset, rowSize, colType = psrfitsio.get_column_layout(hdulist, 'DAT_WTS')
+            
+        ## Nothing else in the file changes
+        with open(self.filename, 'rb') as fh:
+            after = fh.read()
+        self.assertEqual(len(after), len(before))
+        changed = numpy.flatnonzero(numpy.frombuffer(before, dtype=numpy.uint8) != numpy.frombuffer(after, dtype=numpy.uint8))
+        self.assertTrue((((changed - offset) % rowSize) < 16*colType.itemsize).all())
+        
+    def test_skstats(self):
+        """Write and read a spectral kurtosis moments sidecar file."""
+        
+        skname = psrfitsio.get_skstats_filename(self.filename)
+        self.assertEqual(skname, os.path.join(self.tempdir, 'test.skstats'))
+        
+        rng = numpy.random.default_rng(0)
+        moments = rng.uniform(size=(5, 2, 2, 16)).astype(numpy.float32)
+        with psrfitsio.SKStatsWriter(skname, 2, 16, 256) as sk:
+            for i in range(5):
+                sk.write(10+i, moments[i])
+                
+        nfft, rows, s1, s2 = psrfitsio.read_skstats(skname)
+        self.assertEqual(nfft, 256)
+        numpy.testing.assert_array_equal(rows, numpy.arange(10, 15))
+        numpy.testing.assert_array_equal(s1, moments[:,0])
+        numpy.testing.assert_array_equal(s2, moments[:,1])
+        
+        with open(skname, 'r+b') as fh:
+            fh.write(b'NOTSKSTA')
+        self.assertRaises(ValueError, psrfitsio.read_skstats, skname)
+
+
+class psrfitsio_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the psrfitsio module
+    tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(psrfitsio_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ import sys
 import glob
 import numpy
 import subprocess
+from astropy.io import fits as astrofits
 
 
 _URL = 'https://lda10g.alliance.unm.edu/tutorial/UnknownPulsar/056227_000024985_DRX.dat'
@@ -38,7 +39,7 @@ class pulsar_tests(unittest.TestCase):
                                    '-o', _FILENAME, '--create-dirs'])
             
     def tearDown(self):
-        for filename in glob.glob('*.fits'):
+        for filename in glob.glob('*.fits')+glob.glob('*.skstats'):
             try:
                 os.unlink(filename)
             except OSError:
@@ -48,6 +49,42 @@ class pulsar_tests(unittest.TestCase):
             os.unlink('script.log')
         except OSError:
             pass
+            
+    def _get_subint_times(self, script, output, *extra):
+        """Run a conversion and return the start time of each sub-integration,
+        as the file epoch plus OFFS_SUB, for the first tuning."""
+        
+        cmd = [sys.executable, script, '--source=B1919+21', '--ra=19:21:44.815', '--dec=21:53:02.25',
+               f"--output={output}"]
+        cmd.extend(extra)
+        cmd.append(_FILENAME)
+        with open('script.log', 'w') as logfile:
+            subprocess.check_call(cmd, stdout=logfile)
+            
+        times = []
+        for filename in sorted(glob.glob(f"{output}_*t1_*.fits")):
+            with astrofits.open(filename) as hdulist:
+                epoch = hdulist[0].header['STT_SMJD'] + hdulist[0].header['STT_OFFS']
+                epoch += (hdulist[0].header['STT_IMJD'] - 50000)*86400.0
+                times.extend(epoch + hdulist[1].data.field('OFFS_SUB'))
+        return numpy.array(times)
+        
+    def test_writePsrfits2_segments(self):
+        """Times of the sub-integrations from a segmented writePsrfits2.py run."""
+        
+        serial = self._get_subint_times('../writePsrfits2.py', 'serial', '--nsblk=32')
+        segmented = self._get_subint_times('../writePsrfits2.py', 'segmented', '--nsblk=32', '--segments=2')
+        self.assertEqual(serial.size, segmented.size)
+        numpy.testing.assert_allclose(segmented, serial, rtol=0, atol=1e-6)
+        
+    def test_writePsrfits2D_segments(self):
+        """Times of the sub-integrations from a segmented writePsrfits2D.py run."""
+        
+        serial = self._get_subint_times('../writePsrfits2D.py', 'serial', '12.455')
+        segmented = self._get_subint_times('../writePsrfits2D.py', 'segmented', '--segments=2', '12.455')
+        self.assertEqual(serial.size, segmented.size)
+        numpy.testing.assert_allclose(segmented, serial, rtol=0, atol=1e-6)
+
 
 def _test_generator(script):
     """
@@ -75,18 +112,25 @@ def _test_generator(script):
 
 
 def _name_to_name(filename):
+    flags = [f[2:].replace('-', '_') for f in filename.split()[1:] if f.startswith('--') and f.find('=') == -1]
     filename = filename.split()[0]
     filename = os.path.splitext(filename)[0]
     parts = filename.split(os.path.sep)
     start = parts.index('..')
     parts = parts[start+1:]
+    parts.extend(flags)
     return '_'.join(parts)
 
 
 if run_scripts_tests:
     _SCRIPTS = ['../drx2drxi.py', 
                 '../writePsrfits2.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25',
-                '../writePsrfits2D.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 12.455']
+                '../writePsrfits2.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 --mmap',
+                '../writePsrfits2.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 --sk-stats',
+                '../writePsrfits2D.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 12.455',
+                '../writePsrfits2D.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 --mmap 12.455',
+                '../writePsrfits2D.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 --sk-stats 12.455',
+                '../writePsrfits2Multi.py --source=B1919+21 --ra=19:21:44.815 --dec=21:53:02.25 --yes --combine']
     _SCRIPTS.sort()
     for script in _SCRIPTS:
         test = _test_generator(script)
@@ -85,16 +85,19 @@ def _test_generator(script):
 
 
 def _name_to_name(filename):
+    flags = [f[2:].replace('-', '_') for f in filename.split()[1:] if f.startswith('--') and f.find('=') == -1]
     filename = filename.split()[0]
     filename = os.path.splitext(filename)[0]
     parts = filename.split(os.path.sep)
     start = parts.index('..')
     parts = parts[start+1:]
+    parts.extend(flags)
     return '_'.join(parts)
 
 
 if run_scripts_tests:
-    _SCRIPTS = ['../writeHDF5FromPsrfits.py', '../updatePsrfitsMask.py']
+    _SCRIPTS = ['../writeHDF5FromPsrfits.py', '../updatePsrfitsMask.py',
+                '../updatePsrfitsMask.py --jobs 2']
     _SCRIPTS.sort()
     for script in _SCRIPTS:
         test = _test_generator(script)
@@ -48,6 +48,7 @@ _SAFE_TO_IGNORE = ["Possible",
                    "Undefined variable 'PulsarEngineRawWindow",
                    "Undefined variable 'PhaseRotator",
                    "Undefined variable 'ComputeSKMask",
+                   "Undefined variable 'ComputeSKMoments",
                    "Undefined variable 'ComputePseudoSKMask",
                    "Undefined variable 'MultiChannelCD",
                    "Undefined variable 'CombineToIntensity",
@@ -0,0 +1,240 @@
+"""
+Unit tests for the singlepulseio module.
+"""
+
+import unittest
+import os
+import sys
+import numpy
+import shutil
+import tarfile
+import tempfile
+
+
+currentDir = os.path.abspath(os.getcwd())
+if os.path.exists(os.path.join(currentDir, 'test_singlepulseio.py')):
+    MODULE_BUILD = os.path.join(currentDir, '..')
+    sys.path.insert(0, MODULE_BUILD)
+else:
+    MODULE_BUILD = None
+
+run_singlepulseio_tests = False
+try:
+    import singlepulseio
+    if MODULE_BUILD is not None:
+        run_singlepulseio_tests = True
+except ImportError:
+    pass
+
+
+def _make_pulses(nPulse, seed=0):
+    """
+    Build a time-sorted set of random pulses with the same columns as
+    singlepulseio.read_singlepulse().
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    pulses = numpy.zeros((nPulse, singlepulseio.SINGLEPULSE_COLUMNS), dtype=numpy.float32)
+    pulses[:,0] = rng.uniform(0, 100, nPulse)
+    pulses[:,1] = rng.uniform(5, 20, nPulse)
+    pulses[:,2] = numpy.sort(rng.uniform(0, 600, nPulse))
+    pulses[:,3] = numpy.round(pulses[:,2] / 1e-3)
+    pulses[:,4] = rng.integers(1, 30, nPulse)
+    return pulses
+
+
+def _write_singlepulse(filename, pulses):
+    """
+    Write a set of pulses out in the same format as PRESTO's
+    single_pulse_search.py.
+    """
+    
+    with open(filename, 'w') as fh:
+        fh.write("# DM      Sigma      Time (s)     Sample    Downfact\n")
+        for dm,sigma,t,sample,downfact in pulses:
+            fh.write("%7.2f %7.2f %13.6f %10d %3d\n" % (dm, sigma, t, sample, downfact))
+
+
+@unittest.skipUnless(run_singlepulseio_tests, "requires the singlepulseio module")
+class singlepulseio_tests(unittest.TestCase):
+    def setUp(self):
+        """Create a temporary directory to work in."""
+        
+        self.tempdir = tempfile.mkdtemp(prefix='test-singlepulseio-')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        
+    def _write_files(self, nFile=3, nPulse=50):
+        """Write out a set of .singlepulse files, plus a .inf file for the
+        first one, and return their names and the pulses."""
+        
+        filenames, pulses = [], []
+        for i in range(nFile):
+            filename = os.path.join(self.tempdir, 'test_DM%i.00.singlepulse' % i)
+            part = _make_pulses(nPulse, seed=i)
+            _write_singlepulse(filename, part)
+            filenames.append(filename)
+            pulses.append(part)
+        with open(os.path.join(self.tempdir, 'test_DM0.00.inf'), 'w') as fh:
+            fh.write(" Data file name without suffix          =  test_DM0.00\n")
+        return filenames, numpy.concatenate(pulses)
+        
+    def test_read_singlepulse(self):
+        """Read in a .singlepulse file."""
+        
+        filenames, pulses = self._write_files(nFile=1)
+        data = singlepulseio.read_singlepulse(filenames[0])
+        self.assertEqual(data.dtype, numpy.float32)
+        numpy.testing.assert_allclose(data, pulses, atol=1e-2)
+        
+    def test_read_singlepulse_empty(self):
+        """Read in a .singlepulse file with no pulses."""
+        
+        filename = os.path.join(self.tempdir, 'empty.singlepulse')
+        _write_singlepulse(filename, [])
+        data = singlepulseio.read_singlepulse(filename)
+        self.assertEqual(data.shape, (0, singlepulseio.SINGLEPULSE_COLUMNS))
+        
+    def test_read_singlepulse_files(self):
+        """Read in a collection of .singlepulse files, with and without a pool."""
+        
+        filenames, pulses = self._write_files(nFile=20, nPulse=10)
+        serial = singlepulseio.read_singlepulse_files(filenames, nproc=1)
+        numpy.testing.assert_allclose(serial, pulses, atol=1e-2)
+        parallel = singlepulseio.read_singlepulse_files(filenames, nproc=2)
+        numpy.testing.assert_array_equal(parallel, serial)
+        
+    def test_cache(self):
+        """Save and load a binary cache of pulses."""
+        
+        filenames, pulses = self._write_files()
+        cachename = singlepulseio.get_cache_filename(filenames)
+        self.assertEqual(os.path.dirname(cachename), self.tempdir)
+        self.assertEqual(cachename, singlepulseio.get_cache_filename(filenames))
+        self.assertTrue(singlepulseio.load_cache(cachename) is None)
+        
+        self.assertTrue(singlepulseio.save_cache(cachename, pulses, os.path.join(self.tempdir, 'test_DM0.00.inf')))
+        data, infname = singlepulseio.load_cache(cachename)
+        numpy.testing.assert_array_equal(data, pulses)
+        self.assertTrue(os.path.exists(infname))
+        del data
+        
+        ## Changing one of the files changes the cache name
+        _write_singlepulse(filenames[1], pulses[:10])
+        self.assertNotEqual(cachename, singlepulseio.get_cache_filename(filenames))
+        
+    def test_read_singlepulse_tarball(self):
+        """Read in .singlepulse files from a compressed tarball."""
+        
+        filenames, pulses = self._write_files()
+        tarname = os.path.join(self.tempdir, 'test.tar.gz')
+        with tarfile.open(tarname, 'w:gz') as tf:
+            for filename in filenames+[os.path.join(self.tempdir, 'test_DM0.00.inf'),]:
+                tf.add(filename, arcname=os.path.basename(filename))
+                
+        self.assertTrue(singlepulseio.is_tarball(tarname))
+        for nproc in (1, 2):
+            data, inf = singlepulseio.read_singlepulse_tarball(tarname, nproc=nproc)
+            numpy.testing.assert_allclose(data, pulses, atol=1e-2)
+            self.assertTrue(inf.find(b'test_DM0.00') != -1)
+            
+    def test_read_singlepulse_tarball_error(self):
+        """Read in a truncated tarball."""
+        
+        filenames, pulses = self._write_files()
+        tarname = os.path.join(self.tempdir, 'test.tar.gz')
+        with tarfile.open(tarname, 'w:gz') as tf:
+            for filename in filenames:
+                tf.add(filename, arcname=os.path.basename(filename))
+        with open(tarname, 'rb') as fh:
+            contents = fh.read()
+        with open(tarname, 'wb') as fh:
+            fh.write(contents[:len(contents)//2])
+            
+        with self.assertRaises((tarfile.TarError, EOFError, OSError)):
+            singlepulseio.read_singlepulse_tarball(tarname, nproc=1)
+            
+    def test_index_select(self):
+        """Select pulses by time and DM with a PulseIndex."""
+        
+        pulses = _make_pulses(20000)
+        index = singlepulseio.PulseIndex(pulses, 8.0, 2, 20)
+        passed = (pulses[:,1] >= 8.0) & (pulses[:,4] >= 2) & (pulses[:,4] <= 20)
+        
+        for tLow,tHigh,dmLow,dmHigh in ((0, 600, None, None), (100, 200, 10, 20), (50.5, 51.5, 0, 100), (700, 800, None, None)):
+            expected = (pulses[:,2] >= tLow) & (pulses[:,2] <= tHigh)
+            if dmLow is not None:
+                expected &= (pulses[:,0] >= dmLow) & (pulses[:,0] <= dmHigh)
+            numpy.testing.assert_array_equal(index.select(tLow, tHigh, dmLow, dmHigh),
+                                             numpy.flatnonzero(expected & passed))
+            numpy.testing.assert_array_equal(index.select(tLow, tHigh, dmLow, dmHigh, thresholded=False),
+                                             numpy.flatnonzero(expected))
+                                             
+    def test_index_select_dm(self):
+        """Select pulses by DM alone with a PulseIndex."""
+        
+        pulses = _make_pulses(20000)
+        index = singlepulseio.PulseIndex(pulses, 8.0, 2, 20)
+        expected = numpy.flatnonzero((pulses[:,0] >= 40) & (pulses[:,0] <= 45))
+        numpy.testing.assert_array_equal(index.select_dm(40, 45), expected)
+        
+    def test_index_nearest(self):
+        """Find the closest pulse with a PulseIndex."""
+        
+        pulses = _make_pulses(20000)
+        index = singlepulseio.PulseIndex(pulses, 8.0, 2, 20)
+        passed = numpy.flatnonzero((pulses[:,1] >= 8.0) & (pulses[:,4] >= 2) & (pulses[:,4] <= 20))
+        
+        rng = numpy.random.default_rng(1)
+        for aspect in (1.0, 6.0):
+            for t,dm in zip(rng.uniform(-10, 610, 25), rng.uniform(-5, 105, 25)):
+                d = ((pulses[passed,2] - t) / aspect)**2 + (pulses[passed,0] - dm)**2
+                best = index.nearest(t, dm, aspect=aspect)
+                self.assertAlmostEqual(d[numpy.flatnonzero(passed == best)[0]], d.min(), 6)
+                
+        ## Nothing passes
+        index.set_threshold(100.0, 2, 20)
+        self.assertRaises(ValueError, index.nearest, 100.0, 10.0)
+        
+    def test_density_pyramid(self):
+        """Build and view a DensityPyramid."""
+        
+        pulses = _make_pulses(20000)
+        pyramid = singlepulseio.DensityPyramid(pulses[:,2], pulses[:,0], pulses[:,1], (0, 600), (0, 100),
+                                               shape=(256, 64), nLevels=4)
+        self.assertEqual(len(pyramid.levels), 4)
+        for count,peak in pyramid.levels:
+            self.assertEqual(count.sum(), pulses.shape[0])
+            self.assertAlmostEqual(numpy.nanmax(peak), pulses[:,1].max(), 5)
+            
+        ## The full window comes from the coarsest level that is fine enough
+        image, extent = pyramid.view(0, 600, 0, 100, maxCells=(64, 16))
+        self.assertEqual(image.shape, (16, 64))
+        self.assertEqual(extent, (0, 600, 0, 100))
+        
+        ## A zoomed window comes from a finer level and covers the window
+        image, extent = pyramid.view(100, 150, 20, 30, maxCells=(64, 16))
+        self.assertTrue(extent[0] <= 100 and extent[1] >= 150)
+        self.assertTrue(extent[2] <= 20 and extent[3] >= 30)
+        inside = (pulses[:,2] >= extent[0]) & (pulses[:,2] < extent[1]) \
+                 & (pulses[:,0] >= extent[2]) & (pulses[:,0] < extent[3])
+        self.assertEqual(image.sum(), inside.sum())
+        
+        image, extent = pyramid.view(100, 150, 20, 30, maxCells=(64, 16), peak=True)
+        self.assertAlmostEqual(numpy.nanmax(image), pulses[inside,1].max(), 5)
+
+
+class singlepulseio_test_suite(unittest.TestSuite):
+    """A unittest.TestSuite class which contains all of the singlepulseio
+    module tests."""
+    
+    def __init__(self):
+        unittest.TestSuite.__init__(self)
+        
+        loader = unittest.TestLoader()
+        self.addTests(loader.loadTestsFromTestCase(singlepulseio_tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,163 +2,386 @@
 
 import os
 import sys
+import zlib
 import numpy
 import argparse
+from multiprocessing import Pool, Array, Lock, cpu_count
 from astropy.io import fits as astrofits
 
 import lsl.common.progress as progress
 from lsl.statistics import robust, kurtosis
 from lsl.misc import parser as aph
 
+from _psr import *
+from psrfitsio import read_subints, read_weights, read_row_numbers, get_column_layout, write_weights, \
+                      get_skstats_filename, read_skstats
 
-def main(args):
-    # Parse the command line
-    if args.frequencies is not None:
-        values = args.frequencies.split(',')
+
+fileProgress = None
+fileBlocks = None
+outputLock = None
+
+
+def initWorker(counter, blocks, lock):
+    """
+    Pool initializer that saves the shared per-file block counters, the 
+    per-file block totals, and the lock used to keep the output of the workers
+    from being mixed.
+    """
+    
+    global fileProgress
+    global fileBlocks
+    global outputLock
+    fileProgress = counter
+    fileBlocks = blocks
+    outputLock = lock
+
+
+def getStateFilename(filename):
+    """
+    Return the name of the sidecar file used to save the masking state of a
+    PSRFITS file.
+    """
+    
+    return filename+'.skstate.npz'
+
+
+def loadMaskState(filename):
+    """
+    Load the masking state saved for a PSRFITS file by a previous run and
+    return it as a dictionary.  If there is no saved state, or it cannot be 
+    read, return None.
+    """
+    
+    try:
+        with numpy.load(getStateFilename(filename)) as state:
+            state = {key:state[key] for key in state.files}
+    except (OSError, ValueError):
+        state = None
+    return state
+
+
+def saveMaskState(filename, state):
+    """
+    Save the masking state of a PSRFITS file to its sidecar file.  The state
+    is written to a temporary file first so that an interrupted run does not
+    leave a corrupted state behind.
+    """
+    
+    stateName = getStateFilename(filename)
+    with open(stateName+'.tmp', 'wb') as fh:
+        numpy.savez_compressed(fh, **state)
+    os.replace(stateName+'.tmp', stateName)
+
+
+def getStatsMask(filename, hdulist, nBlocks, nSubsChunk, skSigma):
+    """
+    Build the SK mask for each block of nSubsChunk rows from the SK moments
+    saved to a '.skstats' sidecar file by the converters.  Returns a two-
+    element tuple of the (block, channel) mask and the SK limits used.  If 
+    there is no sidecar file or it does not cover every row that is needed, 
+    None is returned for both.
+    """
+    
+    # Load the moments
+    try:
+        nfft, rows, s1, s2 = read_skstats(get_skstats_filename(filename))
+    except (OSError, ValueError):
+        return None, None
         
-        args.frequencies = []
-        for v in values:
-            if v.find('-') == -1:
-                args.frequencies.append( float(v) )
-            else:
-                v1, v2 = [float(vs) for vs in v.split('-', 1)]
-                v = v1
-                while v <= v2:
-                    args.frequencies.append( v )
-                    v += 0.1
-                args.frequencies.append( v2 )
+    # Match them to the rows in the file
+    nRows = nBlocks*nSubsChunk
+    if nRows == 0 or len(rows) == 0 or s1.shape[2] != hdulist[1].header['NCHAN']:
+        return None, None
+    order = numpy.argsort(rows)
+    rows = rows[order]
+    wanted = read_row_numbers(hdulist, 0, nRows)
+    match = numpy.clip(numpy.searchsorted(rows, wanted), 0, len(rows)-1)
+    if (rows[match] != wanted).any():
+        return None, None
+    match = order[match]
+    
+    # Combine the moments over each block and compute the SK.  The moments 
+    # come from the raw spectra so N is always one.
+    nPol, nChan = s1.shape[1:]
+    S1 = s1[match].reshape(nBlocks, nSubsChunk, nPol, nChan).sum(axis=1, dtype=numpy.float64)
+    S2 = s2[match].reshape(nBlocks, nSubsChunk, nPol, nChan).sum(axis=1, dtype=numpy.float64)
+    M = nfft*nSubsChunk
+    skLimits = kurtosis.get_limits(skSigma, M)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sk = (M + 1.0)/(M - 1.0) * (M*S2/S1**2 - 1.0)
+    valid = (sk >= skLimits[0]) & (sk <= skLimits[1])
+    
+    return numpy.where( valid.mean(axis=1) <= 0.5, 0.0, 1.0 ).astype(numpy.float32), skLimits
+
+
+def maskFile(task):
+    """
+    Update the weight mask of a single file.  The task is a tuple of the 
+    command line arguments, the file index, the filename, and the cores to run
+    on.  If the cores are None the file is processed in the foreground with its
+    own progress bar.  Returns a two-element tuple of the number of channels
+    flagged and the number of channels processed.
+    """
+    
+    args, c, filename, cores = task
+    
+    # Keep this file's OpenMP and decoding threads on its own set of cores
+    if cores is None:
+        nThreads = cpu_count()
     else:
-        args.frequencies = []
+        BindOpenMPToCores(cores)
+        nThreads = len(cores)
         
-    for filename in args.filename:
-        print(f"Working on '{os.path.basename(filename)}'")
-        
-        # Open the PRSFITS file
-        hdulist = astrofits.open(filename, mode='update', memmap=True)
+    # Open the PRSFITS file for reading and find where the weights live so
+    # that they can be updated in place
+    hdulist = astrofits.open(filename, mode='readonly', memmap=True)
+    fd = os.open(filename, os.O_WRONLY)
+    wtsLayout = get_column_layout(hdulist, 'DAT_WTS')
+    
+    # Figure out the integration time per sub-integration so we know how 
+    # many sections to work with at a time
+    nPol = hdulist[1].header['NPOL']
+    nSubs = hdulist[1].header['NSBLK']
+    tInt = hdulist[1].data[0][0]
+    nSubsChunk = int( numpy.ceil( args.duration/tInt ) )
+    
+    # Figure out the SK parameters to use
+    srate = hdulist[0].header['OBSBW']*1e6
+    LFFT = hdulist[1].data[0][12].size
+    skM = nSubsChunk*nSubs
+    skN = srate // LFFT * (tInt / nSubs)
+    if nPol == 1:
+        skN *= 2
+    skLimits = kurtosis.get_limits(args.sk_sigma, skM, N=1.0*skN)
+    
+    # Figure out what to mask for the specified frequencies
+    toMask = []
+    freq = hdulist[1].data[0][12]
+    for f in args.frequencies:
+        metric = numpy.abs( freq - f )
+        toMaskCurrent = numpy.where( metric <= 0.05 )[0]
+        toMask.extend( list(toMaskCurrent) )
+    if len(toMask) > 0:
+        toMask = list(set(toMask))
+        toMask.sort()
         
-        # Figure out the integration time per sub-integration so we know how 
-        # many sections to work with at a time
-        nPol = hdulist[1].header['NPOL']
-        nSubs = hdulist[1].header['NSBLK']
-        tInt = hdulist[1].data[0][0]
-        nSubsChunk = int( numpy.ceil( args.duration/tInt ) )
+    # Report
+    with outputLock:
+        print(f"Working on '{os.path.basename(filename)}'")
         print(f"  Polarizations: {nPol}")
         print(f"  Sub-integration time: {tInt/nSubs*1000.0:.3f} ms")
         print(f"  Sub-integrations per block: {nSubs}")
         print(f"  Block integration time: {tInt*1000.0:.3f} ms")
         print(f"  Working in chunks of {nSubsChunk} blocks ({nSubsChunk*tInt:.3f} s)")
-        
-        # Figure out the SK parameters to use
-        srate = hdulist[0].header['OBSBW']*1e6
-        LFFT = hdulist[1].data[0][12].size
-        skM = nSubsChunk*nSubs
-        skN = srate // LFFT * (tInt / nSubs)
-        if nPol == 1:
-            skN *= 2
-        skLimits = kurtosis.get_limits(args.sk_sigma, skM, N=1.0*skN)
         print(f"  (p)SK M: {nSubsChunk*nSubs}")
         print(f"  (p)SK N: {skN}")
         print(f"  (p)SK Limits: {skLimits[0]:.4f} <= valid <= {skLimits[1]:.4f}")
-        
-        # Figure out what to mask for the specified frequencies and report
-        toMask = []
-        freq = hdulist[1].data[0][12]
-        for f in args.frequencies:
-            metric = numpy.abs( freq - f )
-            toMaskCurrent = numpy.where( metric <= 0.05 )[0]
-            toMask.extend( list(toMaskCurrent) )
         if len(toMask) > 0:
-            toMask = list(set(toMask))
-            toMask.sort()
             print("  Masking Channels:")
-            for c in toMask:
-                print(f"    {c} -> {freq[c]:.3f} MHz")
+            for m in toMask:
+                print(f"    {m} -> {freq[m]:.3f} MHz")
                 
-        # Setup the progress bar
+    nBlocks = len(hdulist[1].data)//nSubsChunk
+    with fileBlocks.get_lock():
+        fileBlocks[c] = nBlocks
+        
+    # See if the SK can be computed from moments saved by the converter 
+    # rather than from the data
+    statsMask, statsLimits = None, None
+    if not args.ignore_sk_stats:
+        statsMask, statsLimits = getStatsMask(filename, hdulist, nBlocks, nSubsChunk, args.sk_sigma)
+    skSource = 'data' if statsMask is None else 'stats'
+    with outputLock:
+        if statsMask is None:
+            print(f"  '{os.path.basename(filename)}': computing (p)SK from the data")
+        else:
+            print(f"  '{os.path.basename(filename)}': computing SK from the saved moments")
+            print(f"    SK Limits: {statsLimits[0]:.4f} <= valid <= {statsLimits[1]:.4f}")
+            
+    # Load the state from the last run, as long as it is for the same data.
+    # This contains:
+    #  * the SK parameters used - skSigma, nSubsChunk, and skSource
+    #  * the frequency flagging used - frequencies and replace
+    #  * the weights as they were before any masking - origMask
+    #  * the SK mask for each block already processed - skMask
+    # The SK masks can be reused if the SK parameters have not changed so that
+    # only new rows need to have their SK computed.  The original weights are
+    # always kept since the weights in the file are no longer the originals.
+    nRows = nBlocks*nSubsChunk
+    origMask = numpy.ones((nRows, LFFT), dtype=numpy.float32)
+    skCache = numpy.ones((nBlocks, LFFT), dtype=numpy.float32)
+    nRowsPrev, nBlocksDone, freqChanged = 0, 0, True
+    fileID = zlib.crc32(hdulist[1].data.field('DATA')[0].tobytes())
+    state = loadMaskState(filename)
+    if state is not None and int(state.get('fileID', -1)) != fileID:
+        ## The file has been re-created since the state was saved
+        state = None
+    if state is not None:
+        nRowsPrev = min([state['origMask'].shape[0], nRows])
+        origMask[:nRowsPrev] = state['origMask'][:nRowsPrev]
+        if not args.rebuild \
+           and float(state['skSigma']) == args.sk_sigma \
+           and int(state['nSubsChunk']) == nSubsChunk \
+           and str(state.get('skSource', 'data')) == skSource:
+            nBlocksDone = min([state['skMask'].shape[0], nBlocks])
+            skCache[:nBlocksDone] = state['skMask'][:nBlocksDone]
+        freqChanged = list(state['frequencies']) != list(args.frequencies) \
+                      or bool(state['replace']) != args.replace
+    if nRowsPrev < nRows:
+        origMask[nRowsPrev:] = read_weights(hdulist, nRowsPrev, nRows)
+        
+    with outputLock:
+        print(f"  '{os.path.basename(filename)}': reusing (p)SK results for {nBlocksDone} of {nBlocks} blocks")
+        
+    # Save the original weights before anything in the file is changed
+    state = {'fileID': fileID, 'skSigma': args.sk_sigma, 'nSubsChunk': nSubsChunk, 'skSource': skSource,
+             'frequencies': numpy.array(args.frequencies), 'replace': args.replace,
+             'origMask': origMask, 'skMask': skCache[:nBlocksDone]}
+    saveMaskState(filename, state)
+    
+    # Build the frequency flagging mask
+    freqMask = numpy.ones(LFFT, dtype=numpy.float32)
+    freqMask[toMask] = 0.0
+    
+    # Setup the progress bar
+    if cores is None:
         try:
             pbar = progress.ProgressBarPlus(max=len(hdulist[1].data)/nSubsChunk, span=58)
         except AttributeError:
             pbar = progress.ProgressBar(max=len(hdulist[1].data)/nSubsChunk, span=58)
             
-        # Go!
-        flagged = 0
-        processed = 0
-        sk = numpy.zeros((nPol, LFFT)) - 99.99
-        for i in range(0, (len(hdulist[1].data)//nSubsChunk)*nSubsChunk, nSubsChunk):
-            ## Load in the current block of data
-            blockData = []
-            blockMask = None
-            for j in range(i, i+nSubsChunk):
-                ### Access the correct subintegration
-                subint = hdulist[1].data[j]
-                
-                ### Pull out various bits that we need, including:
-                ###  * the weight mask
-                ###  * the scale and offset values - bscl and bzero
-                ###  * the actual data - data
-                msk = subint[13]
-                bzero = subint[14]
-                bscl = subint[15]
-                bzero.shape = (LFFT,nPol)
-                bscl.shape = (LFFT,nPol)
-                bzero = bzero.T
-                bscl = bscl.T
-                data = subint[16]
-                data.shape = (nSubs,LFFT,nPol)
-                data = data.T
-                
-                ### Apply the scaling/offset to the data and save the results 
-                ### to blockData
-                for k in range(nSubs):
-                    d = data[:,:,k]*bscl + bzero
-                    d.shape += (1,)
-                    blockData.append( d )
-                    
-                ### Save a master mask
-                try:
-                    blockMask *= msk
-                except TypeError:
-                    blockMask = msk
-                    
-            blockData = numpy.concatenate(blockData, axis=2)
+    # Go!
+    flagged = 0
+    processed = 0
+    blockData = None
+    for b,i in enumerate(range(0, nRows, nSubsChunk)):
+        if b >= nBlocksDone and statsMask is not None:
+            ## Use the SK from the saved moments
+            skCache[b] = statsMask[b]
             
-            ## Compute the S-K statistics
-            for p in range(nPol):
-                for l in range(LFFT):
-                    sk[p,l] = kurtosis.spectral_power(blockData[p,l,:], N=1.0*skN)
-                    
-            ## Compute the new mask - both SK and the frequency flagging
-            newMask = numpy.where( (sk < skLimits[0]) | (sk > skLimits[1]), 0.0, 1.0 )
-            newMask = numpy.where( newMask.mean(axis=0) <= 0.5, 0.0, 1.0 )
-            for c in toMask:
-                newMask[c] *= 0.0
-                
-            if args.replace:
-                ## Replace the existing mask
-                blockMask = newMask
-            else:
-                ## Update the existing mask
-                blockMask *= newMask
-                
-            ## Update file
-            for j in range(i, i+nSubsChunk):
-                hdulist[1].data[j][13] = blockMask
-                
-            ## Update the counters
-            processed += LFFT
-            flagged += (1.0-blockMask).sum()
+        elif b >= nBlocksDone:
+            ## Load in the current block of data as (time, pol, chan)
+            blockData = read_subints(hdulist, i, i+nSubsChunk, out=blockData, nthreads=nThreads)
+            
+            ## Compute the S-K statistics for all polarizations and channels
+            ## at once
+            skMask = ComputePseudoSKMask(blockData, LFFT, 1.0*skN, skLimits[0], skLimits[1])
+            skCache[b] = numpy.where( skMask.mean(axis=0) <= 0.5, 0.0, 1.0 )
+            
+        ## Compute the new mask - both SK and the frequency flagging
+        newMask = skCache[b]*freqMask
+        
+        if args.replace:
+            ## Replace the existing mask
+            blockMask = newMask
+        else:
+            ## Update the existing mask, starting from the original weights
+            blockMask = origMask[i:i+nSubsChunk].prod(axis=0)*newMask
+            
+        ## Update file, if anything has changed for this block
+        if b >= nBlocksDone or freqChanged:
+            write_weights(fd, hdulist, i, i+nSubsChunk, blockMask, layout=wtsLayout)
             
-            ## Update the progress bar and remaining time estimate
+        ## Update the counters
+        processed += LFFT
+        flagged += (1.0-blockMask).sum()
+        with fileProgress.get_lock():
+            fileProgress[c] += 1
+            
+        ## Update the progress bar and remaining time estimate
+        if cores is None:
             pbar.inc()
             sys.stdout.write('  %5.1f%% %s\r' % (100.0*(1.0-blockMask).sum()/LFFT, pbar.show()))
             sys.stdout.flush()
             
-        # Update the progress bar with the total time used
+    # Save the SK masks for the next run
+    state['skMask'] = skCache
+    saveMaskState(filename, state)
+    
+    # Update the progress bar with the total time used
+    if cores is None:
         sys.stdout.write('  %5.1f%% %s\n' % (100.0*flagged/processed, pbar.show()))
         sys.stdout.flush()
         
-        # Done
-        hdulist.close()
+    # Done
+    os.close(fd)
+    hdulist.close()
+    
+    return flagged, processed
+
+
+def main(args):
+    # Parse the command line
+    if args.frequencies is not None:
+        values = args.frequencies.split(',')
+        
+        args.frequencies = []
+        for v in values:
+            if v.find('-') == -1:
+                args.frequencies.append( float(v) )
+            else:
+                v1, v2 = [float(vs) for vs in v.split('-', 1)]
+                v = v1
+                while v <= v2:
+                    args.frequencies.append( v )
+                    v += 0.1
+                args.frequencies.append( v2 )
+    else:
+        args.frequencies = []
+        
+    nFiles = len(args.filename)
+    counter = Array('l', nFiles)
+    blocks = Array('l', nFiles)
+    
+    if args.jobs == 1 or nFiles == 1:
+        # Work through the files one at a time
+        initWorker(counter, blocks, Lock())
+        results = []
+        for c,filename in enumerate(args.filename):
+            results.append( maskFile((args, c, filename, None)) )
+            
+    else:
+        # Divide up the cores so that each job has its own set
+        nJobs = min([args.jobs, nFiles])
+        nCore = cpu_count()
+        coresPerJob = max([1, nCore // nJobs])
+        
+        tasks = []
+        for c,filename in enumerate(args.filename):
+            cores = [((c % nJobs)*coresPerJob + j) % nCore for j in range(coresPerJob)]
+            tasks.append( (args, c, filename, cores) )
+            
+        # Create the progress bar so that we can keep up with the masking.
+        pbar = progress.ProgressBarPlus(max=100*nFiles, span=52)
+        
+        # Go!
+        pool = Pool(processes=nJobs, initializer=initWorker, initargs=(counter, blocks, Lock()))
+        result = pool.map_async(maskFile, tasks)
+        while not result.ready():
+            with counter.get_lock():
+                done = list(counter)
+            with blocks.get_lock():
+                total = list(blocks)
+            fractions = [d/t if t else 0.0 for d,t in zip(done, total)]
+            pbar.amount = min([int(100*sum(fractions)), pbar.max])
+            sys.stdout.write('%s\r' % pbar.show())
+            sys.stdout.flush()
+            result.wait(0.5)
+        pool.close()
+        pool.join()
+        
+        # Raise any errors from the workers
+        results = result.get()
+        
+        pbar.amount = pbar.max
+        sys.stdout.write('%s\n' % pbar.show())
+        sys.stdout.flush()
+        
+    # Report the flagging statistics for each file
+    print("Summary:")
+    for filename,(flagged,processed) in zip(args.filename, results):
+        print(f"  {os.path.basename(filename)}: {100.0*flagged/max([1, processed]):5.1f}% flagged")
 
 
 if __name__ == "__main__":
@@ -176,6 +399,12 @@ if __name__ == "__main__":
                         help='(p)SK update interval in seconds')
     parser.add_argument('-r', '--replace', action='store_true', 
                         help='replace the current weight mask rather than augment it')
+    parser.add_argument('-j', '--jobs', type=aph.positive_int, default=1, 
+                        help='number of files to update concurrently')
+    parser.add_argument('-b', '--rebuild', action='store_true', 
+                        help='recompute the (p)SK for all rows rather than only those not processed by a previous run')
+    parser.add_argument('-i', '--ignore-sk-stats', action='store_true', 
+                        help='compute the (p)SK from the data even if there is a .skstats sidecar file from the converter')
     args = parser.parse_args()
     main(args)
     
@@ -7,16 +7,21 @@ Given a PSRFITS file, create a HDF5 file in the standard LWA1 format.
 import os
 import re
 import sys
+import time
 import h5py
 import numpy
 import ctypes
 import argparse
+import threading
+import traceback
 from datetime import datetime
+from collections import deque
 
 from astropy.time import Time as AstroTime
 from astropy.io import fits as astrofits
 
 import data as hdfData
+from psrfitsio import read_subints, read_weights, read_sample_times
 
 import lsl.astro as astro
 import lsl.common.progress as progress
@@ -26,234 +31,350 @@ from lsl.misc import parser as aph
 _fnRE = re.compile('.*_b(?P<beam>[1-4])(t(?P<tuning>[12]))?_.*\.fits')
 
 
+MAX_QUEUE_DEPTH = 3
+writerQ = deque()
+
+# Target size in bytes for a chunk of a data or mask dataset
+CHUNK_SIZE = 1024**2
+
+# Target size in bytes for the decoded data written out in a single block
+BLOCK_SIZE = 32*1024**2
+
+
+def getChunkShape(nSubs, nchan, itemsize):
+    """
+    Return the chunk shape to use for a (time, channel) dataset.  This covers
+    all of the channels and a number of spectra that evenly divides a 
+    sub-integration so that each block written lines up with whole chunks.
+    """
+    
+    nSpec = nSubs
+    while nSpec % 2 == 0 and nSpec*nchan*itemsize > CHUNK_SIZE:
+        nSpec //= 2
+    return (nSpec, nchan)
+
+
+def getFileInfo(filename, hdulist):
+    """
+    Given a PSRFITS filename and the open file, return a dictionary of the
+    observation details needed to build the HDF5 file.
+    """
+    
+    info = {'filename': filename}
+    
+    # Try to find out the beam/tuning
+    mtch = _fnRE.search(filename)
+    
+    if mtch is None:
+        info['beam'] = 0
+        info['tuning'] = 1
+    else:
+        info['beam'] = int(mtch.group('beam'))
+        try:
+            info['tuning'] = int(mtch.group('tuning'))
+        except:
+            info['tuning'] = 1
+            
+    # File specifics
+    info['sourceName'] = hdulist[0].header['SRC_NAME']
+    ra = hdulist[0].header['RA']
+    ra = ra.split(':', 2)
+    info['ra'] = sum([float(v)/60**i for i,v in enumerate(ra)])*15.0
+    dec = hdulist[0].header['DEC']
+    decSign = -1.0 if dec.find('-') != -1 else 1.0
+    dec = dec.replace('-', '')
+    dec = dec.split(':', 2)
+    info['dec'] = decSign*sum([float(v)/60**i for i,v in enumerate(dec)])
+    info['epoch'] = float(hdulist[0].header['EQUINOX'])
+    
+    info['tStart'] = AstroTime(hdulist[0].header['STT_IMJD'], (hdulist[0].header['STT_SMJD'] + hdulist[0].header['STT_OFFS'])/86400.0,
+                               format='mjd', scale='utc')
+    info['cFreq'] = hdulist[0].header['OBSFREQ']*1e6	# MHz -> Hz
+    info['srate'] = hdulist[0].header['OBSBW']*1e6		# MHz -> Hz
+    info['LFFT'] = hdulist[1].header['NCHAN']
+    info['tInt'] = hdulist[1].header['TBIN']
+    info['nSubs'] = hdulist[1].header['NSBLK']
+    info['tSubs'] = info['nSubs']*info['tInt']
+    info['nPol'] = hdulist[1].header['NPOL']
+    if info['nPol'] == 1:
+        info['data_products'] = ['I',]
+    elif info['nPol'] == 2:
+        if hdulist[0].header['FD_POLN'] == 'CIRC':
+            info['data_products'] = ['LL', 'RR']
+        else:
+            info['data_products'] = ['XX', 'YY']
+    else:
+        info['data_products'] = ['I', 'Q', 'U', 'V']
+    info['nChunks'] = len(hdulist[1].data)
+    
+    return info
+
+
+def decoder(hdulist, info, skip, dur, timeInfo, outQueue, failures):
+    """
+    Decode blocks of sub-integrations from an open PSRFITS file and queue 
+    them for the writer.  If timeInfo is not None it is a three-element tuple
+    of the time data type and the integer and fractional parts of the start 
+    time that is used to also queue the sample times.  Any exception is added
+    to the failures list and the decoder stops, as it does if another thread
+    has already added something to the list.
+    """
+    
+    nSubs = info['nSubs']
+    blockRows = max([1, BLOCK_SIZE // (nSubs*info['nPol']*info['LFFT']*4)])
+    
+    try:
+        for i in range(skip, skip+dur, blockRows):
+            while len(outQueue) >= MAX_QUEUE_DEPTH:
+                if failures:
+                    return
+                time.sleep(0.001)
+            if failures:
+                return
+                
+            ## Decode the correct subintegrations into (time, pol, chan) and
+            ## pull out:
+            ##  * the sample times - t
+            ##  * the weight mask, converted to binary - msk
+            j = min([i+blockRows, skip+dur])
+            data = read_subints(hdulist, i, j)
+            t = read_sample_times(hdulist, i, j)
+            msk = read_weights(hdulist, i, j) < 0.5
+            msk = numpy.repeat(msk, nSubs, axis=0)
+            
+            ## Queue the results to be saved to the HDF5 file
+            k = (i-skip)*nSubs
+            tt = None
+            if timeInfo is not None:
+                tt = numpy.empty(data.shape[0], dtype=timeInfo[0])
+                tt[tt.dtype.names[0]] = timeInfo[1]
+                tt[tt.dtype.names[1]] = timeInfo[2] + t
+            outQueue.append( (k, info['tuning'], info['data_products'], tt, data, msk) )
+            
+    except Exception as e:
+        lines = traceback.format_exc()
+        lines = '\x1b[2KDecoder Error '+lines
+        print(lines,)
+        failures.append(e)
+
+
+def writer(ds, inQueue, nSubs, pbar, failures):
+    """
+    Write blocks of decoded sub-integrations from all of the decoders to the 
+    HDF5 file so that any compression is done while the next blocks are being
+    decoded.  Any exception is added to the failures list and the writer
+    stops, as it does if one of the decoders has already failed.
+    """
+    
+    try:
+        incoming = getFromQueue(inQueue)
+        while incoming[0] is not None and not failures:
+            ## Unpack
+            k, tuning, data_products, tt, data, msk = incoming
+            n = data.shape[0]
+            
+            ## Write
+            if tt is not None:
+                ds['obs1-time'][k:k+n] = tt
+            for l,p in enumerate(data_products):
+                ds[f"obs1-{p}{tuning}"][k:k+n,:] = data[:,l,:]
+                ds[f"obs1-mask-{p}{tuning}"][k:k+n,:] = msk
+                
+            ## Update the progress bar and remaining time estimate
+            pbar.inc(n // nSubs)
+            sys.stdout.write('%s\r' % (pbar.show()))
+            sys.stdout.flush()
+            
+            ## Fetch another one
+            incoming = getFromQueue(inQueue)
+            
+    except Exception as e:
+        lines = traceback.format_exc()
+        lines = '\x1b[2KWriter Error '+lines
+        print(lines,)
+        failures.append(e)
+
+
+def getFromQueue(queueName):
+    while len(queueName) == 0:
+        time.sleep(0.001)
+    return queueName.popleft()
+
+
 def main(args):
+    global MAX_QUEUE_DEPTH
+    MAX_QUEUE_DEPTH = min([args.queue_depth, 10])
+    
     # Parse command line options
     filenames = args.filename
+    compression = None if args.compression == 'none' else args.compression
     
-    # Variable that will be associated with the HDF5 instance
-    f = None
-    
-    # Open the file and load in basic information about the observation's goal
-    for c,filename in enumerate(filenames):
+    # Open the files, load in basic information about the observation's goal,
+    # and make sure that everything is in order before we start
+    hdulists, infos = [], []
+    for filename in filenames:
         ## Ready the PSRFITS file
         hdulist = astrofits.open(filename, memmap=True)
+        info = getFileInfo(filename, hdulist)
         
-        ## Try to find out the beam/tuning
-        mtch = _fnRE.search(filename)
-        
-        if mtch is None:
-            beam = 0
-            tuning = 1
-        else:
-            beam = int(mtch.group('beam'))
-            try:
-                tuning = int(mtch.group('tuning'))
-            except:
-                tuning = 1
-                
-        ## File specifics
-        sourceName = hdulist[0].header['SRC_NAME']
-        ra = hdulist[0].header['RA']
-        ra = ra.split(':', 2)
-        ra = sum([float(v)/60**i for i,v in enumerate(ra)])*15.0
-        dec = hdulist[0].header['DEC']
-        decSign = -1.0 if dec.find('-') != -1 else 1.0
-        dec = dec.replace('-', '')
-        dec = dec.split(':', 2)
-        dec = decSign*sum([float(v)/60**i for i,v in enumerate(dec)])
-        epoch = float(hdulist[0].header['EQUINOX'])
-        
-        tStart = AstroTime(hdulist[0].header['STT_IMJD'], (hdulist[0].header['STT_SMJD'] + hdulist[0].header['STT_OFFS'])/86400.0,
-                           format='mjd', scale='utc')
-        cFreq = hdulist[0].header['OBSFREQ']*1e6	# MHz -> Hz
-        srate = hdulist[0].header['OBSBW']*1e6		# MHz -> Hz
-        LFFT = hdulist[1].header['NCHAN']
-        tInt = hdulist[1].header['TBIN']
-        nSubs = hdulist[1].header['NSBLK']
-        tSubs = nSubs*tInt
-        nPol = hdulist[1].header['NPOL']
-        if nPol == 1:
-            data_products = ['I',]
-        elif nPol == 2:
-            if hdulist[0].header['FD_POLN'] == 'CIRC':
-                data_products = ['LL', 'RR']
-            else:
-                data_products = ['XX', 'YY']
-        else:
-            data_products = ['I', 'Q', 'U', 'V']
-        nChunks = len(hdulist[1].data)
-        
-        ## File cross-validation to make sure that everything is in order
-        try:
-            validationPass = True
+        ## File cross-validation against the first file
+        validationPass = True
+        if len(infos) > 0:
             for keyword in ('sourceName', 'ra', 'dec', 'epoch', 'tStart', 'srate', 'LFFT', 'tInt', 'tSubs', 'nPol', 'nChunks'):
-                keywordOld = keyword+"Old"
-                valid = eval(f"{keyword} == {keywordOld}")
-                if not valid:
+                if info[keyword] != infos[0][keyword]:
                     print(f"ERROR:  Detail '{keyword}' of {os.path.basename(filename)} does not match that of the first file")
                     print("ERROR:  Aborting")
                     validationPass = False
                     
-            if not validationPass:
-                continue
-                
-        except NameError as e:
-            sourceNameOld = sourceName
-            raOld = ra
-            decOld = dec
-            epochOld = epoch
-            tStartOld = tStart
-            srateOld = srate
-            LFFTOld = LFFT
-            tIntOld = tInt
-            tSubsOld = tSubs
-            nPolOld = nPol
-            nChunksOld = nChunks
+        if not validationPass:
+            hdulist.close()
+            continue
             
-        ## Pre-process the start time
-        tStartI = int(tStart.unix)
-        tStartF = tStart.unix - tStartI
+        hdulists.append(hdulist)
+        infos.append(info)
         
-        ## Convert the skip and duration values to subblocks
-        skip = int(round(args.skip / tSubs))
-        dur  = int(round(args.duration / tSubs))
-        dur  = dur if dur else 1
-        args.skip = skip * tSubs
-        args.duration = dur * tSubs
+    # Details about the observation from the first file
+    info = infos[0]
+    sourceName, ra, dec, epoch = info['sourceName'], info['ra'], info['dec'], info['epoch']
+    beam, srate, LFFT, tInt = info['beam'], info['srate'], info['LFFT'], info['tInt']
+    nSubs, tSubs, data_products = info['nSubs'], info['tSubs'], info['data_products']
+    
+    # Pre-process the start time
+    tStartI = int(info['tStart'].unix)
+    tStartF = info['tStart'].unix - tStartI
+    
+    # Convert the skip and duration values to subblocks
+    skip = int(round(args.skip / tSubs))
+    dur  = int(round(args.duration / tSubs))
+    dur  = dur if dur else 1
+    args.skip = skip * tSubs
+    args.duration = dur * tSubs
+    if skip + dur > info['nChunks']:
+        raise RuntimeError(f"Sub-integrations {skip} through {skip+dur-1} were requested but the file only has {info['nChunks']}")
         
-        ## Report
-        print(f"Filename: {filename} ({c+1} of {len(filenames)})")
-        print(f"Date of First Frame: {tStart.datetime}")
-        print(f"Beam: {beam}")
-        print(f"Tuning: {tuning}")
-        print(f"Sample Rate: {srate} Hz")
-        print(f"Tuning Frequency: {cFreq:.3f} Hz")
+    # Report
+    for c,info in enumerate(infos):
+        print(f"Filename: {info['filename']} ({c+1} of {len(filenames)})")
+        print(f"Date of First Frame: {info['tStart'].datetime}")
+        print(f"Beam: {info['beam']}")
+        print(f"Tuning: {info['tuning']}")
+        print(f"Sample Rate: {info['srate']} Hz")
+        print(f"Tuning Frequency: {info['cFreq']:.3f} Hz")
         print("---")
-        print(f"Target: {sourceName}")
-        print(f"RA: {ra/15.0:.3f} hours")
-        print(f"Dec: %.3f degrees" % dec)
-        print(f"Data Products: {','.join(data_products)}")
-        print(f"Integration Time: {tInt*1e3:.3f} ms")
-        print(f"Sub-integrations: {nChunks} ({nChunks*tSubs:.3f} s)")
+        print(f"Target: {info['sourceName']}")
+        print(f"RA: {info['ra']/15.0:.3f} hours")
+        print(f"Dec: %.3f degrees" % info['dec'])
+        print(f"Data Products: {','.join(info['data_products'])}")
+        print(f"Integration Time: {info['tInt']*1e3:.3f} ms")
+        print(f"Sub-integrations: {info['nChunks']} ({info['nChunks']*info['tSubs']:.3f} s)")
         print("---")
         print(f"Offset: {args.skip:.3f} s ({skip} subints.)")
         print(f"Duration: {args.duration:.3f} s ({dur} subints.)")
-        print(f"Transform Length: {LFFT}")
+        print(f"Transform Length: {info['LFFT']}")
         
-        ## Prepare the HDF5 file
-        if f is None:
-            ### Create the HDF5 file
-            outname = os.path.split(filename)[1]
-            outname = os.path.splitext(outname)[0]
-            if len(filenames) == 2:
-                outname = outname.replace('t1', '')
-                outname = outname.replace('t2', '')
-            outname = '%s.hdf5' % outname
-            
-            if os.path.exists(outname):
-                yn = input(f"WARNING: '{outname}' exists, overwrite? [Y/n] " % outname)
-                if yn not in ('n', 'N'):
-                    os.unlink(outname)
-                else:
-                    raise RuntimeError(f"Output file '{outname}' already exists" % outname)
-                    
-            ### Populate the groups
-            f = hdfData.create_new_file(outname)
-            hdfData.fill_minimum(f, 1, beam, srate)
-            for t in (1, 2):
-                hdfData.create_observation_set(f, 1, t, numpy.arange(LFFT, dtype=numpy.float64), dur*nSubs, data_products)
-            f.attrs['FileGenerator'] = 'writeHDF5FromPsrfits.py'
-            f.attrs['InputData'] = os.path.basename(filename)
-            
-            ds = {}
-            ds['obs1'] = hdfData.get_observation_set(f, 1)
-            ds['obs1-time'] = hdfData.get_time(f, 1)
-            for t in (1, 2):
-                ds[f"obs1-freq{t}"] = hdfData.get_data_set(f, 1, t, 'freq')
-                for p in data_products:
-                    ds[f"obs1-{p}{t}"] = hdfData.get_data_set(f, 1, t, p)
-                    
-            ### Add in mask information
-            for t in (1, 2):
-                tuningInfo = ds["obs1"].get(f"Tuning{t}", None)
-                maskInfo = tuningInfo.create_group("Mask")
-                for p in data_products:
-                    maskInfo.create_dataset(p, ds[f"obs1-{p}{t}"].shape, 'bool')
-                    ds[f"obs1-mask-{p}{t}"] = maskInfo.get(p, None)
-                    
-            ### Target metadata
-            ds['obs1'].attrs['ObservationName'] = sourceName
-            ds['obs1'].attrs['TargetName'] = sourceName
-            ds['obs1'].attrs['RA'] = ra/15.0
-            ds['obs1'].attrs['RA_Units'] = 'hours'
-            ds['obs1'].attrs['Dec'] = dec
-            ds['obs1'].attrs['Dec_Units'] = 'degrees'
-            ds['obs1'].attrs['Epoch'] = epoch
-            ds['obs1'].attrs['TrackingMode'] = hdulist[0].header['TRK_MODE']
+    # Create the HDF5 file
+    outname = os.path.split(filenames[0])[1]
+    outname = os.path.splitext(outname)[0]
+    if len(filenames) == 2:
+        outname = outname.replace('t1', '')
+        outname = outname.replace('t2', '')
+    outname = '%s.hdf5' % outname
+    
+    if os.path.exists(outname):
+        yn = input(f"WARNING: '{outname}' exists, overwrite? [Y/n] ")
+        if yn not in ('n', 'N'):
+            os.unlink(outname)
+        else:
+            raise RuntimeError(f"Output file '{outname}' already exists")
             
-            ### Observation metadata
-            ds['obs1'].attrs['tInt'] = tInt
-            ds['obs1'].attrs['tInt_Units'] = 's'
-            ds['obs1'].attrs['LFFT'] = LFFT
-            ds['obs1'].attrs['nChan'] = LFFT
+    ## Populate the groups
+    f = hdfData.create_new_file(outname)
+    hdfData.fill_minimum(f, 1, beam, srate)
+    chunks = getChunkShape(nSubs, LFFT, 4)
+    for t in (1, 2):
+        hdfData.create_observation_set(f, 1, t, numpy.arange(LFFT, dtype=numpy.float64), dur*nSubs, data_products,
+                                       chunks=chunks, compression=compression)
+    f.attrs['FileGenerator'] = 'writeHDF5FromPsrfits.py'
+    f.attrs['InputData'] = os.path.basename(filenames[0])
+    
+    ds = {}
+    ds['obs1'] = hdfData.get_observation_set(f, 1)
+    ds['obs1-time'] = hdfData.get_time(f, 1)
+    for t in (1, 2):
+        ds[f"obs1-freq{t}"] = hdfData.get_data_set(f, 1, t, 'freq')
+        for p in data_products:
+            ds[f"obs1-{p}{t}"] = hdfData.get_data_set(f, 1, t, p)
             
-            ### Create the progress bar so that we can keep up with the conversion.
-            pbar = progress.ProgressBarPlus(max=len(filenames)*dur)
+    ## Add in mask information
+    for t in (1, 2):
+        tuningInfo = ds["obs1"].get(f"Tuning{t}", None)
+        maskInfo = tuningInfo.create_group("Mask")
+        for p in data_products:
+            maskInfo.create_dataset(p, ds[f"obs1-{p}{t}"].shape, 'bool',
+                                    chunks=getChunkShape(nSubs, LFFT, 1),
+                                    compression=compression)
+            ds[f"obs1-mask-{p}{t}"] = maskInfo.get(p, None)
             
-        ## Frequency information
+    ## Target metadata
+    ds['obs1'].attrs['ObservationName'] = sourceName
+    ds['obs1'].attrs['TargetName'] = sourceName
+    ds['obs1'].attrs['RA'] = ra/15.0
+    ds['obs1'].attrs['RA_Units'] = 'hours'
+    ds['obs1'].attrs['Dec'] = dec
+    ds['obs1'].attrs['Dec_Units'] = 'degrees'
+    ds['obs1'].attrs['Epoch'] = epoch
+    ds['obs1'].attrs['TrackingMode'] = hdulists[0][0].header['TRK_MODE']
+    
+    ## Observation metadata
+    ds['obs1'].attrs['tInt'] = tInt
+    ds['obs1'].attrs['tInt_Units'] = 's'
+    ds['obs1'].attrs['LFFT'] = LFFT
+    ds['obs1'].attrs['nChan'] = LFFT
+    
+    ## Frequency information
+    for hdulist,info in zip(hdulists, infos):
         freq = hdulist[1].data[0][12]*1e6		# MHz -> Hz
         ds['obs1'].attrs['RBW'] = freq[1]-freq[0]
         ds['obs1'].attrs['RBW_Units'] = 'Hz'
-        ds[f"obs1-freq{tuning}"][:] = freq
-        
-        ## Read in the data and apply what ever scaling is needed
-        for i in range(skip, skip+dur):
-            ### Access the correct subintegration
-            subint = hdulist[1].data[i]
-            
-            ### Pull out various bits that we need, including:
-            ###  * the start time of the subint. - tOff
-            ###  * the weight mask, converted to binary - msk
-            ###  * the scale and offset values - bscl and bzero
-            ###  * the actual data - data
-            tOff = subint[1] - subint[0]/2
-            msk = numpy.where(subint[13] >= 0.5, False, True)
-            bzero = subint[14]
-            bscl = subint[15]
-            bzero.shape = (LFFT,nPol)
-            bscl.shape = (LFFT,nPol)
-            bzero = bzero.T
-            bscl = bscl.T
-            data = subint[16]
-            data.shape = (nSubs,LFFT,nPol)
-            data = data.T
-            
-            ### Apply the scaling/offset to the data and save the results 
-            ### to the HDF5 file
-            for j in range(nSubs):
-                k = (i-skip)*nSubs + j
-                t = subint[1] + tInt*(j-nSubs//2)
-                d = data[:,:,j]*bscl + bzero
-                
-                if c == 0:
-                    ds['obs1-time'][k] = (tStartI, tStartF + t)
-                for l,p in enumerate(data_products):
-                    ds[f"obs1-{p}{tuning}"][k,:] = d[l,:]
-                    ds[f"obs1-mask-{p}{tuning}"][k,:] = msk
-                    
-            ### Update the progress bar and remaining time estimate
-            pbar.inc()
-            sys.stdout.write('%s\r' % (pbar.show()))
-            sys.stdout.flush()
-            
-        ## Close out the current PSRFITS file
-        hdulist.close()
+        ds[f"obs1-freq{info['tuning']}"][:] = freq
         
-        sys.stdout.write(pbar.show()+'\n')
-        sys.stdout.flush()
+    # Create the progress bar so that we can keep up with the conversion.
+    pbar = progress.ProgressBarPlus(max=len(hdulists)*dur)
+    
+    # Start the writer
+    failures = []
+    wrtr = threading.Thread(target=writer, args=(ds, writerQ, nSubs, pbar, failures))
+    wrtr.daemon = True
+    wrtr.start()
+    
+    # Read in the data and apply what ever scaling is needed with one decoder
+    # per file.  The sample times are saved from the first file.
+    dcdrs = []
+    for c,(hdulist,info) in enumerate(zip(hdulists, infos)):
+        timeInfo = (ds['obs1-time'].dtype, tStartI, tStartF) if c == 0 else None
+        dcdr = threading.Thread(target=decoder, args=(hdulist, info, skip, dur, timeInfo, writerQ, failures))
+        dcdr.daemon = True
+        dcdr.start()
+        dcdrs.append(dcdr)
         
+    # Wait for everything to finish
+    for dcdr in dcdrs:
+        dcdr.join()
+    writerQ.append( (None,) )
+    wrtr.join()
+    
+    sys.stdout.write(pbar.show()+'\n')
+    sys.stdout.flush()
+    
     # Done
+    for hdulist in hdulists:
+        hdulist.close()
     f.close()
+    
+    # Stop if anything went wrong, removing the incomplete file
+    if failures:
+        os.unlink(outname)
+        raise RuntimeError(f"Conversion failed: {failures[0]}") from failures[0]
 
 
 if __name__ == "__main__":
@@ -269,6 +390,10 @@ if __name__ == "__main__":
                         help='amount of time to save in seconds')
     parser.add_argument('-o', '--output', type=str,
                         help='output file basename')
+    parser.add_argument('-c', '--compression', type=str, choices=('none', 'lzf', 'gzip'), default='none',
+                        help='compression to use for the data and mask datasets')
+    parser.add_argument('-q', '--queue-depth', type=aph.positive_int, default=3, 
+                        help='writer queue depth')
     args = parser.parse_args()
     main(args)
     
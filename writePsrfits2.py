@@ -15,7 +15,7 @@ import traceback
 
 import threading
 from collections import deque
-from multiprocessing import cpu_count
+from multiprocessing import Pool, Value, cpu_count
 
 import psrfits_utils.psrfits_utils as pfu
 
@@ -28,6 +28,8 @@ from lsl.statistics import kurtosis
 from lsl.misc import parser as aph
 
 from _psr import *
+from drxmmap import DRXMemmapFile
+from psrfitsio import get_skstats_filename, SKStatsWriter
 
 
 MAX_QUEUE_DEPTH = 3
@@ -51,7 +53,7 @@ def resolveTarget(name):
     return raS, decS, serviceS
 
 
-def reader(idf, chunkTime, outQueue, core=None, verbose=True):
+def reader(idf, chunkTime, outQueue, core=None, count=None, verbose=True):
     # Setup
     done = False
     siCount = 0
@@ -66,6 +68,11 @@ def reader(idf, chunkTime, outQueue, core=None, verbose=True):
             while len(outQueue) >= MAX_QUEUE_DEPTH:
                 time.sleep(0.001)
                 
+            ## Stop if we have read everything that was asked for
+            if count is not None and siCount >= count:
+                done = True
+                break
+                
             ## Read in the data
             try:
                 readT, t, rawdata = idf.read(chunkTime)
@@ -91,6 +98,89 @@ def getFromQueue(queueName):
     return queueName.popleft()
 
 
+segmentProgress = None
+
+
+def initSegment(counter):
+    """
+    Pool initializer that saves the shared sub-integration counter used to
+    report the progress of each time segment back to the parent process.
+    """
+    
+    global segmentProgress
+    segmentProgress = counter
+
+
+def segmentWorker(task):
+    """
+    Process a single time segment of the file in a pool worker.  The task is
+    a two-element tuple of the command line arguments and the segment
+    definition (index, start sub-integration, number of sub-integrations,
+    cores).
+    """
+    
+    args, segment = task
+    
+    # Keep this segment's OpenMP threads on its own set of cores
+    BindOpenMPToCores(segment[3])
+    
+    args.segment = segment
+    main(args)
+    return segment[0]
+
+
+def runSegments(args, nSubints):
+    """
+    Split the conversion of the file into args.segments time segments that are
+    processed in parallel.  Segment i is written to file number i+1 of the
+    PSRFITS series with the sub-integration offsets and NSUBOFFS set so that
+    the series is continuous.
+    """
+    
+    # Figure out the segments
+    nSegments = max([1, min([args.segments, nSubints])])
+    segmentSize = (nSubints + nSegments - 1) // nSegments
+    nSegments = (nSubints + segmentSize - 1) // segmentSize
+    
+    # Divide up the cores
+    nCore = cpu_count()
+    coresPerSegment = max([1, nCore // nSegments])
+    
+    tasks = []
+    for i in range(nSegments):
+        start = i*segmentSize
+        count = min([segmentSize, nSubints-start])
+        if i == nSegments - 1:
+            ## The last segment runs through to the end of the file
+            count = None
+        cores = [(i*coresPerSegment + j) % nCore for j in range(coresPerSegment)]
+        tasks.append( (args, (i, start, count, cores)) )
+        
+    print(f"Processing in {nSegments} segments of {segmentSize} sub-integrations using {coresPerSegment} core(s) each")
+    
+    # Create the progress bar so that we can keep up with the conversion.
+    pbar = progress.ProgressBarPlus(max=nSubints, span=52)
+    
+    # Go!
+    counter = Value('l', 0)
+    pool = Pool(processes=nSegments, initializer=initSegment, initargs=(counter,))
+    result = pool.map_async(segmentWorker, tasks)
+    while not result.ready():
+        pbar.amount = min([counter.value, pbar.max])
+        sys.stdout.write('%s\r' % pbar.show())
+        sys.stdout.flush()
+        result.wait(0.5)
+    pool.close()
+    pool.join()
+    
+    # Raise any errors from the workers
+    result.get()
+    
+    pbar.amount = pbar.max
+    sys.stdout.write('%s\n' % pbar.show())
+    sys.stdout.flush()
+
+
 def main(args):
     # Parse command line options
     global MAX_QUEUE_DEPTH
@@ -124,8 +214,15 @@ def main(args):
     # Sub-integration block size
     nsblk = args.nsblk
     
+    # Time segment, if we are processing one
+    segment = getattr(args, 'segment', None)
+    verbose = segment is None
+    
     # Open
-    idf = DRXFile(args.filename)
+    if args.mmap:
+        idf = DRXMemmapFile(args.filename)
+    else:
+        idf = DRXFile(args.filename)
     
     # Load in basic information about the data
     nFramesFile = idf.get_info('nframe')
@@ -139,7 +236,8 @@ def main(args):
         o = idf.offset(args.skip)
     nFramesFile -= int(o*srate/4096)*tunepol
     
-    ## Date
+    ## Date - the start of the file, even when we are processing a segment,
+    ## so that all of the segments share the same epoch
     beginDate = idf.get_info('start_time')
     beginTime = beginDate.datetime
     mjd = beginDate.mjd
@@ -148,24 +246,35 @@ def main(args):
     if args.output is None:
         args.output = f"drx_{mjd_day:05d}_{args.source.replace(' ', '')}"
         
+    ## Move to the start of the segment
+    if segment is not None:
+        o = idf.offset(segment[1]*LFFT/srate*nsblk)
+        nFramesFile -= int(o*srate/4096)*tunepol
+        
     ## Tuning frequencies
     central_freq1 = idf.get_info('freq1')
     central_freq2 = idf.get_info('freq2')
     beam = idf.get_info('beam')
     
     # File summary
-    print(f"Input Filename: {args.filename}")
-    print(f"Date of First Frame: {str(beginDate)} (MJD={mjd:f})")
-    print(f"Tune/Pols: {tunepol}")
-    print(f"Tunings: {central_freq1:.1f} Hz, {central_freq2:.1f} Hz")
-    print(f"Sample Rate: {srate} Hz")
-    print(f"Sample Time: {LFFT / srate:f} s")
-    print(f"Sub-block Time: {LFFT / srate * nsblk:f} s")
-    print("Frames: %i (%.3f s)" % (nFramesFile, 4096.0*nFramesFile / srate / tunepol))
-    print("---")
-    print(f"Offset: {o:.3f} s ({o*srate//4096*tunepol} frames)")
-    print("---")
-    print(f"Using FFTW Wisdom? {useWisdom}")
+    if verbose:
+        print(f"Input Filename: {args.filename}")
+        print(f"Date of First Frame: {str(beginDate)} (MJD={mjd:f})")
+        print(f"Tune/Pols: {tunepol}")
+        print(f"Tunings: {central_freq1:.1f} Hz, {central_freq2:.1f} Hz")
+        print(f"Sample Rate: {srate} Hz")
+        print(f"Sample Time: {LFFT / srate:f} s")
+        print(f"Sub-block Time: {LFFT / srate * nsblk:f} s")
+        print("Frames: %i (%.3f s)" % (nFramesFile, 4096.0*nFramesFile / srate / tunepol))
+        print("---")
+        print(f"Offset: {o:.3f} s ({o*srate//4096*tunepol} frames)")
+        print("---")
+        print(f"Using FFTW Wisdom? {useWisdom}")
+        
+    # Split the conversion into time segments, if requested
+    if args.segments > 1 and segment is None:
+        runSegments(args, nFramesFile//(tunepol*(nsblk*LFFT//4096)))
+        return
     
     # Create the output PSRFITS file(s)
     pfu_out = []
@@ -198,6 +307,13 @@ def main(args):
         pfo.filenum = 0
         pfo.tot_rows = pfo.N = pfo.T = pfo.status = pfo.multifile = 0
         pfo.rows_per_file = 32768
+        if segment is not None:
+            ### Each segment is the next file in the series and picks up the
+            ### sub-integration count where the previous segment left off
+            pfo.filenum = segment[0]
+            pfo.tot_rows = segment[1]
+            if segment[2] is not None:
+                pfo.rows_per_file = max([pfo.rows_per_file, segment[2]])
         
         ## Frequency, bandwidth, and channels
         if t == 1:
@@ -248,6 +364,12 @@ def main(args):
         pfu.psrfits_create(pfo)
         pfu_out.append(pfo)
         
+    # Setup the SK moments sidecar files, if requested
+    skStats = []
+    if args.sk_stats:
+        for pfo in pfu_out:
+            skStats.append( SKStatsWriter(get_skstats_filename(pfo.filename), 2, LFFT, nsblk) )
+            
     freqBaseMHz = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) / 1e6
     for i in range(len(pfu_out)):
         # Define the frequencies available in the file (in MHz)
@@ -284,7 +406,10 @@ def main(args):
     pbar = progress.ProgressBarPlus(max=nFramesFile//(4*chunkSize), span=52)
     
     # Go!
-    rdr = threading.Thread(target=reader, args=(idf, chunkTime, readerQ), kwargs={'core':0})
+    if segment is None:
+        rdr = threading.Thread(target=reader, args=(idf, chunkTime, readerQ), kwargs={'core':0})
+    else:
+        rdr = threading.Thread(target=reader, args=(idf, chunkTime, readerQ), kwargs={'core':segment[3][0], 'count':segment[2], 'verbose':False})
     rdr.setDaemon(True)
     rdr.start()
     
@@ -307,6 +432,13 @@ def main(args):
         ff1 = 1.0*(LFFT - weight1.sum()) / LFFT
         ff2 = 1.0*(LFFT - weight2.sum()) / LFFT
         
+        ## S-K moments
+        if args.sk_stats:
+            try:
+                skMoments = ComputeSKMoments(rawSpectra, skMoments)
+            except NameError:
+                skMoments = ComputeSKMoments(rawSpectra)
+                
         ## Detect power
         try:
             redData = reduceEngine(rawSpectra, redData)
@@ -351,13 +483,21 @@ def main(args):
             ptr, junk = wt.__array_interface__['data']
             ctypes.memmove(int(pfu_out[j].sub.dat_weights), ptr, pfu_out[j].hdr.nchan*4)
             
+            ## SK moments
+            if args.sk_stats:
+                skStats[j].write(pfu_out[j].tot_rows, skMoments[:,2*j:2*j+2,:])
+                
             ## Save
             pfu.psrfits_write_subint(pfu_out[j])
             
         ## Update the progress bar and remaining time estimate
-        pbar.inc()
-        sys.stdout.write('%5.1f%% %5.1f%% %s %2i\r' % (ff1*100, ff2*100, pbar.show(), len(readerQ)))
-        sys.stdout.flush()
+        if segment is None:
+            pbar.inc()
+            sys.stdout.write('%5.1f%% %5.1f%% %s %2i\r' % (ff1*100, ff2*100, pbar.show(), len(readerQ)))
+            sys.stdout.flush()
+        else:
+            with segmentProgress.get_lock():
+                segmentProgress.value += 1
         
         ## Fetch another one
         incoming = getFromQueue(readerQ)
@@ -366,14 +506,17 @@ def main(args):
     
     # Update the progress bar with the total time used but only if we have
     # reached the end of the file
-    if incoming[1]:
-        pbar.amount = pbar.max
-    sys.stdout.write('              %s %2i\n' % (pbar.show(), len(readerQ)))
-    sys.stdout.flush()
+    if verbose:
+        if incoming[1]:
+            pbar.amount = pbar.max
+        sys.stdout.write('              %s %2i\n' % (pbar.show(), len(readerQ)))
+        sys.stdout.flush()
     
     # And close out the files
     for pfo in pfu_out:
         pfu.psrfits_close(pfo)
+    for sks in skStats:
+        sks.close()
 
 
 if __name__ == "__main__":
@@ -411,6 +554,12 @@ if __name__ == "__main__":
                         help='save the spectra in 4-bit mode instead of 8-bit mode')
     parser.add_argument('-q', '--queue-depth', type=aph.positive_int, default=3, 
                         help='reader queue depth')
+    parser.add_argument('-g', '--segments', type=aph.positive_int, default=1, 
+                        help='split the file into this many time segments and process them in parallel')
+    parser.add_argument('-m', '--mmap', action='store_true', 
+                        help='read the file through a memory map and pass the packed 4+4-bit samples directly to the FFT')
+    parser.add_argument('-x', '--sk-stats', action='store_true', 
+                        help='save the per-sub-integration SK moments to a .skstats sidecar file for use by updatePsrfitsMask.py')
     args = parser.parse_args()
     main(args)
     
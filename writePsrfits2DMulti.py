@@ -16,6 +16,7 @@ from datetime import datetime
 
 import threading
 from collections import deque
+from multiprocessing import Pool, Array, Lock, cpu_count
 from multiprocessing import cpu_count
 
 import psrfits_utils.psrfits_utils as pfu
@@ -30,6 +31,7 @@ from lsl.misc.dedispersion import get_coherent_sample_size
 from lsl.misc import parser as aph
 
 from _psr import *
+from psrfitsio import get_skstats_filename, SKStatsWriter
 
 
 MAX_QUEUE_DEPTH = 3
@@ -93,6 +95,397 @@ def getFromQueue(queueName):
     return queueName.popleft()
 
 
+fileProgress = None
+outputLock = None
+
+
+def initWorker(counter, lock):
+    """
+    Pool initializer that saves the shared per-file sub-integration counters
+    and the lock used to keep the output of the workers from being mixed.
+    """
+    
+    global fileProgress
+    global outputLock
+    fileProgress = counter
+    outputLock = lock
+
+
+def convertFile(task):
+    """
+    Convert a single file in a pool worker using the alignment found by main().
+    The task is a tuple of the command line arguments, the file index, the 
+    filename, the frame, sample, and tick offsets, the number of 
+    sub-integrations to write, and the cores to run on.
+    """
+    
+    args, c, filename, frameOffset, sampleOffset, tickOffset, siCountMax, cores = task
+    
+    # Keep this file's OpenMP threads on its own set of cores
+    BindOpenMPToCores(cores)
+    
+    # FFT length
+    LFFT = args.nchan
+    
+    # Sub-integration block size
+    nsblk = args.nsblk
+    
+    DM = float(args.DM)
+    
+    # Setup the processing constraints
+    if (not args.no_summing):
+        polNames = 'I'
+        nPols = 1
+        reduceEngine = CombineToIntensity
+    elif args.stokes:
+        polNames = 'IQUV'
+        nPols = 4
+        reduceEngine = CombineToStokes
+    elif args.circular:
+        polNames = 'LLRR'
+        nPols = 2
+        reduceEngine = CombineToCircular
+    else:
+        polNames = 'XXYY'
+        nPols = 2
+        reduceEngine = CombineToLinear
+        
+    if args.four_bit_data:
+        OptimizeDataLevels = OptimizeDataLevels4Bit
+    else:
+        OptimizeDataLevels = OptimizeDataLevels8Bit
+        
+    idf = DRXFile(filename)
+    
+    # Find out how many frame sets are in each file
+    srate = idf.get_info('sample_rate')
+    beampols = idf.get_info('nbeampol')
+    tunepol = beampols
+    nFramesFile = idf.get_info('nframe')
+    spSkip = int(fS / srate)
+    
+    # Offset, if needed
+    o = 0
+    if args.skip != 0.0:
+        o = idf.offset(args.skip)
+    nFramesFile -= int(o*srate/4096)*tunepol
+    
+    # Additional seek for timetag alignment across the files
+    o += idf.offset(frameOffset*4096/srate)
+    
+    ## Date
+    tStart = idf.get_info('start_time') + sampleOffset*spSkip/fS + tickOffset/fS
+    beginDate = tStart.datetime
+    beginTime = beginDate
+    mjd = tStart.mjd
+    mjd_day = int(mjd)
+    mjd_sec = (mjd-mjd_day)*86400
+    
+    ## Tuning frequencies
+    central_freq1 = idf.get_info('freq1')
+    central_freq2 = idf.get_info('freq2')
+    beam = idf.get_info('beam')
+    
+    ## Coherent Dedispersion Setup
+    timesPerFrame = numpy.arange(4096, dtype=numpy.float64)/srate
+    spectraFreq1 = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) + central_freq1
+    spectraFreq2 = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) + central_freq2
+    
+    # File summary
+    with outputLock:
+        print(f"Input Filename: {filename} ({c+1} of {len(args.filename)})")
+        print(f"Date of First Frame: {str(beginDate)} (MJD={mjd:f})")
+        print(f"Tune/Pols: {tunepol}")
+        print(f"Tunings: {central_freq1:.1f} Hz, {central_freq2:.1f} Hz")
+        print(f"Sample Rate: {srate} Hz")
+        print(f"Sample Time: {LFFT / srate:f} s")
+        print(f"Sub-block Time: {LFFT / srate * nsblk:f} s")
+        print(f"Frames: {nFramesFile} ({4096.0*nFramesFile / srate / tunepol:.3f} s)")
+        print("---")
+        print(f"Using FFTW Wisdom? {useWisdom}")
+        print(f"DM: {DM:.4f} pc / cm^3")
+        print("Samples Needed: %i, %i to %i, %i" % (get_coherent_sample_size(central_freq1-srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq2-srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq1+srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq2+srate/2, 1.0*srate/LFFT, DM)))
+        
+    # Parameter validation
+    if get_coherent_sample_size(central_freq1-srate/2, 1.0*srate/LFFT, DM) > nsblk:
+        raise RuntimeError("Too few samples for coherent dedispersion.  Considering increasing the number of channels.")
+    elif get_coherent_sample_size(central_freq2-srate/2, 1.0*srate/LFFT, DM) > nsblk:
+        raise RuntimeError("Too few samples for coherent dedispersion.  Considering increasing the number of channels.")
+        
+    # Adjust the time for the padding used for coherent dedispersion
+    with outputLock:
+        print(f"MJD shifted by {nsblk * LFFT / srate * 1000.0:.3f} ms to account for padding")
+    beginDate = idf.get_info('start_time') + nsblk*LFFT/srate
+    beginTime = beginDate.datetime
+    mjd = beginDate.mjd
+    
+    # Create the output PSRFITS file(s)
+    pfu_out = []
+    for t in range(1, 2+1):
+        ## Basic structure and bounds
+        pfo = pfu.psrfits()
+        pfo.basefilename = f"{args.output}_b{beam}t{t}"
+        pfo.filenum = 0
+        pfo.tot_rows = pfo.N = pfo.T = pfo.status = pfo.multifile = 0
+        pfo.rows_per_file = 32768
+        
+        ## Frequency, bandwidth, and channels
+        if t == 1:
+            pfo.hdr.fctr=central_freq1/1e6
+        else:
+            pfo.hdr.fctr=central_freq2/1e6
+        pfo.hdr.BW = srate/1e6
+        pfo.hdr.nchan = LFFT
+        pfo.hdr.df = srate/1e6/LFFT
+        pfo.hdr.dt = LFFT / srate
+        
+        ## Metadata about the observation/observatory/pulsar
+        pfo.hdr.observer = "writePsrfits2Multi.py"
+        pfo.hdr.source = args.source
+        pfo.hdr.fd_hand = 1
+        pfo.hdr.nbits = 4 if args.four_bit_data else 8
+        pfo.hdr.nsblk = nsblk
+        pfo.hdr.ds_freq_fact = 1
+        pfo.hdr.ds_time_fact = 1
+        pfo.hdr.npol = nPols
+        pfo.hdr.summed_polns = 1 if (not args.no_summing) else 0
+        pfo.hdr.obs_mode = "SEARCH"
+        pfo.hdr.telescope = "LWA"
+        pfo.hdr.frontend = "LWA"
+        pfo.hdr.backend = "DRX"
+        pfo.hdr.project_id = "Pulsar"
+        pfo.hdr.ra_str = args.ra
+        pfo.hdr.dec_str = args.dec
+        pfo.hdr.poln_type = "LIN" if not args.circular else "CIRC"
+        pfo.hdr.poln_order = polNames
+        pfo.hdr.date_obs = str(beginTime.strftime("%Y-%m-%dT%H:%M:%S"))     
+        pfo.hdr.MJD_epoch = pfu.get_ld(mjd)
+        
+        ## Coherent dedispersion information
+        pfo.hdr.chan_dm = DM
+        
+        
+        ## Setup the subintegration structure
+        pfo.sub.tsubint = pfo.hdr.dt*pfo.hdr.nsblk
+        pfo.sub.bytes_per_subint = pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk*pfo.hdr.nbits//8
+        pfo.sub.dat_freqs   = pfu.malloc_doublep(pfo.hdr.nchan*8)				# 8-bytes per double @ LFFT channels
+        pfo.sub.dat_weights = pfu.malloc_floatp(pfo.hdr.nchan*4)				# 4-bytes per float @ LFFT channels
+        pfo.sub.dat_offsets = pfu.malloc_floatp(pfo.hdr.nchan*pfo.hdr.npol*4)		# 4-bytes per float @ LFFT channels per pol.
+        pfo.sub.dat_scales  = pfu.malloc_floatp(pfo.hdr.nchan*pfo.hdr.npol*4)		# 4-bytes per float @ LFFT channels per pol.
+        if args.four_bit_data:
+            pfo.sub.data = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk)	# 1-byte per unsigned char @ (LFFT channels x pols. x nsblk sub-integrations) samples
+            pfo.sub.rawdata = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk//2)	# 4-bits per nibble @ (LFFT channels x pols. x nsblk sub-integrations) samples
+        else:
+            pfo.sub.rawdata = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk)	# 1-byte per unsigned char @ (LFFT channels x pols. x nsblk sub-integrations) samples
+            
+        ## Create and save it for later use
+        pfu.psrfits_create(pfo)
+        pfu_out.append(pfo)
+        
+    # Setup the SK moments sidecar files, if requested
+    skStats = []
+    if args.sk_stats:
+        for pfo in pfu_out:
+            skStats.append( SKStatsWriter(get_skstats_filename(pfo.filename), 2, LFFT, nsblk) )
+            
+    freqBaseMHz = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) / 1e6
+    for i in range(len(pfu_out)):
+        # Define the frequencies available in the file (in MHz)
+        pfu.convert2_double_array(pfu_out[i].sub.dat_freqs, freqBaseMHz + pfu_out[i].hdr.fctr, LFFT)
+        
+        # Define which part of the spectra are good (1) or bad (0).  All channels
+        # are good except for the two outermost.
+        pfu.convert2_float_array(pfu_out[i].sub.dat_weights, numpy.ones(LFFT),  LFFT)
+        pfu.set_float_value(pfu_out[i].sub.dat_weights, 0,      0)
+        pfu.set_float_value(pfu_out[i].sub.dat_weights, LFFT-1, 0)
+        
+        # Define the data scaling (default is a scale of one and an offset of zero)
+        pfu.convert2_float_array(pfu_out[i].sub.dat_offsets, numpy.zeros(LFFT*nPols), LFFT*nPols)
+        pfu.convert2_float_array(pfu_out[i].sub.dat_scales,  numpy.ones(LFFT*nPols),  LFFT*nPols)
+        
+    # Speed things along, the data need to be processed in units of 'nsblk'.  
+    # Find out how many frames per tuning/polarization that corresponds to.
+    chunkSize = nsblk*LFFT//4096
+    chunkTime = LFFT/srate*nsblk
+    
+    # Frequency arrays for use with the phase rotator
+    freq1 = central_freq1 + numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) )
+    freq2 = central_freq2 + numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) )
+    
+    # Calculate the SK limites for weighting
+    if (not args.no_sk_flagging):
+        skLimits = kurtosis.get_limits(4.0, 1.0*nsblk)
+        
+        GenerateMask = lambda x: ComputeSKMask(x, skLimits[0], skLimits[1])
+    else:
+        def GenerateMask(x):
+            flag = numpy.ones((4, LFFT), dtype=numpy.float32)
+            flag[:,0] = 0.0
+            flag[:,-1] = 0.0
+            return flag
+            
+    # Pre-read the first frame so that we have something to pad with, if needed.
+    # This is also where the end of the previous chunk is kept so that the
+    # sample offset can be applied by PulsarEngineRaw.
+    if sampleOffset != 0:
+        # Pre-read the first frame
+        readT, t, dataPrev = idf.read(4096/srate)
+        
+    # Go!
+    rdr = threading.Thread(target=reader, args=(idf, chunkTime, readerQ), kwargs={'core':cores[0], 'verbose':False})
+    rdr.setDaemon(True)
+    rdr.start()
+    
+    # Unpack - Previous data
+    incoming = getFromQueue(readerQ)
+    siCount, t, rawdata = incoming
+    if sampleOffset != 0:
+        rawSpectraPrev = PulsarEngineRaw(rawdata, LFFT, prevSignals=dataPrev, offset=dataPrev.shape[1]-4096+sampleOffset)
+        dataPrev = rawdata
+    else:
+        rawSpectraPrev = PulsarEngineRaw(rawdata, LFFT)
+    if tickOffset != 0:
+        PhaseRotator(rawSpectraPrev, freq1, freq2, tickOffset/fS, rawSpectraPrev)
+    
+    # Unpack - Current data
+    incoming = getFromQueue(readerQ)
+    siCount, t, rawdata = incoming
+    if sampleOffset != 0:
+        rawSpectra = PulsarEngineRaw(rawdata, LFFT, prevSignals=dataPrev, offset=dataPrev.shape[1]-4096+sampleOffset)
+        dataPrev = rawdata
+    else:
+        rawSpectra = PulsarEngineRaw(rawdata, LFFT)
+    if tickOffset != 0:
+        PhaseRotator(rawSpectra, freq1, freq2, tickOffset/fS, rawSpectra)
+    
+    # Main Loop
+    incoming = getFromQueue(readerQ)
+    while incoming[0] is not None:
+        ## Unpack
+        siCount, t, rawdata = incoming
+        
+        ## Check to see where we are
+        if siCount > siCountMax:
+            ### Looks like we are done, allow the reader to finish
+            incoming = getFromQueue(readerQ)
+            continue
+            
+        ## FFT - The sample offset is applied here by starting the FFT windows
+        ## sampleOffset samples into the last frame of the previous chunk
+        if sampleOffset != 0:
+            try:
+                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT, rawSpectraNext, prevSignals=dataPrev, offset=dataPrev.shape[1]-4096+sampleOffset)
+            except NameError:
+                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT, prevSignals=dataPrev, offset=dataPrev.shape[1]-4096+sampleOffset)
+            dataPrev = rawdata
+        else:
+            try:
+                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT, rawSpectraNext)
+            except NameError:
+                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT)
+                
+        ## Apply the sub-sample offset as a phase rotation
+        if tickOffset != 0:
+            PhaseRotator(rawSpectraNext, freq1, freq2, tickOffset/fS, rawSpectraNext)
+            
+        ## S-K flagging
+        flag = GenerateMask(rawSpectra)
+        weight1 = numpy.where( flag[:2,:].sum(axis=0) == 0, 0, 1 ).astype(numpy.float32)
+        weight2 = numpy.where( flag[2:,:].sum(axis=0) == 0, 0, 1 ).astype(numpy.float32)
+        ff1 = 1.0*(LFFT - weight1.sum()) / LFFT
+        ff2 = 1.0*(LFFT - weight2.sum()) / LFFT
+        
+        ## S-K moments
+        if args.sk_stats:
+            try:
+                skMoments = ComputeSKMoments(rawSpectra, skMoments)
+            except NameError:
+                skMoments = ComputeSKMoments(rawSpectra)
+                
+        ## Dedisperse
+        try:
+            rawSpectraDedispersed = MultiChannelCD(rawSpectra, spectraFreq1, spectraFreq2,
+                                                   1.0*srate/LFFT, DM, 
+                                                   rawSpectraPrev, 
+                                                   rawSpectraNext, 
+                                                   rawSpectraDedispersed)
+        except NameError:
+            rawSpectraDedispersed = MultiChannelCD(rawSpectra, spectraFreq1, spectraFreq2,
+                                                   1.0*srate/LFFT, DM, 
+                                                   rawSpectraPrev, 
+                                                   rawSpectraNext)
+                                                   
+        ## Update the state variables used to get the CD process continuous
+        rawSpectraPrev[...] = rawSpectra
+        rawSpectra[...] = rawSpectraNext
+        
+        ## Detect power
+        try:
+            redData = reduceEngine(rawSpectraDedispersed, redData)
+        except NameError:
+            redData = reduceEngine(rawSpectraDedispersed)
+            
+        ## Optimal data scaling
+        try:
+            bzero, bscale, bdata = OptimizeDataLevels(redData, LFFT, bzero, bscale, bdata)
+        except NameError:
+            bzero, bscale, bdata = OptimizeDataLevels(redData, LFFT)
+            
+        ## Polarization mangling
+        bzero1 = bzero[:nPols,:].T.ravel()
+        bzero2 = bzero[nPols:,:].T.ravel()
+        bscale1 = bscale[:nPols,:].T.ravel()
+        bscale2 = bscale[nPols:,:].T.ravel()
+        bdata1 = bdata[:nPols,:].T.ravel()
+        bdata2 = bdata[nPols:,:].T.ravel()
+        
+        ## Write the spectra to the PSRFITS files
+        for j,sp,bz,bs,wt in zip(range(2), (bdata1, bdata2), (bzero1, bzero2), (bscale1, bscale2), (weight1, weight2)):
+            ## Time
+            pfu_out[j].sub.offs = (pfu_out[j].tot_rows)*pfu_out[j].hdr.nsblk*pfu_out[j].hdr.dt+pfu_out[j].hdr.nsblk*pfu_out[j].hdr.dt/2.0
+            
+            ## Data
+            ptr, junk = sp.__array_interface__['data']
+            if args.four_bit_data:
+                ctypes.memmove(int(pfu_out[j].sub.data), ptr, pfu_out[j].hdr.nchan*nPols*pfu_out[j].hdr.nsblk)
+            else:
+                ctypes.memmove(int(pfu_out[j].sub.rawdata), ptr, pfu_out[j].hdr.nchan*nPols*pfu_out[j].hdr.nsblk)
+                
+            ## Zero point
+            ptr, junk = bz.__array_interface__['data']
+            ctypes.memmove(int(pfu_out[j].sub.dat_offsets), ptr, pfu_out[j].hdr.nchan*nPols*4)
+            
+            ## Scale factor
+            ptr, junk = bs.__array_interface__['data']
+            ctypes.memmove(int(pfu_out[j].sub.dat_scales), ptr, pfu_out[j].hdr.nchan*nPols*4)
+            
+            ## SK
+            ptr, junk = wt.__array_interface__['data']
+            ctypes.memmove(int(pfu_out[j].sub.dat_weights), ptr, pfu_out[j].hdr.nchan*4)
+            
+            ## SK moments
+            if args.sk_stats:
+                skStats[j].write(pfu_out[j].tot_rows, skMoments[:,2*j:2*j+2,:])
+                
+            ## Save
+            pfu.psrfits_write_subint(pfu_out[j])
+            
+        ## Report our progress back to the parent
+        with fileProgress.get_lock():
+            fileProgress[c] += 1
+            
+        ## Fetch another one
+        incoming = getFromQueue(readerQ)
+        
+    rdr.join()
+    
+    # And close out the files
+    for pfo in pfu_out:
+        pfu.psrfits_close(pfo)
+    for sks in skStats:
+        sks.close()
+
+
 def main(args):
     # Parse command line options
     args.filename.sort()
@@ -208,346 +601,46 @@ def main(args):
         print("=> Accepted via the command line")
     print(" ")
     
-    # Setup the processing constraints
-    if (not args.no_summing):
-        polNames = 'I'
-        nPols = 1
-        reduceEngine = CombineToIntensity
-    elif args.stokes:
-        polNames = 'IQUV'
-        nPols = 4
-        reduceEngine = CombineToStokes
-    elif args.circular:
-        polNames = 'LLRR'
-        nPols = 2
-        reduceEngine = CombineToCircular
-    else:
-        polNames = 'XXYY'
-        nPols = 2
-        reduceEngine = CombineToLinear
-        
-    if args.four_bit_data:
-        OptimizeDataLevels = OptimizeDataLevels4Bit
-    else:
-        OptimizeDataLevels = OptimizeDataLevels8Bit
+    # Default output basename
+    if args.output is None:
+        idf = DRXFile(args.filename[0])
+        mjd_day = int(idf.get_info('start_time').mjd)
+        idf.close()
+        args.output = f"drx_{mjd_day:05d}_{args.source.replace(' ', '')}"
         
+    # Divide up the cores so that each file has its own set
+    nCore = cpu_count()
+    coresPerFile = max([1, nCore // len(args.filename)])
+    
+    tasks = []
     for c,filename,frameOffset,sampleOffset,tickOffset in zip(range(len(args.filename)), args.filename, frameOffsets, sampleOffsets, tickOffsets):
-        idf = DRXFile(filename)
-            
-        # Find out how many frame sets are in each file
-        srate = idf.get_info('sample_rate')
-        beampols = idf.get_info('nbeampol')
-        tunepol = beampols
-        nFramesFile = idf.get_info('nframe')
-        
-        # Offset, if needed
-        o = 0
-        if args.skip != 0.0:
-            o = idf.offset(args.skip)
-        nFramesFile -= int(o*srate/srate)*tunepol
-        
-        # Additional seek for timetag alignment across the files
-        o += idf.offset(frameOffset*4096/srate)
-        
-        ## Date
-        tStart = idf.get_info('start_time') + sampleOffset*spSkip/fS + tickOffset/fS
-        beginDate = tStart.datetime
-        beginTime = beginDate
-        mjd = tStart.mjd
-        mjd_day = int(mjd)
-        mjd_sec = (mjd-mjd_day)*86400
-        if args.output is None:
-            args.output = f"drx_{mjd_day:05d}_{args.source.replace(' ', '')}"
-            
-        ## Tuning frequencies
-        central_freq1 = idf.get_info('freq1')
-        central_freq2 = idf.get_info('freq2')
-        beam = idf.get_info('beam')
-        
-        ## Coherent Dedispersion Setup
-        timesPerFrame = numpy.arange(4096, dtype=numpy.float64)/srate
-        spectraFreq1 = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) + central_freq1
-        spectraFreq2 = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) + central_freq2
-        
-        # File summary
-        print(f"Input Filename: {filename} ({c+1} of {len(args.filename)}")
-        print(f"Date of First Frame: {str(beginDate)} (MJD={mjd:f})")
-        print(f"Tune/Pols: {tunepol}")
-        print(f"Tunings: {central_freq1:.1f} Hz, {central_freq2:.1f} Hz")
-        print(f"Sample Rate: {srate} Hz")
-        print(f"Sample Time: {LFFT / srate:f} s")
-        print(f"Sub-block Time: {LFFT / srate * nsblk:f} s")
-        print(f"Frames: {nFramesFile} ({4096.0*nFramesFile / srate / tunepol:.3f} s)")
-        print("---")
-        print(f"Using FFTW Wisdom? {useWisdom}")
-        print(f"DM: {DM:.4f} pc / cm^3")
-        print("Samples Needed: %i, %i to %i, %i" % (get_coherent_sample_size(central_freq1-srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq2-srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq1+srate/2, 1.0*srate/LFFT, DM), get_coherent_sample_size(central_freq2+srate/2, 1.0*srate/LFFT, DM)))
-        
-        # Parameter validation
-        if get_coherent_sample_size(central_freq1-srate/2, 1.0*srate/LFFT, DM) > nsblk:
-            raise RuntimeError("Too few samples for coherent dedispersion.  Considering increasing the number of channels.")
-        elif get_coherent_sample_size(central_freq2-srate/2, 1.0*srate/LFFT, DM) > nsblk:
-            raise RuntimeError("Too few samples for coherent dedispersion.  Considering increasing the number of channels.")
-            
-        # Adjust the time for the padding used for coherent dedispersion
-        print(f"MJD shifted by {nsblk * LFFT / srate * 1000.0:.3f} ms to account for padding")
-        beginDate = idf.get_info('start_time') + nsblk*LFFT/srate
-        beginTime = beginDate.datetime
-        mjd = beginDate.mjd
-        
-        # Create the output PSRFITS file(s)
-        pfu_out = []
-        for t in range(1, 2+1):
-            ## Basic structure and bounds
-            pfo = pfu.psrfits()
-            pfo.basefilename = f"{args.output}_b{beam}t{t}"
-            pfo.filenum = 0
-            pfo.tot_rows = pfo.N = pfo.T = pfo.status = pfo.multifile = 0
-            pfo.rows_per_file = 32768
-            
-            ## Frequency, bandwidth, and channels
-            if t == 1:
-                pfo.hdr.fctr=central_freq1/1e6
-            else:
-                pfo.hdr.fctr=central_freq2/1e6
-            pfo.hdr.BW = srate/1e6
-            pfo.hdr.nchan = LFFT
-            pfo.hdr.df = srate/1e6/LFFT
-            pfo.hdr.dt = LFFT / srate
-            
-            ## Metadata about the observation/observatory/pulsar
-            pfo.hdr.observer = "writePsrfits2Multi.py"
-            pfo.hdr.source = args.source
-            pfo.hdr.fd_hand = 1
-            pfo.hdr.nbits = 4 if args.four_bit_data else 8
-            pfo.hdr.nsblk = nsblk
-            pfo.hdr.ds_freq_fact = 1
-            pfo.hdr.ds_time_fact = 1
-            pfo.hdr.npol = nPols
-            pfo.hdr.summed_polns = 1 if (not args.no_summing) else 0
-            pfo.hdr.obs_mode = "SEARCH"
-            pfo.hdr.telescope = "LWA"
-            pfo.hdr.frontend = "LWA"
-            pfo.hdr.backend = "DRX"
-            pfo.hdr.project_id = "Pulsar"
-            pfo.hdr.ra_str = args.ra
-            pfo.hdr.dec_str = args.dec
-            pfo.hdr.poln_type = "LIN" if not args.circular else "CIRC"
-            pfo.hdr.poln_order = polNames
-            pfo.hdr.date_obs = str(beginTime.strftime("%Y-%m-%dT%H:%M:%S"))     
-            pfo.hdr.MJD_epoch = pfu.get_ld(mjd)
-            
-            ## Coherent dedispersion information
-            pfo.hdr.chan_dm = DM
-            
-            
-            ## Setup the subintegration structure
-            pfo.sub.tsubint = pfo.hdr.dt*pfo.hdr.nsblk
-            pfo.sub.bytes_per_subint = pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk*pfo.hdr.nbits//8
-            pfo.sub.dat_freqs   = pfu.malloc_doublep(pfo.hdr.nchan*8)				# 8-bytes per double @ LFFT channels
-            pfo.sub.dat_weights = pfu.malloc_floatp(pfo.hdr.nchan*4)				# 4-bytes per float @ LFFT channels
-            pfo.sub.dat_offsets = pfu.malloc_floatp(pfo.hdr.nchan*pfo.hdr.npol*4)		# 4-bytes per float @ LFFT channels per pol.
-            pfo.sub.dat_scales  = pfu.malloc_floatp(pfo.hdr.nchan*pfo.hdr.npol*4)		# 4-bytes per float @ LFFT channels per pol.
-            if args.four_bit_data:
-                pfo.sub.data = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk)	# 1-byte per unsigned char @ (LFFT channels x pols. x nsblk sub-integrations) samples
-                pfo.sub.rawdata = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk//2)	# 4-bits per nibble @ (LFFT channels x pols. x nsblk sub-integrations) samples
-            else:
-                pfo.sub.rawdata = pfu.malloc_ucharp(pfo.hdr.nchan*pfo.hdr.npol*pfo.hdr.nsblk)	# 1-byte per unsigned char @ (LFFT channels x pols. x nsblk sub-integrations) samples
-                
-            ## Create and save it for later use
-            pfu.psrfits_create(pfo)
-            pfu_out.append(pfo)
-            
-        freqBaseMHz = numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) ) / 1e6
-        for i in range(len(pfu_out)):
-            # Define the frequencies available in the file (in MHz)
-            pfu.convert2_double_array(pfu_out[i].sub.dat_freqs, freqBaseMHz + pfu_out[i].hdr.fctr, LFFT)
-            
-            # Define which part of the spectra are good (1) or bad (0).  All channels
-            # are good except for the two outermost.
-            pfu.convert2_float_array(pfu_out[i].sub.dat_weights, numpy.ones(LFFT),  LFFT)
-            pfu.set_float_value(pfu_out[i].sub.dat_weights, 0,      0)
-            pfu.set_float_value(pfu_out[i].sub.dat_weights, LFFT-1, 0)
-            
-            # Define the data scaling (default is a scale of one and an offset of zero)
-            pfu.convert2_float_array(pfu_out[i].sub.dat_offsets, numpy.zeros(LFFT*nPols), LFFT*nPols)
-            pfu.convert2_float_array(pfu_out[i].sub.dat_scales,  numpy.ones(LFFT*nPols),  LFFT*nPols)
-            
-        # Speed things along, the data need to be processed in units of 'nsblk'.  
-        # Find out how many frames per tuning/polarization that corresponds to.
-        chunkSize = nsblk*LFFT//4096
-        chunkTime = LFFT/srate*nsblk
-        
-        # Frequency arrays for use with the phase rotator
-        freq1 = central_freq1 + numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) )
-        freq2 = central_freq2 + numpy.fft.fftshift( numpy.fft.fftfreq(LFFT, d=1.0/srate) )
-        
-        # Calculate the SK limites for weighting
-        if (not args.no_sk_flagging):
-            skLimits = kurtosis.get_limits(4.0, 1.0*nsblk)
-            
-            GenerateMask = lambda x: ComputeSKMask(x, skLimits[0], skLimits[1])
-        else:
-            def GenerateMask(x):
-                flag = numpy.ones((4, LFFT), dtype=numpy.float32)
-                flag[:,0] = 0.0
-                flag[:,-1] = 0.0
-                return flag
-                
-        # Create the progress bar so that we can keep up with the conversion.
-        pbar = progress.ProgressBarPlus(max=siCountMax, span=52)
+        cores = [(c*coresPerFile + j) % nCore for j in range(coresPerFile)]
+        tasks.append( (args, c, filename, frameOffset, sampleOffset, tickOffset, siCountMax, cores) )
         
-        # Pre-read the first frame so that we have something to pad with, if needed
-        if sampleOffset != 0:
-            # Pre-read the first frame
-            readT, t, dataPrev = idf.read(4096/srate)
-            
-        # Go!
-        rdr = threading.Thread(target=reader, args=(idf, chunkTime, readerQ), kwargs={'core':0})
-        rdr.setDaemon(True)
-        rdr.start()
-        
-        # Unpack - Previous data
-        incoming = getFromQueue(readerQ)
-        siCount, t, rawdata = incoming
-        rawSpectraPrev = PulsarEngineRaw(rawdata,LFFT)
-        
-        # Unpack - Current data
-        incoming = getFromQueue(readerQ)
-        siCount, t, rawdata = incoming
-        rawSpectra = PulsarEngineRaw(rawdata, LFFT)
-        
-        # Main Loop
-        incoming = getFromQueue(readerQ)
-        while incoming[0] is not None:
-            ## Unpack
-            siCount, t, rawdata = incoming
-            
-            ## Check to see where we are
-            if siCount > siCountMax:
-                ### Looks like we are done, allow the reader to finish
-                incoming = getFromQueue(readerQ)
-                continue
-                
-            ## Apply the sample offset
-            if sampleOffset != 0:
-                try:
-                    dataComb[:,:4096] = dataPrev
-                except NameError:
-                    dataComb = numpy.zeros((rawdata.shape[0], rawdata.shape[1]+4096), dtype=rawdata.dtype)
-                    dataComb[:,:4096] = dataPrev
-                dataComb[:,4096:] = rawdata
-                dataPrev = dataComb[:,-4096:]
-                rawdata[...] = dataComb[:,sampleOffset:sampleOffset+4096*chunkSize]
-                
-            ## FFT
-            try:
-                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT, rawSpectraNext)
-            except NameError:
-                rawSpectraNext = PulsarEngineRaw(rawdata, LFFT)
-                
-            ## Apply the sub-sample offset as a phase rotation
-            if tickOffset != 0:
-                PhaseRotator(rawSpectra, freq1, freq2, tickOffset/fS, rawSpectra)
-                
-            ## S-K flagging
-            flag = GenerateMask(rawSpectra)
-            weight1 = numpy.where( flag[:2,:].sum(axis=0) == 0, 0, 1 ).astype(numpy.float32)
-            weight2 = numpy.where( flag[2:,:].sum(axis=0) == 0, 0, 1 ).astype(numpy.float32)
-            ff1 = 1.0*(LFFT - weight1.sum()) / LFFT
-            ff2 = 1.0*(LFFT - weight2.sum()) / LFFT
-            
-            ## Dedisperse
-            try:
-                rawSpectraDedispersed = MultiChannelCD(rawSpectra, spectraFreq1, spectraFreq2,
-                                                       1.0*srate/LFFT, DM, 
-                                                       rawSpectraPrev, 
-                                                       rawSpectraNext, 
-                                                       rawSpectraDedispersed)
-            except NameError:
-                rawSpectraDedispersed = MultiChannelCD(rawSpectra, spectraFreq1, spectraFreq2,
-                                                       1.0*srate/LFFT, DM, 
-                                                       rawSpectraPrev, 
-                                                       rawSpectraNext)
-                
-            ## Update the state variables used to get the CD process continuous
-            rawSpectraPrev[...] = rawSpectra
-            rawSpectra[...] = rawSpectraNext
-            
-            ## Detect power
-            try:
-                redData = reduceEngine(rawSpectraDedispersed, redData)
-            except NameError:
-                redData = reduceEngine(rawSpectraDedispersed)
-                
-            ## Optimal data scaling
-            try:
-                bzero, bscale, bdata = OptimizeDataLevels(redData, LFFT, bzero, bscale, bdata)
-            except NameError:
-                bzero, bscale, bdata = OptimizeDataLevels(redData, LFFT)
-                
-            ## Polarization mangling
-            bzero1 = bzero[:nPols,:].T.ravel()
-            bzero2 = bzero[nPols:,:].T.ravel()
-            bscale1 = bscale[:nPols,:].T.ravel()
-            bscale2 = bscale[nPols:,:].T.ravel()
-            bdata1 = bdata[:nPols,:].T.ravel()
-            bdata2 = bdata[nPols:,:].T.ravel()
-            
-            ## Write the spectra to the PSRFITS files
-            for j,sp,bz,bs,wt in zip(range(2), (bdata1, bdata2), (bzero1, bzero2), (bscale1, bscale2), (weight1, weight2)):
-                ## Time
-                pfu_out[j].sub.offs = (pfu_out[j].tot_rows)*pfu_out[j].hdr.nsblk*pfu_out[j].hdr.dt+pfu_out[j].hdr.nsblk*pfu_out[j].hdr.dt/2.0
-                
-                ## Data
-                ptr, junk = sp.__array_interface__['data']
-                if args.four_bit_data:
-                    ctypes.memmove(int(pfu_out[j].sub.data), ptr, pfu_out[j].hdr.nchan*nPols*pfu_out[j].hdr.nsblk)
-                else:
-                    ctypes.memmove(int(pfu_out[j].sub.rawdata), ptr, pfu_out[j].hdr.nchan*nPols*pfu_out[j].hdr.nsblk)
-                    
-                ## Zero point
-                ptr, junk = bz.__array_interface__['data']
-                ctypes.memmove(int(pfu_out[j].sub.dat_offsets), ptr, pfu_out[j].hdr.nchan*nPols*4)
-                
-                ## Scale factor
-                ptr, junk = bs.__array_interface__['data']
-                ctypes.memmove(int(pfu_out[j].sub.dat_scales), ptr, pfu_out[j].hdr.nchan*nPols*4)
-                
-                ## SK
-                ptr, junk = wt.__array_interface__['data']
-                ctypes.memmove(int(pfu_out[j].sub.dat_weights), ptr, pfu_out[j].hdr.nchan*4)
-                
-                ## Save
-                pfu.psrfits_write_subint(pfu_out[j])
-                
-            ## Update the progress bar and remaining time estimate
-            pbar.inc()
-            sys.stdout.write('%5.1f%% %5.1f%% %s %2i\r' % (ff1*100, ff2*100, pbar.show(), len(readerQ)))
-            sys.stdout.flush()
-            
-            ## Fetch another one
-            incoming = getFromQueue(readerQ)
-            
-        rdr.join()
-        if sampleOffset != 0:
-            del dataComb
-        del rawSpectra
-        del redData
-        del bzero
-        del bscale
-        del bdata
-        
-        # Update the progress bar with the total time used but only if we have
-        # reached the end of the file
-        if incoming[1]:
-            pbar.amount = pbar.max
-        sys.stdout.write('              %s %2i\n' % (pbar.show(), len(readerQ)))
+    # Create the progress bar so that we can keep up with the conversion.  The
+    # first two sub-blocks of each file only prime the dedispersion.
+    pbar = progress.ProgressBarPlus(max=(siCountMax-2)*len(args.filename), span=52)
+    
+    # Go!
+    counter = Array('l', len(args.filename))
+    pool = Pool(processes=len(args.filename), initializer=initWorker, initargs=(counter, Lock()))
+    result = pool.map_async(convertFile, tasks)
+    while not result.ready():
+        with counter.get_lock():
+            done = list(counter)
+        pbar.amount = min([sum(done), pbar.max])
+        sys.stdout.write('%s %s\r' % (' '.join(['%5.1f%%' % (100.0*d/(siCountMax-2)) for d in done]), pbar.show()))
         sys.stdout.flush()
-        
-        # And close out the files
-        for pfo in pfu_out:
-            pfu.psrfits_close(pfo)
+        result.wait(0.5)
+    pool.close()
+    pool.join()
+    
+    # Raise any errors from the workers
+    result.get()
+    
+    pbar.amount = pbar.max
+    sys.stdout.write('%s %s\n' % (' '.join(['%5.1f%%' % 100.0,]*len(args.filename)), pbar.show()))
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
@@ -591,6 +684,8 @@ if __name__ == "__main__":
                         help='enable sub-sample delay correction')
     parser.add_argument('-y', '--yes', action='store_true', 
                         help='accept the file alignment as is')
+    parser.add_argument('-x', '--sk-stats', action='store_true', 
+                        help='save the per-sub-integration SK moments to a .skstats sidecar file for use by updatePsrfitsMask.py')
     args = parser.parse_args()
     main(args)
     
@@ -6,11 +6,15 @@ Given an HDF5 file from drspec2hdf.py, create one of more PSRFITS file(s).
 
 import os
 import sys
+import time
 import h5py
 import numpy
 import ctypes
 import argparse
+import threading
+import traceback
 from datetime import datetime
+from collections import deque
 
 from astropy.time import Time as AstroTime
 
@@ -24,6 +28,10 @@ from lsl.misc import parser as aph
 from _psr import *
 
 
+MAX_QUEUE_DEPTH = 3
+readerQ = deque()
+
+
 def resolveTarget(name):
     from astropy import units
     from astropy.coordinates import SkyCoord
@@ -41,7 +49,64 @@ def resolveTarget(name):
     return raS, decS, serviceS
 
 
+def reader(obs1, tunings, data_products, nsblk, chanOffset, nSubInts, outQueue, freeBuffers, failures):
+    """
+    Read ahead whole sub-blocks of spectra from the HDF5 file.  Each data 
+    product is read as a single (nsblk, nchan) hyperslab directly into a 
+    recycled (product, nsblk, LFFT) buffer taken from freeBuffers.  The
+    buffer needs to be returned to freeBuffers once it has been used.  Any
+    exception is added to the failures list.
+    """
+    
+    # Setup
+    done = False
+    
+    try:
+        for i in range(nSubInts):
+            while len(outQueue) >= MAX_QUEUE_DEPTH or len(freeBuffers) == 0:
+                time.sleep(0.001)
+                
+            ## Read in the time tags
+            sel = numpy.s_[i*nsblk:(i+1)*nsblk]
+            times = obs1['time'][sel]
+            if times.dtype.names is not None:
+                times = times['int'] + times['frac']
+            times = times.astype(numpy.float64)
+            
+            ## Read in the data
+            data = freeBuffers.popleft()
+            k = 0
+            for t in tunings:
+                if t is None:
+                    continue
+                    
+                for p in data_products:
+                    t[p].read_direct(data[k], numpy.s_[sel,:], numpy.s_[:,chanOffset:])
+                    k += 1
+                    
+            ## Add it to the queue
+            outQueue.append( (i,times,data) )
+        done = True
+        
+    except Exception as e:
+        lines = traceback.format_exc()
+        lines = '\x1b[2KReader Error '+lines
+        print(lines,)
+        failures.append(e)
+        
+    outQueue.append( (None,done) )
+
+
+def getFromQueue(queueName):
+    while len(queueName) == 0:
+        time.sleep(0.001)
+    return queueName.popleft()
+
+
 def main(args):
+    global MAX_QUEUE_DEPTH
+    MAX_QUEUE_DEPTH = min([args.queue_depth, 10])
+    
     # Open the file and load in basic information about the observation's goal
     fh = h5py.File(args.filename, 'r')
     if len(fh.keys()) != 1 or 'Observation1' not in fh:
@@ -326,45 +391,39 @@ def main(args):
     # Create the progress bar so that we can keep up with the conversion.
     pbar = progress.ProgressBarPlus(max=nFramesFile//chunkSize, span=55)
     
+    # Setup the read buffers.  These have a shape of (product, nsblk, LFFT) so
+    # that each product is a contiguous block that can be filled in one read.  
+    # Any channels not contained in the input HDF5 file stay at zero.
+    nProducts = 2*len(data_products)
+    freeBuffers = deque()
+    for i in range(MAX_QUEUE_DEPTH+1):
+        freeBuffers.append( numpy.zeros((nProducts, chunkSize, LFFT), dtype=numpy.float64) )
+        
     # Go!
-    done = False
-    
-    siCount = 0
     nSubInts = nFramesFile // chunkSize
-    for i in range(nSubInts):
-        ## Read in the data
-        data = numpy.zeros((2*len(data_products), LFFT*chunkSize), dtype=numpy.float64)
+    failures = []
+    rdr = threading.Thread(target=reader, args=(obs1, (obs1tuning1, obs1tuning2), data_products, chunkSize, chanOffset, nSubInts, readerQ, freeBuffers, failures))
+    rdr.daemon = True
+    rdr.start()
+    
+    # Main Loop
+    incoming = getFromQueue(readerQ)
+    while incoming[0] is not None:
+        ## Unpack
+        siCount, nTime, buffer = incoming
+        data = buffer.reshape(nProducts, -1)
         
-        for j in range(chunkSize):
-            jP = j + i*chunkSize
-            nTime = obs1['time'][jP]
-            try:
-                nTime = nTime['int'] + nTime['frac']
-            except ValueError:
-                pass
-                
-            try:
-                if nTime > oTime + 1.001*tInt:
-                    # pylint: disable-next=bad-string-format-type
-                    print(f"Warning: Time tag error in subint. {siCount}; {nTime:.3f} > {oTime:.3f} + {tInt:.3f}")
-            except NameError:
-                pass
-            oTime = nTime
-            
-            k = 0
-            for t in (obs1tuning1, obs1tuning2):
-                if t is None:
-                    continue
-                    
-                for p in data_products:
-                    data[k, j*LFFT+chanOffset:(j+1)*LFFT] = t[p][jP,:]
-                    k += 1
-        siCount += 1
+        ## Check the time tags for continuity, including the boundary with the
+        ## previous sub-block
+        try:
+            pTime = numpy.concatenate([[oTime], nTime[:-1]])
+        except NameError:
+            pTime = numpy.concatenate([[nTime[0]], nTime[:-1]])
+        for j in numpy.where(nTime > pTime + 1.001*tInt)[0]:
+            # pylint: disable-next=bad-string-format-type
+            print(f"Warning: Time tag error in subint. {siCount}; {nTime[j]:.3f} > {pTime[j]:.3f} + {tInt:.3f}")
+        oTime = nTime[-1]
         
-        ## Are we done yet?
-        if done:
-            break
-            
         ## FFT
         spectra = data
         
@@ -378,6 +437,9 @@ def main(args):
         ## Detect power
         data = reduceEngine(spectra)
         
+        ## Return the read buffer
+        freeBuffers.append( buffer )
+        
         ## Optimal data scaling
         bzero, bscale, bdata = OptimizeDataLevels(data, LFFT)
         
@@ -424,6 +486,11 @@ def main(args):
         sys.stdout.write('%5.1f%% %5.1f%% %s\r' % (ff1*100, ff2*100, pbar.show()))
         sys.stdout.flush()
         
+        ## Fetch another one
+        incoming = getFromQueue(readerQ)
+        
+    rdr.join()
+    
     # Update the progress bar with the total time used
     sys.stdout.write('              %s\n' % pbar.show())
     sys.stdout.flush()
@@ -431,6 +498,12 @@ def main(args):
     # And close out the files
     for pfo in pfu_out:
         pfu.psrfits_close(pfo)
+        
+    # Stop if anything went wrong in the reader, removing the incomplete files
+    if failures:
+        for pfo in pfu_out:
+            os.unlink(pfo.filename)
+        raise RuntimeError(f"Conversion failed: {failures[0]}") from failures[0]
 
 
 if __name__ == "__main__":
@@ -459,6 +532,8 @@ if __name__ == "__main__":
                         help='declination; sDD:MM:SS.S, J2000')
     parser.add_argument('-4', '--four-bit-data', action='store_true', 
                         help='save the spectra in 4-bit mode instead of 8-bit mode')
+    parser.add_argument('-q', '--queue-depth', type=aph.positive_int, default=3, 
+                        help='reader queue depth')
     args = parser.parse_args()
     main(args)
     